@@ -19,7 +19,8 @@ class Defaults:
     height: int = 512
     fps: int = 30
     audio: bool = False
-    codec: str = "libvpx-vp9"
+    # Семейство кодека; энкодер выбирается из доступных в ffmpeg (app/services/encoders.py)
+    codec: str = "vp9"
     crf: int = 32
     preset: str = "good"
 
@@ -28,9 +29,67 @@ class Defaults:
 class Config:
     bot_token: str
     defaults: Defaults
+    encode_workers: int
+    encoder: Optional[str]
+    editor_threads: int
+    download_cache_dir: str
+    download_cache_max_bytes: int
+    result_cache_enabled: bool
+    result_cache_dir: str
+    result_cache_max_bytes: int
+    result_cache_ttl: float
+    spool_dir: Optional[str]
+    spool_max_bytes: int
+    upload_max_bytes: int
+    encode_history: Optional[str]
+    file_id_store: str
+    fsm_storage: str
+    job_queue: str
+    mode: str
+    webhook_url: Optional[str]
+    webhook_path: str
+    webhook_host: str
+    webhook_port: int
+    webhook_secret: Optional[str]
+    webhook_max_in_flight: int
+    webhook_drain_timeout: float
 
     @staticmethod
     def load() -> "Config":
         load_dotenv()
         token = _env("BOT_TOKEN")
-        return Config(bot_token=token, defaults=Defaults())
+        encode_workers = int(_env("ENCODE_WORKERS", str(os.cpu_count() or 1)))
+        mode = _env("BOT_MODE", "polling").lower()
+        if mode not in ("polling", "webhook"):
+            raise RuntimeError(f"Unknown BOT_MODE {mode}")
+        # В режиме веб-хука секрет обязателен: без него кто угодно может слать обновления
+        webhook_secret = _env("WEBHOOK_SECRET") if mode == "webhook" else os.getenv("WEBHOOK_SECRET")
+        return Config(
+            bot_token=token,
+            defaults=Defaults(),
+            encode_workers=encode_workers,
+            encoder=os.getenv("ENCODER") or None,
+            editor_threads=int(_env("EDITOR_THREADS", str(min(4, os.cpu_count() or 1)))),
+            download_cache_dir=_env("DOWNLOAD_CACHE_DIR", "/tmp/tiktok_downloads"),
+            download_cache_max_bytes=int(_env("DOWNLOAD_CACHE_MAX_MB", "1024")) * 1024 * 1024,
+            result_cache_enabled=_env("RESULT_CACHE_ENABLED", "1").lower() not in ("0", "false", "no"),
+            result_cache_dir=_env("RESULT_CACHE_DIR", "/tmp/converter_results"),
+            result_cache_max_bytes=int(_env("RESULT_CACHE_MAX_MB", "512")) * 1024 * 1024,
+            result_cache_ttl=float(_env("RESULT_CACHE_TTL_HOURS", "24")) * 3600,
+            # Пустой SPOOL_DIR — временные выходы на диске
+            spool_dir=os.getenv("SPOOL_DIR", "/dev/shm") or None,
+            spool_max_bytes=int(_env("SPOOL_MAX_MB", "256")) * 1024 * 1024,
+            upload_max_bytes=int(_env("UPLOAD_MAX_MB", "50")) * 1024 * 1024,
+            encode_history=os.getenv("ENCODE_HISTORY", "/tmp/converter_encode_history.jsonl") or None,
+            file_id_store=_env("FILE_ID_STORE", "sqlite:/tmp/converter_file_ids.sqlite3"),
+            fsm_storage=_env("FSM_STORAGE", "memory"),
+            job_queue=_env("JOB_QUEUE", "local"),
+            mode=mode,
+            webhook_url=os.getenv("WEBHOOK_URL") or None,
+            webhook_path=_env("WEBHOOK_PATH", "/webhook"),
+            webhook_host=_env("WEBHOOK_HOST", "0.0.0.0"),
+            webhook_port=int(_env("WEBHOOK_PORT", "8000")),
+            webhook_secret=webhook_secret,
+            webhook_max_in_flight=int(_env("WEBHOOK_MAX_IN_FLIGHT", "100")),
+            webhook_drain_timeout=float(_env("WEBHOOK_DRAIN_TIMEOUT", "30")),
+        )
@@ -4,7 +4,7 @@ from aiogram.fsm.context import FSMContext
 
 from app.keyboards.inline import settings_menu, size_menu, fps_menu, crf_menu
 from app.config import Config
-from app.models import Settings
+from app.models import Settings, load_settings
 
 router = Router()
 
@@ -12,10 +12,10 @@ router = Router()
 @router.callback_query(F.data == "settings")
 async def open_settings(cb: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    settings = data.get("settings")
+    settings = load_settings(data)
     if not settings:
         settings = Settings.from_defaults(Config.load().defaults)
-        await state.update_data(settings=settings)
+        await state.update_data(settings=settings.to_dict())
     await cb.message.edit_text("Настройки конвертации", reply_markup=settings_menu(settings))
     await cb.answer()
 
@@ -30,9 +30,9 @@ async def choose_size(cb: CallbackQuery):
 async def set_size(cb: CallbackQuery, state: FSMContext):
     w, h = map(int, cb.data.split(":")[1].split("x"))
     data = await state.get_data()
-    s = data.get("settings")
+    s = load_settings(data)
     s.width, s.height = w, h
-    await state.update_data(settings=s)
+    await state.update_data(settings=s.to_dict())
     await open_settings(cb, state)
 
 
@@ -46,18 +46,18 @@ async def choose_fps(cb: CallbackQuery):
 async def set_fps(cb: CallbackQuery, state: FSMContext):
     fps = int(cb.data.split(":")[1])
     data = await state.get_data()
-    s = data.get("settings")
+    s = load_settings(data)
     s.fps = fps
-    await state.update_data(settings=s)
+    await state.update_data(settings=s.to_dict())
     await open_settings(cb, state)
 
 
 @router.callback_query(F.data == "toggle_audio")
 async def toggle_audio(cb: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    s = data.get("settings")
+    s = load_settings(data)
     s.audio = not s.audio
-    await state.update_data(settings=s)
+    await state.update_data(settings=s.to_dict())
     await open_settings(cb, state)
 
 
@@ -71,7 +71,7 @@ async def choose_crf(cb: CallbackQuery):
 async def set_crf(cb: CallbackQuery, state: FSMContext):
     crf = int(cb.data.split(":")[1])
     data = await state.get_data()
-    s = data.get("settings")
+    s = load_settings(data)
     s.crf = crf
-    await state.update_data(settings=s)
+    await state.update_data(settings=s.to_dict())
     await open_settings(cb, state)
@@ -1,11 +1,16 @@
+import shutil
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
-from aiogram.filters import CommandStart
+from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 
 from app.config import Config
 from app.keyboards.inline import main_menu
-from app.models import Settings
+from app.models import EditorSession, Settings, load_settings
+from app.services.async_editor import close_session_editor
+from app.services.metrics import metrics
+from app.services.tiktok import TikTokDownloader
 
 router = Router()
 
@@ -26,7 +31,7 @@ def format_main_menu_text(settings: Settings) -> str:
 async def cmd_start(message: Message, state: FSMContext):
     cfg = Config.load()
     settings = Settings.from_defaults(cfg.defaults)
-    await state.update_data(settings=settings)
+    await state.update_data(settings=settings.to_dict())
     msg = await message.answer(
         "⌛", reply_markup=ReplyKeyboardRemove(remove_keyboard=True)
     )
@@ -39,47 +44,72 @@ async def cmd_start(message: Message, state: FSMContext):
     )
 
 
+def release_tiktok_session(session: EditorSession) -> None:
+    """Отпускает загруженное видео, открытый редактор, рабочую вырезку и
+    заранее закодированный результат сессии TikTok"""
+    if session.downloader:
+        TikTokDownloader.from_state(session.downloader).cleanup()
+    close_session_editor(session.video_path)
+    for directory in (session.prepared_dir, session.working_dir):
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def format_stats_text() -> str:
+    lines = ["📊 <b>Статистика</b>", ""]
+    for name, title in (("download_cache", "📥 Кеш загрузок"), ("result_cache", "🎞 Кеш результатов")):
+        hit_ratio = metrics.ratio(f"{name}.hits", f"{name}.misses")
+        saved_mb = metrics.get(f"{name}.bytes_saved") / (1024 * 1024)
+        lines.append(f"{title}: {hit_ratio:.0%} попаданий, сэкономлено {saved_mb:.1f} MB")
+    frame_ratio = metrics.ratio("frame_cache.hits", "frame_cache.misses")
+    lines.append(f"🖼 Кеш кадров редактора: {frame_ratio:.0%} попаданий")
+    reuse_ratio = metrics.ratio("file_ids.hits", "file_ids.misses")
+    upload_saved_mb = metrics.get("file_ids.bytes_saved") / (1024 * 1024)
+    lines.append(f"📤 Повторные отправки по file_id: {reuse_ratio:.0%}, не загружено {upload_saved_mb:.1f} MB")
+    lines.append(
+        f"⏱ Задержка event loop: {metrics.get('loop_lag.last_ms'):.0f} ms "
+        f"(макс. {metrics.get('loop_lag.max_ms'):.0f} ms)"
+    )
+    lines.append("")
+    lines += [f"<code>{name}</code>: {value:g}" for name, value in metrics.snapshot().items()]
+    return "\n".join(lines)
+
+
+@router.message(Command("stats"))
+async def cmd_stats(message: Message):
+    await message.answer(format_stats_text(), parse_mode="HTML")
+
+
 @router.callback_query(F.data == "back_main")
 async def back_main(cb: CallbackQuery, state: FSMContext):
     data = await state.get_data()
+    session = EditorSession.from_data(data)
 
     # Проверяем, есть ли активные данные TikTok редактора для очистки
-    from app.services.tiktok import TikTokDownloader
-
-    downloader: TikTokDownloader = data.get("downloader")
-    if downloader:
-        downloader.cleanup()
+    release_tiktok_session(session)
 
     # Очищаем сообщение редактора TikTok, если есть
-    editor_menu_message_id = data.get("editor_menu_message_id")
-    editor_menu_chat_id = data.get("editor_menu_chat_id")
+    editor_menu_message_id = session.editor_menu_message_id
+    editor_menu_chat_id = session.editor_menu_chat_id
     if editor_menu_message_id and editor_menu_chat_id:
         try:
             await cb.bot.delete_message(editor_menu_chat_id, editor_menu_message_id)
         except Exception:
             pass
 
-    settings = data.get("settings")
-    if not settings:
-        settings = Settings.from_defaults(Config.load().defaults)
-        await state.update_data(settings=settings)
+    settings = load_settings(data) or Settings.from_defaults(Config.load().defaults)
 
-    # Пытаемся редактировать сообщение, если не получается - создаем новое
+    # Пытаемся редактировать сообщение, если не получается - создаем новое.
+    # Данные FSM ниже все равно очищаются, поэтому id меню не записываем
     try:
         await cb.message.edit_text(
             format_main_menu_text(settings), reply_markup=main_menu(), parse_mode="HTML"
         )
-        await state.update_data(
-            menu_message_id=cb.message.message_id, chat_id=cb.message.chat.id
-        )
     except Exception:
         # Если не удалось редактировать (сообщение не найдено), создаем новое
-        new_menu = await cb.message.answer(
+        await cb.message.answer(
             format_main_menu_text(settings), reply_markup=main_menu(), parse_mode="HTML"
         )
-        await state.update_data(
-            menu_message_id=new_menu.message_id, chat_id=new_menu.chat.id
-        )
 
     await state.clear()  # Очищаем состояние при возврате в главное меню
     await cb.answer()
@@ -1,45 +1,153 @@
+import asyncio
 import os
 import re
-import asyncio
+import shutil
 import tempfile
+from dataclasses import asdict
+from typing import Set
 
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile, InputMediaPhoto, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 
 from app.states import TikTokEditStates
 from app.config import Config
-from app.models import Settings
+from app.models import EditorSession, Settings, load_settings
 from app.keyboards.inline import (
     main_menu, back_menu, crop_edit_menu, crop_size_menu, 
     time_edit_menu, preview_menu
 )
-from app.services.tiktok import TikTokDownloader, VideoEditor
-from app.services.converter import Converter
-from app.handlers.start import format_main_menu_text
+from app.services.async_editor import open_session_editor
+from app.services.coalesce import PressCoalescer
+from app.services.tiktok import StreamHead, TikTokDownloader, cut_working_copy
+from app.services.cache import file_digest
+from app.services.converter import STICKER_MAX_BYTES, Converter, FFmpegError
+from app.services.file_ids import send_document
+from app.services.jobs import Job, get_job_queue
+from app.services.progress import StatusReporter
+from app.services.results import get_result_cache, job_key
+from app.services.spool import get_spool
+from app.handlers.start import format_main_menu_text, release_tiktok_session
 
 router = Router()
 
+# Запас по размеру при повторном сжатии: первый проход уже промахнулся
+COMPRESS_MARGIN = 0.8
+# Место в spool под mp4 предпросмотра (несколько секунд в 512x512)
+PREVIEW_SPOOL_BYTES = 4 * 1024 * 1024
+
+# Быстрые нажатия стрелок склеиваются, рисуется только последнее состояние
+press_coalescer = PressCoalescer()
+
+# Фоновые задачи хендлеров: ссылка не дает сборщику мусора прервать их
+_background_tasks: Set[asyncio.Task] = set()
+
 # Регулярное выражение для TikTok URL
 TIKTOK_URL_PATTERN = re.compile(
     r'(?:https?://)?(?:www\.)?(?:tiktok\.com|vm\.tiktok\.com|vt\.tiktok\.com)/.*'
 )
 
 
-async def add_message_for_cleanup(state: FSMContext, message_id: int, chat_id: int):
-    """Добавляет сообщение в список для очистки"""
-    data = await state.get_data()
-    cleanup_messages = data.get("cleanup_messages", [])
-    cleanup_messages.append({"message_id": message_id, "chat_id": chat_id})
-    await state.update_data(cleanup_messages=cleanup_messages)
+def add_message_for_cleanup(session: EditorSession, message: Message):
+    """Добавляет сообщение в список для очистки (сохраняется вместе с сессией)"""
+    session.cleanup_messages.append({"message_id": message.message_id, "chat_id": message.chat.id})
+
+
+def download_status(message: Message):
+    """Обработчик начала потока: дописывает в статус загрузки размеры и
+    длительность, как только их прочитал ffmpeg"""
+    async def on_head(head: StreamHead) -> None:
+        try:
+            await message.edit_text(
+                f"⏳ Загружаю видео с TikTok...\n\n🎞 {head.width}x{head.height}, {head.duration:.1f}s"
+            )
+        except TelegramBadRequest:
+            pass
+    return on_head
+
+
+async def encode_with_status(message: Message, title: str, user_id: int, **params) -> int:
+    """Кодирование под размер через очередь заданий с местом в очереди,
+    процентом и ETA в статусном сообщении"""
+    reporter = StatusReporter(message, title)
+    report_task = asyncio.create_task(reporter.run())
+    try:
+        result = await get_job_queue().run(
+            Job("encode_to_size", user_id, params),
+            on_position=reporter.on_position,
+            progress=reporter.stream,
+        )
+        return result["size"]
+    finally:
+        reporter.stream.close()
+        report_task.cancel()
+
+
+async def session_features(session: EditorSession) -> dict:
+    """Сложность выбранного отрезка для выбора параметров кодирования (кешируется редактором).
+
+    Прокси ради одной оценки перед итоговым кодированием не строится; если
+    уменьшенных кадров нет (например, после перезапуска), оценка
+    пропускается и параметры выбираются как без нее.
+    """
+    editor = await open_session_editor(session.video_path, build_proxy=False)
+    if not editor.has_small_frames:
+        return {}
+    return asdict(await editor.probe_content(session.start_time, session.duration, session.crop))
+
+
+async def sticker_result_key(session: EditorSession, settings: Settings) -> str:
+    """Ключ итогового стикера для кеша результатов и заранее закодированного webm"""
+    return job_key(
+        await file_digest(session.video_path),
+        settings,
+        kind="sticker",
+        crop=session.crop,
+        start_time=session.start_time,
+        duration=session.duration,
+        max_bytes=STICKER_MAX_BYTES,
+    )
+
+
+async def prepare_working_copy(state: FSMContext, user_id: int) -> None:
+    """Фоном вырезает выбранный отрезок и его прокси: дальше превью и
+    кодирование читают маленькие файлы вместо исходника"""
+    session = await EditorSession.load(state)
+    video_path = session.video_path
+    if not video_path:
+        return
+    editor = await open_session_editor(video_path)
+    work_dir = tempfile.mkdtemp(prefix="tiktok_work_")
+    try:
+        working_copy = await cut_working_copy(
+            editor, session.start_time, session.duration or min(3.0, session.total_duration), work_dir, user_id
+        )
+    except FFmpegError:
+        working_copy = None
+    # Пока резали, сессию могли закрыть или начать заново
+    session = await EditorSession.load(state)
+    if working_copy is None or session.video_path != video_path:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return
+    await editor.attach_window(working_copy)
+    previous = session.working_dir
+    session.working_dir, session.working_path = work_dir, working_copy.path
+    session.working_start, session.working_end = working_copy.start, working_copy.end
+    await session.save(state)
+    if previous:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def start_working_copy(state: FSMContext, user_id: int) -> None:
+    task = asyncio.create_task(prepare_working_copy(state, user_id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
 
-async def cleanup_messages(state: FSMContext, bot):
+async def cleanup_messages(session: EditorSession, bot):
     """Удаляет все сообщения из списка очистки"""
-    data = await state.get_data()
-    cleanup_messages = data.get("cleanup_messages", [])
-    
-    for msg_info in cleanup_messages:
+    for msg_info in session.cleanup_messages:
         try:
             await bot.delete_message(
                 chat_id=msg_info["chat_id"], 
@@ -49,7 +157,16 @@ async def cleanup_messages(state: FSMContext, bot):
             pass
     
     # Очищаем список
-    await state.update_data(cleanup_messages=[])
+    session.cleanup_messages = []
+
+
+async def delete_editor_menu(session: EditorSession, bot):
+    """Удаляет сообщение «Отправьте ссылку» редактора, если оно есть"""
+    if session.editor_menu_message_id and session.editor_menu_chat_id:
+        try:
+            await bot.delete_message(session.editor_menu_chat_id, session.editor_menu_message_id)
+        except Exception:
+            pass
 
 
 @router.message(F.text)
@@ -79,14 +196,17 @@ async def handle_tiktok_url_direct(message: Message, state: FSMContext):
     )
     
     # Сохраняем URL для дальнейшего использования
-    await state.update_data(pending_tiktok_url=url)
+    session = await EditorSession.load(state)
+    session.pending_url = url
+    await session.save(state)
 
 
 @router.callback_query(F.data == "tiktok_editor_direct")
 async def handle_tiktok_editor_direct(cb: CallbackQuery, state: FSMContext):
     """Обработка прямого перехода к редактору"""
     data = await state.get_data()
-    url = data.get("pending_tiktok_url")
+    session = EditorSession.from_data(data)
+    url = session.pending_url
     
     if not url:
         await cb.answer("Ошибка: URL не найден")
@@ -103,22 +223,23 @@ async def handle_tiktok_editor_direct(cb: CallbackQuery, state: FSMContext):
     
     loading_msg = await cb.message.edit_text("⏳ Загружаю видео с TikTok...")
     # Добавляем сообщение в список для очистки
-    await add_message_for_cleanup(state, loading_msg.message_id, loading_msg.chat.id)
+    add_message_for_cleanup(session, loading_msg)
     
     # Используем тот же код, что и в handle_tiktok_url
     downloader = TikTokDownloader()
     try:
         # Загружаем видео
-        video_path = await downloader.download_video(url)
+        video_path = await downloader.download_video(
+            url, on_head=download_status(loading_msg), user_id=cb.message.chat.id
+        )
         
         # ... (остальной код как в handle_tiktok_url)
-        # Создаем редактор видео
-        editor = VideoEditor(video_path)
+        # Создаем редактор видео; прокси, построенная во время загрузки, переходит к нему
+        editor = await open_session_editor(video_path, downloader.take_proxy())
         video_info = editor.get_video_info()
         
         # Получаем настройки
-        settings_data = await state.get_data()
-        settings = settings_data.get("settings")
+        settings = load_settings(data)
         if not settings:
             settings = Settings.from_defaults(Config.load().defaults)
         
@@ -133,26 +254,20 @@ async def handle_tiktok_editor_direct(cb: CallbackQuery, state: FSMContext):
         
         # Создаем превью времени (первый этап)
         crop_params = (crop_x, crop_y, crop_width, crop_height)
-        preview_bytes = editor.create_time_preview(start_time, duration, crop_params)
+        preview_bytes = await editor.create_time_preview(start_time, duration, crop_params)
         
         if not preview_bytes:
             await cb.message.edit_text("❌ Ошибка при обработке видео")
+            await session.save(state)
             return
         
-        # Сохраняем данные в состояние
-        await state.update_data(
-            video_path=video_path,
-            editor=editor,
-            downloader=downloader,
-            crop_x=crop_x,
-            crop_y=crop_y,
-            crop_width=crop_width,
-            crop_height=crop_height,
-            video_info=video_info,
-            settings=settings,
-            start_time=start_time,
-            duration=duration
-        )
+        # Заполняем сессию
+        session.video_path = video_path
+        session.downloader = downloader.to_state()
+        session.crop_x, session.crop_y, session.crop_width, session.crop_height = crop_params
+        session.video_info = video_info
+        session.start_time = start_time
+        session.duration = duration
         
         # Отправляем превью времени
         await cb.message.edit_media(
@@ -173,15 +288,13 @@ async def handle_tiktok_editor_direct(cb: CallbackQuery, state: FSMContext):
             reply_markup=time_edit_menu(start_time, duration, video_info["duration"])
         )
         
-        await state.update_data(
-            time_message_id=cb.message.message_id,
-            chat_id=cb.message.chat.id
-        )
+        await session.save(state, settings=settings.to_dict(), chat_id=cb.message.chat.id)
         await state.set_state(TikTokEditStates.time_editing)
         
     except Exception as e:
         await cb.message.edit_text(f"❌ Ошибка при загрузке видео: {str(e)}")
         downloader.cleanup()
+        await session.save(state)
     
     await cb.answer()
 
@@ -196,10 +309,10 @@ async def start_tiktok_editor(cb: CallbackQuery, state: FSMContext):
         parse_mode="HTML"
     )
     # Сохраняем ID сообщения для удаления после загрузки
-    await state.update_data(
-        editor_menu_message_id=cb.message.message_id,
-        editor_menu_chat_id=cb.message.chat.id
-    )
+    session = await EditorSession.load(state)
+    session.editor_menu_message_id = cb.message.message_id
+    session.editor_menu_chat_id = cb.message.chat.id
+    await session.save(state)
     await state.set_state(TikTokEditStates.waiting_url)
     await cb.answer()
 
@@ -217,6 +330,7 @@ async def handle_tiktok_url(message: Message, state: FSMContext):
     
     # Удаляем предыдущие сообщения
     data = await state.get_data()
+    session = EditorSession.from_data(data)
     
     # Удаляем главное меню если есть
     menu_msg_id = data.get("menu_message_id")
@@ -228,8 +342,8 @@ async def handle_tiktok_url(message: Message, state: FSMContext):
             pass
     
     # Удаляем сообщение редактора
-    editor_menu_msg_id = data.get("editor_menu_message_id")
-    editor_menu_chat_id = data.get("editor_menu_chat_id") or message.chat.id
+    editor_menu_msg_id = session.editor_menu_message_id
+    editor_menu_chat_id = session.editor_menu_chat_id or message.chat.id
     if editor_menu_msg_id and editor_menu_chat_id:
         try:
             await message.bot.delete_message(chat_id=editor_menu_chat_id, message_id=editor_menu_msg_id)
@@ -238,20 +352,21 @@ async def handle_tiktok_url(message: Message, state: FSMContext):
     
     status_msg = await message.answer("⏳ Загружаю видео с TikTok...")
     # Добавляем статусное сообщение в список для очистки
-    await add_message_for_cleanup(state, status_msg.message_id, status_msg.chat.id)
+    add_message_for_cleanup(session, status_msg)
     
     downloader = TikTokDownloader()
     try:
         # Загружаем видео
-        video_path = await downloader.download_video(url)
+        video_path = await downloader.download_video(
+            url, on_head=download_status(status_msg), user_id=message.chat.id
+        )
         
-        # Создаем редактор видео
-        editor = VideoEditor(video_path)
+        # Создаем редактор видео; прокси, построенная во время загрузки, переходит к нему
+        editor = await open_session_editor(video_path, downloader.take_proxy())
         video_info = editor.get_video_info()
         
         # Получаем настройки
-        settings_data = await state.get_data()
-        settings = settings_data.get("settings")
+        settings = load_settings(data)
         if not settings:
             settings = Settings.from_defaults(Config.load().defaults)
         
@@ -266,26 +381,20 @@ async def handle_tiktok_url(message: Message, state: FSMContext):
         
         # Создаем превью времени (первый этап)
         crop_params = (crop_x, crop_y, crop_width, crop_height)
-        preview_bytes = editor.create_time_preview(start_time, duration, crop_params)
+        preview_bytes = await editor.create_time_preview(start_time, duration, crop_params)
         
         if not preview_bytes:
             await status_msg.edit_text("❌ Ошибка при обработке видео")
+            await session.save(state)
             return
         
-        # Сохраняем данные в состояние
-        await state.update_data(
-            video_path=video_path,
-            editor=editor,
-            downloader=downloader,
-            crop_x=crop_x,
-            crop_y=crop_y,
-            crop_width=crop_width,
-            crop_height=crop_height,
-            video_info=video_info,
-            settings=settings,
-            start_time=start_time,
-            duration=duration
-        )
+        # Заполняем сессию
+        session.video_path = video_path
+        session.downloader = downloader.to_state()
+        session.crop_x, session.crop_y, session.crop_width, session.crop_height = crop_params
+        session.video_info = video_info
+        session.start_time = start_time
+        session.duration = duration
         
         # Отправляем превью времени
         await status_msg.delete()
@@ -306,10 +415,7 @@ async def handle_tiktok_url(message: Message, state: FSMContext):
             parse_mode="HTML"
         )
         
-        await state.update_data(
-            time_message_id=time_msg.message_id,
-            chat_id=time_msg.chat.id
-        )
+        await session.save(state, settings=settings.to_dict(), chat_id=time_msg.chat.id)
         await state.set_state(TikTokEditStates.time_editing)
         
     except Exception as e:
@@ -352,74 +458,82 @@ async def handle_tiktok_url(message: Message, state: FSMContext):
             )
         
         downloader.cleanup()
+        await session.save(state)
+
+
+# Шаги стрелок кропа в пикселях источника
+CROP_MOVES = {
+    "up": (0, -20),
+    "down": (0, 20),
+    "left": (-20, 0),
+    "right": (20, 0),
+}
 
 
 @router.callback_query(TikTokEditStates.crop_editing, F.data.startswith("crop_move:"))
 async def handle_crop_move(cb: CallbackQuery, state: FSMContext):
     """Обработка перемещения кропа"""
     direction = cb.data.split(":")[1]
-    data = await state.get_data()
+    if direction not in CROP_MOVES:
+        await cb.answer()
+        return
     
-    editor: VideoEditor = data["editor"]
-    crop_x = data["crop_x"]
-    crop_y = data["crop_y"]
-    crop_width = data["crop_width"]
-    crop_height = data["crop_height"]
-    settings = data["settings"]
-    
-    # Шаг перемещения
-    step = 20
-    
-    # Перемещаем кроп
-    if direction == "up":
-        crop_y = max(0, crop_y - step)
-    elif direction == "down":
-        crop_y = min(editor.height - crop_height, crop_y + step)
-    elif direction == "left":
-        crop_x = max(0, crop_x - step)
-    elif direction == "right":
-        crop_x = min(editor.width - crop_width, crop_x + step)
+    # Отвечаем сразу, превью догонит
+    await cb.answer()
     
-    # Создаем новое превью
-    preview_bytes = editor.create_crop_preview(crop_x, crop_y, crop_width, crop_height)
+    async def commit(offset):
+        dx, dy = offset
+        data = await state.get_data()
+        session = EditorSession.from_data(data)
+        editor = await open_session_editor(session.video_path)
+        session.crop_x = max(0, min(editor.width - session.crop_width, session.crop_x + int(dx)))
+        session.crop_y = max(0, min(editor.height - session.crop_height, session.crop_y + int(dy)))
+        
+        # Сохраняем новые координаты
+        await session.save(state)
+        return editor, load_settings(data), session.crop, session.start_time
     
-    if preview_bytes:
+    async def render(snapshot):
+        editor, settings, crop_params, start_time = snapshot
+        crop_width, crop_height = crop_params[2], crop_params[3]
+        
+        # Создаем новое превью на первом кадре выбранного отрезка
+        preview_bytes = await editor.create_crop_preview(*crop_params, time_seconds=start_time)
+        if not preview_bytes:
+            return
+        
+        caption = (
+            f"🎬 <b>Редактирование кропа</b>\n\n"
+            f"📐 Размер видео: {editor.width}x{editor.height}\n"
+            f"⏱ Длительность: {editor.duration:.1f}s\n"
+            f"✂️ Кроп: {crop_width}x{crop_height}\n\n"
+            f"Используйте стрелки для перемещения области обрезки:"
+        )
         # Обновляем сообщение
         try:
             await cb.message.edit_media(
                 media=InputMediaPhoto(
                     media=BufferedInputFile(preview_bytes, "crop_preview.jpg"),
-                    caption=(
-                        f"🎬 <b>Редактирование кропа</b>\n\n"
-                        f"📐 Размер видео: {editor.width}x{editor.height}\n"
-                        f"⏱ Длительность: {editor.duration:.1f}s\n"
-                        f"✂️ Кроп: {crop_width}x{crop_height}\n\n"
-                        f"Используйте стрелки для перемещения области обрезки:"
-                    ),
+                    caption=caption,
                     parse_mode="HTML"
                 ),
                 reply_markup=crop_edit_menu(settings)
             )
-        except Exception:
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return
             # Если не удалось обновить медиа, отправляем новое сообщение
             await cb.message.delete()
-            new_msg = await cb.message.answer_photo(
+            await cb.message.answer_photo(
                 BufferedInputFile(preview_bytes, "crop_preview.jpg"),
-                caption=(
-                    f"🎬 <b>Редактирование кропа</b>\n\n"
-                    f"📐 Размер видео: {editor.width}x{editor.height}\n"
-                    f"⏱ Длительность: {editor.duration:.1f}s\n"
-                    f"✂️ Кроп: {crop_width}x{crop_height}\n\n"
-                    f"Используйте стрелки для перемещения области обрезки:"
-                ),
+                caption=caption,
                 reply_markup=crop_edit_menu(settings),
                 parse_mode="HTML"
             )
-            await state.update_data(crop_message_id=new_msg.message_id)
     
-    # Сохраняем новые координаты
-    await state.update_data(crop_x=crop_x, crop_y=crop_y)
-    await cb.answer()
+    press_coalescer.push(
+        (cb.message.chat.id, cb.message.message_id), CROP_MOVES[direction], commit, render
+    )
 
 
 @router.callback_query(TikTokEditStates.crop_editing, F.data == "crop_size")
@@ -435,9 +549,11 @@ async def handle_crop_size_set(cb: CallbackQuery, state: FSMContext):
     size = cb.data.split(":")[1]
     width, height = map(int, size.split("x"))
     
+    await press_coalescer.flush((cb.message.chat.id, cb.message.message_id))
     data = await state.get_data()
-    editor: VideoEditor = data["editor"]
-    settings: Settings = data["settings"]
+    session = EditorSession.from_data(data)
+    editor = await open_session_editor(session.video_path)
+    settings = load_settings(data)
     
     # Обновляем настройки
     settings.width = width
@@ -445,9 +561,12 @@ async def handle_crop_size_set(cb: CallbackQuery, state: FSMContext):
     
     # Пересчитываем позицию кропа
     crop_x, crop_y, crop_width, crop_height = editor.calculate_crop_bounds(width, height)
+    session.crop_x, session.crop_y, session.crop_width, session.crop_height = crop_x, crop_y, crop_width, crop_height
     
     # Создаем новое превью
-    preview_bytes = editor.create_crop_preview(crop_x, crop_y, crop_width, crop_height)
+    preview_bytes = await editor.create_crop_preview(
+        crop_x, crop_y, crop_width, crop_height, time_seconds=session.start_time
+    )
     
     if preview_bytes:
         try:
@@ -467,7 +586,7 @@ async def handle_crop_size_set(cb: CallbackQuery, state: FSMContext):
             )
         except Exception:
             await cb.message.delete()
-            new_msg = await cb.message.answer_photo(
+            await cb.message.answer_photo(
                 BufferedInputFile(preview_bytes, "crop_preview.jpg"),
                 caption=(
                     f"🎬 <b>Редактирование кропа</b>\n\n"
@@ -479,16 +598,9 @@ async def handle_crop_size_set(cb: CallbackQuery, state: FSMContext):
                 reply_markup=crop_edit_menu(settings),
                 parse_mode="HTML"
             )
-            await state.update_data(crop_message_id=new_msg.message_id)
     
     # Сохраняем новые параметры
-    await state.update_data(
-        settings=settings,
-        crop_x=crop_x,
-        crop_y=crop_y,
-        crop_width=crop_width,
-        crop_height=crop_height
-    )
+    await session.save(state, settings=settings.to_dict())
     await cb.answer()
 
 
@@ -496,7 +608,7 @@ async def handle_crop_size_set(cb: CallbackQuery, state: FSMContext):
 async def handle_crop_back(cb: CallbackQuery, state: FSMContext):
     """Возврат к редактированию кропа"""
     data = await state.get_data()
-    settings = data["settings"]
+    settings = load_settings(data)
     await cb.message.edit_reply_markup(reply_markup=crop_edit_menu(settings))
     await cb.answer()
 
@@ -505,38 +617,28 @@ async def handle_crop_back(cb: CallbackQuery, state: FSMContext):
 async def handle_crop_back_to_main(cb: CallbackQuery, state: FSMContext):
     """Возврат в главное меню из редактирования кропа"""
     data = await state.get_data()
-    settings = data.get("settings")
+    session = EditorSession.from_data(data)
+    settings = load_settings(data)
     
     # Очищаем временные данные
-    downloader: TikTokDownloader = data.get("downloader")
-    if downloader:
-        downloader.cleanup()
+    release_tiktok_session(session)
     
     # Очищаем сообщение редактора TikTok
-    editor_menu_message_id = data.get("editor_menu_message_id")
-    editor_menu_chat_id = data.get("editor_menu_chat_id")
-    if editor_menu_message_id and editor_menu_chat_id:
-        try:
-            await cb.bot.delete_message(editor_menu_chat_id, editor_menu_message_id)
-        except Exception:
-            pass
+    await delete_editor_menu(session, cb.bot)
     
     # Очищаем все служебные сообщения
-    await cleanup_messages(state, cb.bot)
+    await cleanup_messages(session, cb.bot)
     
     await cb.message.delete()
     
     if settings:
-        new_menu = await cb.message.answer(
+        await cb.message.answer(
             format_main_menu_text(settings),
             reply_markup=main_menu(),
             parse_mode="HTML"
         )
-        await state.update_data(
-            menu_message_id=new_menu.message_id,
-            chat_id=new_menu.chat.id
-        )
     
+    # Данные FSM очищаются целиком, промежуточные записи не нужны
     await state.clear()
     await cb.answer()
 
@@ -545,16 +647,15 @@ async def handle_crop_back_to_main(cb: CallbackQuery, state: FSMContext):
 async def handle_tiktok_back_to_main(cb: CallbackQuery, state: FSMContext):
     """Возврат в главное меню из TikTok редактора"""
     data = await state.get_data()
-    settings = data.get("settings")
+    session = EditorSession.from_data(data)
+    settings = load_settings(data)
     
     # Очищаем временные данные
-    downloader: TikTokDownloader = data.get("downloader")
-    if downloader:
-        downloader.cleanup()
+    release_tiktok_session(session)
         
     # Очищаем временные файлы если они есть (от процесса сжатия)
-    oversized_file_path = data.get("oversized_file_path")
-    temp_dir = data.get("temp_dir_path")
+    oversized_file_path = session.oversized_file_path
+    temp_dir = session.temp_dir_path
     if oversized_file_path and os.path.exists(oversized_file_path):
         try:
             os.remove(oversized_file_path)
@@ -567,21 +668,14 @@ async def handle_tiktok_back_to_main(cb: CallbackQuery, state: FSMContext):
             pass
     
     # Очищаем сообщение редактора TikTok
-    editor_menu_message_id = data.get("editor_menu_message_id")
-    editor_menu_chat_id = data.get("editor_menu_chat_id")
-    if editor_menu_message_id and editor_menu_chat_id:
-        try:
-            await cb.bot.delete_message(editor_menu_chat_id, editor_menu_message_id)
-        except Exception:
-            pass
+    await delete_editor_menu(session, cb.bot)
     
     # Очищаем все служебные сообщения
-    await cleanup_messages(state, cb.bot)
+    await cleanup_messages(session, cb.bot)
     
     # Убеждаемся, что настройки загружены
     if not settings:
         settings = Settings.from_defaults(Config.load().defaults)
-        await state.update_data(settings=settings)
     
     # Изменяем текущее сообщение на главное меню вместо удаления
     try:
@@ -590,22 +684,15 @@ async def handle_tiktok_back_to_main(cb: CallbackQuery, state: FSMContext):
             reply_markup=main_menu(),
             parse_mode="HTML"
         )
-        await state.update_data(
-            menu_message_id=cb.message.message_id,
-            chat_id=cb.message.chat.id
-        )
     except Exception:
         # Если не удалось редактировать, создаем новое сообщение
-        new_menu = await cb.message.answer(
+        await cb.message.answer(
             format_main_menu_text(settings),
             reply_markup=main_menu(),
             parse_mode="HTML"
         )
-        await state.update_data(
-            menu_message_id=new_menu.message_id,
-            chat_id=new_menu.chat.id
-        )
     
+    # Данные FSM очищаются целиком, промежуточные записи не нужны
     await state.clear()
     await cb.answer()
 
@@ -613,6 +700,7 @@ async def handle_tiktok_back_to_main(cb: CallbackQuery, state: FSMContext):
 @router.callback_query(TikTokEditStates.crop_editing, F.data == "crop_next")
 async def handle_crop_next(cb: CallbackQuery, state: FSMContext):
     """Переход к предпросмотру"""
+    await press_coalescer.flush((cb.message.chat.id, cb.message.message_id))
     await show_preview(cb, state)
     await cb.answer()
 
@@ -621,46 +709,85 @@ async def handle_time_ignore(cb: CallbackQuery, state: FSMContext):
     """Обработка игнорируемой кнопки"""
     await cb.answer("Ниже кнопки для управления временем")
 
+def time_edit_caption(total_duration: float, start_time: float, duration: float) -> str:
+    return (
+        f"⏰ <b>Выбор временного отрезка</b>\n\n"
+        f"📹 Общая длительность: {total_duration:.1f}s\n"
+        f"✂️ Выбранный отрезок: {start_time:.1f}s - {start_time + duration:.1f}s\n"
+        f"⏱ Длительность: {duration:.1f}s\n\n"
+        f"📝 <b>Управление:</b>\n"
+        f"⏪⏪ = -1 сек   ⏪ = -0.1 сек\n"
+        f"⏩ = +0.1 сек   ⏩⏩ = +1 сек\n\n"
+        f"Максимальная длительность: 3.0s"
+    )
+
+
 @router.callback_query(TikTokEditStates.time_editing, F.data.startswith("time_"))
 async def handle_time_edit(cb: CallbackQuery, state: FSMContext):
     """Обработка редактирования времени"""
     action = cb.data.split(":")[0]
     direction = cb.data.split(":")[1] if ":" in cb.data else None
+    session_key = (cb.message.chat.id, cb.message.message_id)
     
+    if action in ("time_start", "time_end") and direction:
+        # Определяем шаг в зависимости от типа кнопки
+        if direction.endswith("_fast"):
+            step = 1.0  # Быстрый шаг - 1 секунда
+            direction = direction.replace("_fast", "")  # Убираем суффикс
+        else:
+            step = 0.1  # Обычный шаг - 0.1 секунды
+        delta = -step if direction == "left" else step
+        offset = (delta, 0.0) if action == "time_start" else (0.0, delta)
+        
+        # Отвечаем сразу, превью догонит
+        await cb.answer()
+        
+        async def commit(offset):
+            d_start, d_duration = offset
+            session = await EditorSession.load(state)
+            total = session.total_duration
+            max_duration = min(3.0, total)
+            duration = session.duration or max_duration
+            
+            start_time = max(0.0, min(total - duration, session.start_time + d_start))
+            if d_duration:
+                duration = max(0.1, min(max_duration, total - start_time, duration + d_duration))
+            
+            session.start_time, session.duration = start_time, duration
+            await session.save(state)
+            return await open_session_editor(session.video_path), total, start_time, duration, session.crop
+        
+        async def render(snapshot):
+            editor, total, start_time, duration, crop_params = snapshot
+            preview_bytes = await editor.create_time_preview(start_time, duration, crop_params)
+            if not preview_bytes:
+                return
+            try:
+                await cb.message.edit_media(
+                    media=InputMediaPhoto(
+                        media=BufferedInputFile(preview_bytes, "time_preview.jpg"),
+                        caption=time_edit_caption(total, start_time, duration),
+                        parse_mode="HTML"
+                    ),
+                    reply_markup=time_edit_menu(start_time, duration, total)
+                )
+            except TelegramBadRequest:
+                pass
+        
+        press_coalescer.push(session_key, offset, commit, render)
+        return
+    
+    # Остальные кнопки работают с уже примененными нажатиями
+    await press_coalescer.flush(session_key)
     data = await state.get_data()
-    editor: VideoEditor = data["editor"]
-    video_info = data["video_info"]
-    start_time = data.get("start_time", 0.0)
-    duration = data.get("duration", min(3.0, video_info.get("duration", 3.0)))
-    max_duration = min(3.0, video_info.get("duration", 3.0))
-    
-    # Определяем шаг в зависимости от типа кнопки
-    if direction and direction.endswith("_fast"):
-        step = 1.0  # Быстрый шаг - 1 секунда
-        direction = direction.replace("_fast", "")  # Убираем суффикс
-    else:
-        step = 0.1  # Обычный шаг - 0.1 секунды
-    
-    if action == "time_start":
-        if direction == "left":
-            start_time = max(0, start_time - step)
-        elif direction == "right":
-            start_time = min(video_info["duration"] - duration, start_time + step)
-    
-    elif action == "time_end":
-        if direction == "left":
-            new_duration = max(0.1, duration - step)
-            if start_time + new_duration <= video_info["duration"]:
-                duration = new_duration
-        elif direction == "right":
-            new_duration = min(max_duration, duration + step)
-            if start_time + new_duration <= video_info["duration"]:
-                duration = new_duration
-    
-    elif action == "time_back":
+    session = EditorSession.from_data(data)
+    start_time = session.start_time
+    duration = session.duration or min(3.0, session.total_duration)
+    
+    if action == "time_back":
         # Возврат к редактированию кропа
-        crop_params = (data["crop_x"], data["crop_y"], data["crop_width"], data["crop_height"])
-        preview_bytes = editor.create_crop_preview(*crop_params)
+        editor = await open_session_editor(session.video_path)
+        preview_bytes = await editor.create_crop_preview(*session.crop, time_seconds=session.start_time)
         
         if preview_bytes:
             try:
@@ -670,14 +797,14 @@ async def handle_time_edit(cb: CallbackQuery, state: FSMContext):
                         f"🎬 <b>Редактирование кропа</b>\n\n"
                         f"📐 Размер видео: {editor.width}x{editor.height}\n"
                         f"⏱ Длительность: {editor.duration:.1f}s\n"
-                        f"✂️ Кроп: {data['crop_width']}x{data['crop_height']}\n\n"
+                        f"✂️ Кроп: {session.crop_width}x{session.crop_height}\n\n"
                         f"Используйте стрелки для перемещения области обрезки:"
                     ),
                     parse_mode="HTML"
                 )
                 await cb.message.edit_media(
                     media=media,
-                    reply_markup=crop_edit_menu(data["settings"])
+                    reply_markup=crop_edit_menu(load_settings(data))
                 )
             except Exception:
                 pass
@@ -687,6 +814,8 @@ async def handle_time_edit(cb: CallbackQuery, state: FSMContext):
         return
     
     elif action == "time_done":
+        # Отрезок выбран: готовим рабочую вырезку, пока пользователь двигает кроп
+        start_working_copy(state, cb.message.chat.id)
         # Переходим к редактированию кропа
         await show_crop_editing(cb, state)
         return
@@ -695,45 +824,17 @@ async def handle_time_edit(cb: CallbackQuery, state: FSMContext):
         await cb.answer(f"Отрезок: {start_time:.1f}s - {start_time + duration:.1f}s")
         return
     
-    # Обновляем превью
-    crop_params = (data["crop_x"], data["crop_y"], data["crop_width"], data["crop_height"])
-    preview_bytes = editor.create_time_preview(start_time, duration, crop_params)
-    
-    if preview_bytes:
-        try:
-            media = InputMediaPhoto(
-                media=BufferedInputFile(preview_bytes, "time_preview.jpg"),
-                caption=(
-                    f"⏰ <b>Выбор временного отрезка</b>\n\n"
-                    f"📹 Общая длительность: {video_info['duration']:.1f}s\n"
-                    f"✂️ Выбранный отрезок: {start_time:.1f}s - {start_time + duration:.1f}s\n"
-                    f"⏱ Длительность: {duration:.1f}s\n\n"
-                    f"📝 <b>Управление:</b>\n"
-                    f"⏪⏪ = -1 сек   ⏪ = -0.1 сек\n"
-                    f"⏩ = +0.1 сек   ⏩⏩ = +1 сек\n\n"
-                    f"Максимальная длительность: 3.0s"
-                ),
-                parse_mode="HTML"
-            )
-            await cb.message.edit_media(
-                media=media,
-                reply_markup=time_edit_menu(start_time, duration, video_info["duration"])
-            )
-        except Exception:
-            pass
-    
-    await state.update_data(start_time=start_time, duration=duration)
     await cb.answer()
 
 
 async def show_crop_editing(cb: CallbackQuery, state: FSMContext):
     """Показать интерфейс редактирования кропа"""
     data = await state.get_data()
-    editor: VideoEditor = data["editor"]
-    settings = data["settings"]
-    crop_params = (data["crop_x"], data["crop_y"], data["crop_width"], data["crop_height"])
+    session = EditorSession.from_data(data)
+    editor = await open_session_editor(session.video_path)
+    settings = load_settings(data)
     
-    preview_bytes = editor.create_crop_preview(*crop_params)
+    preview_bytes = await editor.create_crop_preview(*session.crop, time_seconds=session.start_time)
     
     if preview_bytes:
         await cb.message.edit_media(
@@ -743,7 +844,7 @@ async def show_crop_editing(cb: CallbackQuery, state: FSMContext):
                     f"🎬 <b>Редактирование кропа</b>\n\n"
                     f"📐 Размер видео: {editor.width}x{editor.height}\n"
                     f"⏱ Длительность: {editor.duration:.1f}s\n"
-                    f"✂️ Кроп: {data['crop_width']}x{data['crop_height']}\n\n"
+                    f"✂️ Кроп: {session.crop_width}x{session.crop_height}\n\n"
                     f"Используйте стрелки для перемещения области обрезки:"
                 ),
                 parse_mode="HTML"
@@ -751,51 +852,72 @@ async def show_crop_editing(cb: CallbackQuery, state: FSMContext):
             reply_markup=crop_edit_menu(settings)
         )
         
-        await state.update_data(
-            crop_message_id=cb.message.message_id,
-            chat_id=cb.message.chat.id
-        )
         await state.set_state(TikTokEditStates.crop_editing)
 
 
 async def show_preview(cb: CallbackQuery, state: FSMContext):
     """Показывает предпросмотр результата"""
     data = await state.get_data()
-    editor: VideoEditor = data["editor"]
-    
-    crop_x = data["crop_x"]
-    crop_y = data["crop_y"]  
-    crop_width = data["crop_width"]
-    crop_height = data["crop_height"]
+    session = EditorSession.from_data(data)
+    editor = await open_session_editor(session.video_path)
+    crop_x, crop_y, crop_width, crop_height = session.crop
     
     # Обеспечиваем наличие параметров времени
-    video_info = data.get("video_info", {})
-    start_time = data.get("start_time", 0.0)
-    duration = data.get("duration", min(3.0, video_info.get("duration", 3.0)))
-    
-    # Сохраняем параметры времени, если их не было
-    if "start_time" not in data or "duration" not in data:
-        await state.update_data(start_time=start_time, duration=duration)
+    if not session.duration:
+        session.duration = min(3.0, session.total_duration)
+    start_time = session.start_time
+    duration = session.duration
     
-    settings: Settings = data["settings"]
+    settings = load_settings(data)
     
     # Создаем превью
     await cb.message.delete()
     preview_msg = await cb.message.answer("🎬 Создаю предпросмотр...")
-    await add_message_for_cleanup(state, preview_msg.message_id, preview_msg.chat.id)
+    add_message_for_cleanup(session, preview_msg)
     
+    temp_dir = prepared_dir = None
     try:
         # Временный файл для превью
-        temp_dir = tempfile.mkdtemp(prefix="preview_")
+        temp_dir = get_spool().mkdtemp("preview_", PREVIEW_SPOOL_BYTES)
         preview_path = os.path.join(temp_dir, "preview.mp4")
         
+        # Тем же декодированием кодируем итоговый webm и сжатый вариант:
+        # после подтверждения их останется только отправить
+        if session.prepared_dir:
+            shutil.rmtree(session.prepared_dir, ignore_errors=True)
+        session.prepared_key = session.prepared_dir = None
+        result_key = await sticker_result_key(session, settings)
+        extra_outputs = []
+        if not get_result_cache().get(result_key):
+            prepared_dir = get_spool().mkdtemp("tiktok_result_", 2 * STICKER_MAX_BYTES)
+            converter = Converter()
+            features = await editor.probe_content(start_time, duration, session.crop)
+            extra_outputs = [
+                await converter.sticker_output(
+                    os.path.join(prepared_dir, "result.webm"), settings, duration, features=features
+                ),
+                await converter.sticker_output(
+                    os.path.join(prepared_dir, "compressed.webm"), settings, duration,
+                    margin=COMPRESS_MARGIN, features=features,
+                ),
+            ]
+        
         crop_params = (crop_x, crop_y, crop_width, crop_height)
-        success = await editor.create_video_preview(start_time, duration, crop_params, preview_path)
+        input_path, input_start = session.encode_input()
+        success = await editor.create_video_preview(
+            input_start,
+            duration,
+            crop_params,
+            preview_path,
+            user_id=cb.message.chat.id,
+            extra_outputs=extra_outputs,
+            input_path=input_path,
+        )
+        if extra_outputs and success:
+            session.prepared_key, session.prepared_dir = result_key, prepared_dir
         
         if success:
             await preview_msg.edit_text("📱 Предпросмотр результата:")
-            # Добавляем сообщение предпросмотра в список для очистки
-            await add_message_for_cleanup(state, preview_msg.message_id, preview_msg.chat.id)
             
             video_msg = await preview_msg.answer_video(
                 FSInputFile(preview_path),
@@ -810,20 +932,21 @@ async def show_preview(cb: CallbackQuery, state: FSMContext):
                 parse_mode="HTML"
             )
             # Добавляем видео с превью в список для очистки
-            await add_message_for_cleanup(state, video_msg.message_id, video_msg.chat.id)
-            
-            # Очистка
-            try:
-                os.remove(preview_path)
-                os.rmdir(temp_dir)
-            except Exception:
-                pass
+            add_message_for_cleanup(session, video_msg)
         else:
             await preview_msg.edit_text("❌ Ошибка создания предпросмотра")
             
     except Exception as e:
         await preview_msg.edit_text(f"❌ Ошибка: {str(e)}")
     
+    finally:
+        # Каталоги в spool занимают память: удаляем и после ошибки
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        if prepared_dir and prepared_dir != session.prepared_dir:
+            shutil.rmtree(prepared_dir, ignore_errors=True)
+    
+    await session.save(state)
     await state.set_state(TikTokEditStates.preview)
     await cb.answer()
 
@@ -839,11 +962,11 @@ async def handle_preview_convert(cb: CallbackQuery, state: FSMContext):
 async def handle_preview_edit_crop(cb: CallbackQuery, state: FSMContext):
     """Возврат к редактированию кропа"""
     data = await state.get_data()
-    editor: VideoEditor = data["editor"]
-    settings = data["settings"]
-    crop_params = (data["crop_x"], data["crop_y"], data["crop_width"], data["crop_height"])
+    session = EditorSession.from_data(data)
+    editor = await open_session_editor(session.video_path)
+    settings = load_settings(data)
     
-    preview_bytes = editor.create_crop_preview(*crop_params)
+    preview_bytes = await editor.create_crop_preview(*session.crop, time_seconds=session.start_time)
     
     if preview_bytes:
         # Изменяем текущее сообщение на кроп-редактор
@@ -854,7 +977,7 @@ async def handle_preview_edit_crop(cb: CallbackQuery, state: FSMContext):
                     f"🎬 <b>Редактирование кропа</b>\n\n"
                     f"📐 Размер видео: {editor.width}x{editor.height}\n"
                     f"⏱ Длительность: {editor.duration:.1f}s\n"
-                    f"✂️ Кроп: {data['crop_width']}x{data['crop_height']}\n\n"
+                    f"✂️ Кроп: {session.crop_width}x{session.crop_height}\n\n"
                     f"Используйте стрелки для перемещения области обрезки:"
                 ),
                 parse_mode="HTML"
@@ -862,10 +985,6 @@ async def handle_preview_edit_crop(cb: CallbackQuery, state: FSMContext):
             reply_markup=crop_edit_menu(settings)
         )
         
-        await state.update_data(
-            crop_message_id=cb.message.message_id,
-            chat_id=cb.message.chat.id
-        )
         await state.set_state(TikTokEditStates.crop_editing)
     
     await cb.answer()
@@ -874,14 +993,13 @@ async def handle_preview_edit_crop(cb: CallbackQuery, state: FSMContext):
 @router.callback_query(TikTokEditStates.preview, F.data == "preview_edit_time")
 async def handle_preview_edit_time(cb: CallbackQuery, state: FSMContext):
     """Возврат к редактированию времени"""
-    data = await state.get_data()
-    editor: VideoEditor = data["editor"]
-    video_info = data["video_info"]
-    start_time = data.get("start_time", 0.0)
-    duration = data.get("duration", min(3.0, video_info.get("duration", 3.0)))
+    session = await EditorSession.load(state)
+    editor = await open_session_editor(session.video_path)
+    video_info = session.video_info
+    start_time = session.start_time
+    duration = session.duration or min(3.0, session.total_duration)
     
-    crop_params = (data["crop_x"], data["crop_y"], data["crop_width"], data["crop_height"])
-    preview_bytes = editor.create_time_preview(start_time, duration, crop_params)
+    preview_bytes = await editor.create_time_preview(start_time, duration, session.crop)
     
     if preview_bytes:
         # Изменяем текущее сообщение на редактор времени
@@ -903,7 +1021,6 @@ async def handle_preview_edit_time(cb: CallbackQuery, state: FSMContext):
             reply_markup=time_edit_menu(start_time, duration, video_info["duration"])
         )
         
-        await state.update_data(crop_message_id=cb.message.message_id)
         await state.set_state(TikTokEditStates.time_editing)
     
     await cb.answer()
@@ -913,11 +1030,13 @@ async def handle_preview_edit_time(cb: CallbackQuery, state: FSMContext):
 async def handle_compress_file(cb: CallbackQuery, state: FSMContext):
     """Обработка сжатия файла"""
     data = await state.get_data()
-    oversized_file_path = data.get("oversized_file_path")
-    temp_dir = data.get("temp_dir_path")
+    session = EditorSession.from_data(data)
+    oversized_file_path = session.oversized_file_path
+    temp_dir = session.temp_dir_path
     
     # Убираем флаг ожидания выбора
-    await state.update_data(awaiting_compression_choice=False)
+    session.awaiting_compression_choice = False
+    await session.save(state)
     
     if not oversized_file_path or not os.path.exists(oversized_file_path):
         await cb.message.edit_text("❌ Файл не найден")
@@ -927,100 +1046,80 @@ async def handle_compress_file(cb: CallbackQuery, state: FSMContext):
     
     try:
         # Получаем параметры из состояния
-        settings: Settings = data["settings"]
-        crop_x = data["crop_x"]
-        crop_y = data["crop_y"]
-        crop_width = data["crop_width"]
-        crop_height = data["crop_height"]
-        start_time = data["start_time"]
-        duration = data["duration"]
-        video_path = data["video_path"]
+        settings = load_settings(data)
+        crop_x, crop_y, crop_width, crop_height = session.crop
+        duration = session.duration
+        # Рабочая вырезка, если она готова, иначе исходник
+        video_path, start_time = session.encode_input()
         
-        from app.services.converter import Converter
-        converter = Converter()
-        
-        # Попытки сжатия с разными параметрами
-        compression_attempts = [
-            {"crf": 35, "bitrate": "500k"},    # Первая попытка
-            {"crf": 40, "bitrate": "300k"},    # Вторая попытка  
-            {"crf": 45, "bitrate": "200k"},    # Третья попытка
-            {"crf": 50, "bitrate": "150k"},    # Четвертая попытка
-        ]
+        # Одно кодирование под байтовый бюджет с повышенным запасом вместо
+        # лестницы из четырех попыток с разными CRF
+        compressed_path = os.path.join(temp_dir, "compressed.webm")
+        file_size = None
+        if session.prepared_key == session.result_key and os.path.exists(compressed_path):
+            # Сжатый вариант закодирован вместе с превью
+            file_size = os.path.getsize(compressed_path)
+        if file_size is None or file_size > STICKER_MAX_BYTES:
+            try:
+                file_size = await encode_with_status(
+                    processing_msg,
+                    "🗜 Сжимаю файл...",
+                    cb.message.chat.id,
+                    input_path=video_path,
+                    output_path=compressed_path,
+                    settings=settings.to_dict(),
+                    duration=duration,
+                    max_bytes=STICKER_MAX_BYTES,
+                    start_time=start_time,
+                    crop=[crop_x, crop_y, crop_width, crop_height],
+                    margin=COMPRESS_MARGIN,
+                    features=await session_features(session),
+                )
+            except FFmpegError:
+                file_size = None
         
-        compressed_path = None
-        for attempt_num, params in enumerate(compression_attempts, 1):
-            await processing_msg.edit_text(f"🗜 Сжимаю файл... Попытка {attempt_num}/4")
-            
-            compressed_path = os.path.join(temp_dir, f"compressed_{attempt_num}.webm")
-            
-            # Формируем команду FFmpeg с дополнительным сжатием
-            ffmpeg_path = converter.ffmpeg
-            cmd = [
-                ffmpeg_path,
-                "-y",
-                "-ss", str(start_time),
-                "-t", str(duration),
-                "-i", video_path,
-                "-vf", f"crop={crop_width}:{crop_height}:{crop_x}:{crop_y},scale={settings.width}:{settings.height}:flags=lanczos",
-                "-r", str(settings.fps),
-                "-c:v", "libvpx-vp9",
-                "-crf", str(params["crf"]),
-                "-b:v", params["bitrate"],
-                "-c:a", "libopus" if settings.audio else "copy",
-                "-b:a", "64k" if settings.audio else "0",
-                "-an" if not settings.audio else "",
-                compressed_path
-            ]
+        if file_size is not None and file_size <= STICKER_MAX_BYTES:
+            # Следующий такой же запрос сразу получит сжатую версию
+            results = get_result_cache()
+            if results.enabled and session.result_key:
+                compressed_path = results.put(session.result_key, compressed_path)
             
-            # Удаляем пустые элементы
-            cmd = [x for x in cmd if x]
+            # Отправляем сжатый файл
+            await processing_msg.edit_text("✅ Готово! Отправляю сжатый файл...")
             
-            # Запускаем сжатие
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+            await send_document(
+                processing_msg,
+                compressed_path,
+                caption=f"📱 TikTok видео (сжатое)\n"
+                       f"📐 {settings.width}x{settings.height}\n"
+                       f"⏱ {duration:.1f}s\n"
+                       f"📦 {file_size // 1024} KB"
             )
-            stdout, stderr = await process.communicate()
             
-            if process.returncode == 0 and os.path.exists(compressed_path):
-                file_size = os.path.getsize(compressed_path)
-                if file_size <= 256 * 1024:  # Успешно сжали до нужного размера
-                    # Отправляем сжатый файл
-                    await processing_msg.edit_text("✅ Готово! Отправляю сжатый файл...")
-                    
-                    await processing_msg.answer_document(
-                        FSInputFile(compressed_path),
-                        caption=f"📱 TikTok видео (сжатое)\n"
-                               f"📐 {settings.width}x{settings.height}\n"
-                               f"⏱ {duration:.1f}s\n"
-                               f"📦 {file_size // 1024} KB"
-                    )
-                    
-                    # Очистка всех файлов
-                    try:
-                        if os.path.exists(oversized_file_path):
-                            os.remove(oversized_file_path)
-                        if os.path.exists(compressed_path):
-                            os.remove(compressed_path)
-                        if os.path.exists(temp_dir):
-                            os.rmdir(temp_dir)
-                    except Exception:
-                        pass
-                    
-                    # Очищаем все сообщения и возвращаемся в главное меню
-                    await cleanup_messages(state, cb.bot)
-                    await return_to_main_menu(state, cb)
-                    return
+            # Очистка всех файлов
+            try:
+                if os.path.exists(oversized_file_path):
+                    os.remove(oversized_file_path)
+                if os.path.exists(compressed_path) and not results.owns(compressed_path):
+                    os.remove(compressed_path)
+                if os.path.exists(temp_dir):
+                    os.rmdir(temp_dir)
+            except Exception:
+                pass
             
-            # Удаляем неудачную попытку
-            if os.path.exists(compressed_path):
-                os.remove(compressed_path)
+            # Очищаем все сообщения и возвращаемся в главное меню
+            await cleanup_messages(session, cb.bot)
+            await return_to_main_menu(state, cb)
+            return
+        
+        # Удаляем неудачную попытку
+        if os.path.exists(compressed_path):
+            os.remove(compressed_path)
         
         # Если не удалось сжать до нужного размера
         await processing_msg.edit_text(
             "❌ <b>Не получилось уменьшить файл</b>\n\n"
-            "Попробованы разные способы сжатия, но файл всё ещё слишком большой.\n\n"
+            "Даже при минимальном битрейте файл всё ещё слишком большой.\n\n"
             "💡 <b>Рекомендации:</b>\n"
             "• Уменьшите длительность видео\n" 
             "• Выберите меньшее разрешение\n"
@@ -1052,12 +1151,10 @@ async def handle_compress_file(cb: CallbackQuery, state: FSMContext):
 async def return_to_main_menu(state: FSMContext, message_or_callback):
     """Возврат в главное меню"""
     data = await state.get_data()
-    settings = data.get("settings")
+    settings = load_settings(data)
     
     # Очищаем временные данные
-    downloader: TikTokDownloader = data.get("downloader")
-    if downloader:
-        downloader.cleanup()
+    release_tiktok_session(EditorSession.from_data(data))
     
     if settings:
         # Определяем, что нам передали - message или callback
@@ -1071,16 +1168,12 @@ async def return_to_main_menu(state: FSMContext, message_or_callback):
             bot = message_or_callback.bot
         
         try:
-            new_menu = await bot.send_message(
+            await bot.send_message(
                 chat_id,
                 format_main_menu_text(settings),
                 reply_markup=main_menu(),
                 parse_mode="HTML"
             )
-            await state.update_data(
-                menu_message_id=new_menu.message_id,
-                chat_id=new_menu.chat.id
-            )
         except Exception:
             pass
     
@@ -1090,88 +1183,78 @@ async def return_to_main_menu(state: FSMContext, message_or_callback):
 async def start_video_processing(cb: CallbackQuery, state: FSMContext):
     """Начинает обработку видео"""
     data = await state.get_data()
+    session = EditorSession.from_data(data)
     
     # Заменяем фото на текстовое сообщение о процессе
     await cb.message.delete()
     processing_msg = await cb.message.answer("🔄 Обрабатываю видео...")
     await state.set_state(TikTokEditStates.processing)
     
+    temp_dir = None
     try:
-        # Получаем все параметры
-        video_path = data["video_path"]
-        downloader: TikTokDownloader = data["downloader"]
-        settings: Settings = data["settings"]
+        # Получаем все параметры; кодируем из рабочей вырезки, если она готова
+        video_path, start_time = session.encode_input()
+        settings = load_settings(data)
         
-        crop_x = data["crop_x"]
-        crop_y = data["crop_y"]
-        crop_width = data["crop_width"]
-        crop_height = data["crop_height"]
-        start_time = data["start_time"]
-        duration = data["duration"]
+        crop = session.crop
+        duration = session.duration
         
-        # Создаем конвертер
-        converter = Converter()
+        results = get_result_cache()
+        result_key = await sticker_result_key(session, settings)
         
-        # Временный файл для результата
-        temp_dir = tempfile.mkdtemp(prefix="tiktok_result_")
+        # Временный файл для результата; если превью с теми же параметрами
+        # уже закодировало результат, берем его каталог
+        if session.prepared_key == result_key and session.prepared_dir:
+            temp_dir = session.prepared_dir
+        else:
+            temp_dir = get_spool().mkdtemp("tiktok_result_", 2 * STICKER_MAX_BYTES)
         output_path = os.path.join(temp_dir, "result.webm")
         
-        # Формируем команду FFmpeg с кропом и обрезкой по времени
-        ffmpeg_path = converter.ffmpeg
-        
-        cmd = [
-            ffmpeg_path,
-            "-y",
-            "-ss", str(start_time),
-            "-t", str(duration),
-            "-i", video_path,
-            "-vf", f"crop={crop_width}:{crop_height}:{crop_x}:{crop_y},scale={settings.width}:{settings.height}:flags=lanczos",
-            "-r", str(settings.fps),
-        ]
-        
-        if settings.audio:
-            cmd.extend(["-c:a", "libopus", "-b:a", "96k"])
+        cached_path = results.get(result_key)
+        if cached_path:
+            # Тот же отрезок с теми же настройками уже кодировали
+            output_path = cached_path
         else:
-            cmd.append("-an")
-        
-        cmd.extend([
-            "-c:v", settings.codec,
-            "-crf", str(settings.crf),
-            "-b:v", "0",
-            "-pix_fmt", "yuv420p",
-            "-deadline", settings.preset,
-            output_path
-        ])
-        
-        # Запускаем конвертацию
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode != 0:
-            error_text = stderr.decode('utf-8', errors='ignore')
-            await processing_msg.edit_text(f"❌ Ошибка при обработке видео:\n{error_text}")
-            return
+            prepared = os.path.exists(output_path) and os.path.getsize(output_path) <= STICKER_MAX_BYTES
+            if not prepared:
+                # Кодируем сразу под лимит стикера: битрейт считается из длительности.
+                # Однопроходный результат из превью, не уложившийся в лимит,
+                # перекодируется точнее в два прохода
+                try:
+                    await encode_with_status(
+                        processing_msg,
+                        "🔄 Обрабатываю видео...",
+                        cb.message.chat.id,
+                        input_path=video_path,
+                        output_path=output_path,
+                        settings=settings.to_dict(),
+                        duration=duration,
+                        max_bytes=STICKER_MAX_BYTES,
+                        start_time=start_time,
+                        crop=list(crop),
+                        features=await session_features(session),
+                    )
+                except FFmpegError as e:
+                    await processing_msg.edit_text(f"❌ Ошибка при обработке видео:\n{e}")
+                    return
+            if results.enabled and os.path.exists(output_path) and os.path.getsize(output_path) <= STICKER_MAX_BYTES:
+                output_path = results.put(result_key, output_path)
         
         # Проверяем размер файла
         if os.path.exists(output_path):
             file_size = os.path.getsize(output_path)
-            if file_size > 256 * 1024:  # 256 KB
+            if file_size > STICKER_MAX_BYTES:
                 # Сохраняем путь к файлу для повторной обработки
-                await state.update_data(
-                    oversized_file_path=output_path, 
-                    temp_dir_path=temp_dir,
-                    awaiting_compression_choice=True  # Флаг ожидания выбора пользователя
-                )
+                session.oversized_file_path = output_path
+                session.temp_dir_path = temp_dir
+                session.result_key = result_key
+                session.awaiting_compression_choice = True  # Флаг ожидания выбора пользователя
+                await session.save(state)
                 
                 await processing_msg.edit_text(
                     f"⚠️ <b>Файл слишком большой</b>\n\n"
                     f"📦 Размер: {file_size // 1024} KB\n"
-                    f"📏 Лимит: 256 KB\n\n"
+                    f"📏 Лимит: {STICKER_MAX_BYTES // 1024} KB\n\n"
                     f"Что делать?",
                     reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                         [InlineKeyboardButton(text="🗜 Уменьшить объем", callback_data="compress_file")],
@@ -1184,23 +1267,25 @@ async def start_video_processing(cb: CallbackQuery, state: FSMContext):
             # Отправляем результат
             await processing_msg.edit_text("✅ Готово! Отправляю файл...")
             
-            await processing_msg.answer_document(
-                FSInputFile(output_path),
+            await send_document(
+                processing_msg,
+                output_path,
                 caption=f"📱 TikTok видео\n"
                        f"📐 {settings.width}x{settings.height}\n"
                        f"⏱ {duration:.1f}s\n"
                        f"📦 {file_size // 1024} KB"
             )
             
-            # Очистка файлов
+            # Очистка файлов (результат из кеша остается в кеше)
             try:
-                os.remove(output_path)
+                if not results.owns(output_path):
+                    os.remove(output_path)
                 os.rmdir(temp_dir)
             except Exception:
                 pass
             
             # Очищаем все сообщения и возвращаемся в главное меню
-            await cleanup_messages(state, cb.bot)
+            await cleanup_messages(session, cb.bot)
             await return_to_main_menu(state, cb)
             return
         else:
@@ -1210,39 +1295,39 @@ async def start_video_processing(cb: CallbackQuery, state: FSMContext):
         await processing_msg.edit_text(f"❌ Ошибка при обработке: {str(e)}")
     
     finally:
-        # Проверяем, не ожидаем ли мы выбор пользователя по сжатию
+        # Состояние перечитывается: после отправки return_to_main_menu уже
+        # очистил его и показал меню, повторять это не нужно
         data = await state.get_data()
-        if data.get("awaiting_compression_choice"):
+        session = EditorSession.from_data(data)
+        # Каталог результата в spool держит резерв памяти, пока существует:
+        # после ошибки он не нужен, если это не подготовленный каталог сессии
+        # и не файл, ждущий выбора сжатия
+        if temp_dir and temp_dir != session.prepared_dir and not session.awaiting_compression_choice:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        if not data:
+            await cb.answer()
+            return
+        
+        # Проверяем, не ожидаем ли мы выбор пользователя по сжатию
+        if session.awaiting_compression_choice:
             return  # Не очищаем данные, пользователь должен сделать выбор
         
         # Очистка и возврат в главное меню
-        downloader: TikTokDownloader = data.get("downloader")
-        if downloader:
-            downloader.cleanup()
+        release_tiktok_session(session)
         
         # Очищаем сообщение редактора TikTok
-        editor_menu_message_id = data.get("editor_menu_message_id")
-        editor_menu_chat_id = data.get("editor_menu_chat_id")
-        if editor_menu_message_id and editor_menu_chat_id:
-            try:
-                await processing_msg.bot.delete_message(editor_menu_chat_id, editor_menu_message_id)
-            except Exception:
-                pass
+        await delete_editor_menu(session, processing_msg.bot)
         
         # Очищаем все служебные сообщения
-        await cleanup_messages(state, processing_msg.bot)
+        await cleanup_messages(session, processing_msg.bot)
         
-        settings = data.get("settings")
+        settings = load_settings(data)
         if settings:
-            new_menu = await processing_msg.answer(
+            await processing_msg.answer(
                 format_main_menu_text(settings),
                 reply_markup=main_menu(),
                 parse_mode="HTML"
             )
-            await state.update_data(
-                menu_message_id=new_menu.message_id,
-                chat_id=new_menu.chat.id
-            )
         
         await state.clear()
         await cb.answer()
\ No newline at end of file
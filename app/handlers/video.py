@@ -1,19 +1,44 @@
 import os
 import asyncio
+import mimetypes
+import shutil
 import tempfile
+from typing import Dict
 
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 
 from app.config import Config
 from app.keyboards.inline import main_menu, back_menu, cancel_menu
-from app.models import Settings
-from app.services.converter import Converter, FFmpegError
+from app.models import Settings, load_settings
+from app.services.converter import FFmpegError
+from app.services.ingest import partial_path, wait_streamable
+from app.services.file_ids import send_document
+from app.services.jobs import Job, get_job_queue, new_job_id
+from app.services.progress import StatusReporter
+from app.services.results import get_result_cache, job_key
 from app.handlers.start import format_main_menu_text
 
 router = Router()
 
+# Конвертации, задание которых еще не поставлено в очередь (файл загружается):
+# отменить их через очередь нельзя, поэтому отменяется сама задача
+_pending: Dict[str, asyncio.Task] = {}
+
+
+async def download_growing(bot, file, path: str) -> None:
+    """Скачивает файл Telegram в path + .part и переименовывает в path в конце;
+    недокачанный .part удаляется, чтобы читающий его ffmpeg остановился"""
+    part = partial_path(path)
+    try:
+        await bot.download(file, part)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    os.replace(part, path)
+
 
 @router.callback_query(F.data == "convert")
 async def open_convert(cb: CallbackQuery, state: FSMContext):
@@ -35,16 +60,17 @@ async def handle_video(message: Message, state: FSMContext):
 
     bot = message.bot
     with tempfile.TemporaryDirectory(prefix="dl_") as td:
-        name = getattr(file, "file_name", None) or "video.bin"
+        name = getattr(file, "file_name", None) or "video" + (mimetypes.guess_extension(file.mime_type or "") or ".bin")
         in_path = os.path.join(td, name)
-        await bot.download(file, in_path)
+        # Скачиваем в растущий .part: кодирование может начаться до конца загрузки
+        download = asyncio.create_task(download_growing(bot, file, in_path))
 
         data = await state.get_data()
-        settings: Settings = data.get("settings")
+        cfg = Config.load()
+        settings = load_settings(data)
         if not settings:
-            settings = Settings.from_defaults(Config.load().defaults)
+            settings = Settings.from_defaults(cfg.defaults)
 
-        data = await state.get_data()
         menu_msg_id = data.get("menu_message_id")
         chat_id = data.get("chat_id") or message.chat.id
         
@@ -61,38 +87,57 @@ async def handle_video(message: Message, state: FSMContext):
                 except Exception:
                     continue
 
-        conv = Converter()
         status = await message.answer("Конвертирую…", reply_markup=cancel_menu())
-        loading_frames = [
-            "Конвертирую ⠋",
-            "Конвертирую ⠙",
-            "Конвертирую ⠹",
-            "Конвертирую ⠸",
-            "Конвертирую ⠼",
-            "Конвертирую ⠴",
-            "Конвертирую ⠦",
-            "Конвертирую ⠧",
-            "Конвертирую ⠇",
-            "Конвертирую ⠏",
-        ]
+        reporter = StatusReporter(status, "Конвертирую…", reply_markup=cancel_menu())
 
-        async def run_convert():
-            return await conv.convert(in_path, settings)
+        results = get_result_cache()
+        # file_unique_id — id содержимого у Telegram: повтор берется из кеша без загрузки
+        key = job_key(f"telegram-{file.file_unique_id}", settings, kind="convert")
+
+        job_id = new_job_id()
 
-        async def animate_loading(task):
-            i = 0
+        async def encode(out_dir: str) -> str:
+            # Контейнер, которому нужна перемотка (MP4 с moov в конце), кодируется после загрузки
+            ext = os.path.splitext(name)[1].lstrip(".").lower()
             try:
-                while not task.done():
-                    await status.edit_text(loading_frames[i % len(loading_frames)])
-                    i += 1
-                    await asyncio.sleep(0.4)
-            except Exception:
-                pass
+                follow = await wait_streamable(in_path, ext, download)
+                if not follow:
+                    await download
+            except Exception as e:
+                raise FFmpegError(f"Не удалось загрузить файл: {e}")
+            # Дальше задание отменяется через очередь
+            _pending.pop(job_id, None)
+            job = Job(
+                "convert",
+                message.chat.id,
+                {
+                    "input_path": in_path,
+                    "settings": settings.to_dict(),
+                    "out_dir": out_dir,
+                    "follow": follow,
+                    # Больше лимита Telegram файл все равно не отправить: обрываем сразу
+                    "max_bytes": cfg.upload_max_bytes,
+                },
+                id=job_id,
+            )
+            result = await get_job_queue().run(job, on_position=reporter.on_position, progress=reporter.stream)
+            return result["path"]
+
+        async def run_convert():
+            try:
+                # Повторное задание с тем же входом и настройками берется из кеша
+                return await results.get_or_create(key, encode, expected_bytes=cfg.upload_max_bytes)
+            except asyncio.CancelledError:
+                # Отмена кнопкой до постановки задания в очередь
+                raise FFmpegError("Конвертация отменена")
+            finally:
+                reporter.stream.close()
 
         convert_task = asyncio.create_task(run_convert())
-        anim_task = asyncio.create_task(animate_loading(convert_task))
+        _pending[job_id] = convert_task
+        report_task = asyncio.create_task(reporter.run())
         await state.update_data(
-            convert_task=convert_task,
+            convert_job_id=job_id,
             status_message_id=status.message_id,
             status_chat_id=message.chat.id,
         )
@@ -103,42 +148,42 @@ async def handle_video(message: Message, state: FSMContext):
                 await status.edit_text(str(e))
             except Exception:
                 pass
-            try:
-                anim_task.cancel()
-            except Exception:
-                pass
             new_menu = await message.answer(format_main_menu_text(settings), reply_markup=main_menu(), parse_mode="HTML")
-            await state.update_data(menu_message_id=new_menu.message_id, chat_id=new_menu.chat.id, convert_task=None)
+            await state.update_data(menu_message_id=new_menu.message_id, chat_id=new_menu.chat.id, convert_job_id=None)
             return
         finally:
-            try:
-                anim_task.cancel()
-            except Exception:
-                pass
+            _pending.pop(job_id, None)
+            report_task.cancel()
+            # Результат из кеша или ошибка кодирования: загрузка больше не нужна
+            download.cancel()
+            await asyncio.gather(download, return_exceptions=True)
 
         await status.edit_text("Готово! Отправляю файл…")
-        await message.answer_document(
-            FSInputFile(out_path), caption=f"{settings.width}x{settings.height} {settings.fps}fps webm"
-        )
         try:
-            os.remove(out_path)
-        except Exception:
-            pass
+            await send_document(message, out_path, caption=f"{settings.width}x{settings.height} {settings.fps}fps webm")
+        finally:
+            if not results.owns(out_path):
+                shutil.rmtree(os.path.dirname(out_path), ignore_errors=True)
         await status.delete()
 
         new_menu = await message.answer(format_main_menu_text(settings), reply_markup=main_menu(), parse_mode="HTML")
-        await state.update_data(menu_message_id=new_menu.message_id, chat_id=new_menu.chat.id, convert_task=None)
+        await state.update_data(menu_message_id=new_menu.message_id, chat_id=new_menu.chat.id, convert_job_id=None)
 
 
 @router.callback_query(F.data == "cancel_convert")
 async def cancel_convert(cb: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    task: asyncio.Task | None = data.get("convert_task")
-    if task and not task.done():
-        task.cancel()
+    job_id = data.get("convert_job_id")
+    pending = _pending.pop(job_id, None) if job_id else None
+    if pending is not None:
+        # Файл еще загружается, задания в очереди нет
+        pending.cancel()
+    elif job_id:
+        # Задание может выполняться в другом процессе: отмена идет через очередь
+        await get_job_queue().cancel(job_id)
     try:
         await cb.message.edit_text("Отмена…")
     except Exception:
         pass
     await cb.answer("Конвертация отменена")
-    await state.update_data(convert_task=None)
+    await state.update_data(convert_job_id=None)
@@ -1,4 +1,9 @@
-from dataclasses import dataclass
+from copy import deepcopy
+from dataclasses import asdict, dataclass, field
+from dataclasses import fields as dataclass_fields
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.services.metrics import metrics
 
 
 @dataclass
@@ -22,3 +27,136 @@ class Settings:
             crf=d.crf,
             preset=d.preset,
         )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @staticmethod
+    def from_dict(d: Dict[str, Any]) -> "Settings":
+        return Settings(**d)
+
+
+def load_settings(data: Dict[str, Any]) -> Optional[Settings]:
+    """Настройки из данных FSM: там они лежат словарем, чтобы хранилище могло их сериализовать"""
+    raw = data.get("settings")
+    return Settings.from_dict(raw) if raw else None
+
+
+# Поля сессии редактора лежат в FSM плоскими ключами с этим префиксом:
+# сохранение дописывает только изменившиеся ключи и не затирает чужие
+SESSION_PREFIX = "editor:"
+SESSION_VERSION = 1
+# Ключи, в которых сессия хранилась до появления EditorSession (версия 0)
+_LEGACY_KEYS = {
+    "pending_tiktok_url": "pending_url",
+    "video_path": "video_path",
+    "downloader": "downloader",
+    "video_info": "video_info",
+    "crop_x": "crop_x",
+    "crop_y": "crop_y",
+    "crop_width": "crop_width",
+    "crop_height": "crop_height",
+    "start_time": "start_time",
+    "duration": "duration",
+    "cleanup_messages": "cleanup_messages",
+    "editor_menu_message_id": "editor_menu_message_id",
+    "editor_menu_chat_id": "editor_menu_chat_id",
+    "oversized_file_path": "oversized_file_path",
+    "temp_dir_path": "temp_dir_path",
+    "result_key": "result_key",
+    "awaiting_compression_choice": "awaiting_compression_choice",
+}
+
+
+@dataclass
+class EditorSession:
+    """Состояние TikTok редактора одного чата.
+
+    Загружается из FSM один раз на обновление и сохраняется одним
+    update_data, в который попадают только изменившиеся поля.
+    """
+    pending_url: Optional[str] = None
+    video_path: Optional[str] = None
+    downloader: Optional[Dict[str, Any]] = None
+    video_info: Dict[str, Any] = field(default_factory=dict)
+    crop_x: int = 0
+    crop_y: int = 0
+    crop_width: int = 0
+    crop_height: int = 0
+    start_time: float = 0.0
+    duration: float = 0.0
+    cleanup_messages: List[Dict[str, int]] = field(default_factory=list)
+    editor_menu_message_id: Optional[int] = None
+    editor_menu_chat_id: Optional[int] = None
+    oversized_file_path: Optional[str] = None
+    temp_dir_path: Optional[str] = None
+    result_key: Optional[str] = None
+    awaiting_compression_choice: bool = False
+    # Итоговый webm, закодированный вместе с превью, и ключ его параметров
+    prepared_key: Optional[str] = None
+    prepared_dir: Optional[str] = None
+    # Рабочая вырезка выбранного отрезка (см. cut_working_copy) и ее положение в исходнике
+    working_dir: Optional[str] = None
+    working_path: Optional[str] = None
+    working_start: float = 0.0
+    working_end: float = 0.0
+    _saved: Dict[str, Any] = field(default_factory=dict, repr=False, compare=False)
+
+    @property
+    def crop(self) -> Tuple[int, int, int, int]:
+        return self.crop_x, self.crop_y, self.crop_width, self.crop_height
+
+    @property
+    def total_duration(self) -> float:
+        return self.video_info.get("duration", 0.0)
+
+    def encode_input(self) -> Tuple[str, float]:
+        """Файл и время начала для кодирования выбранного отрезка: рабочая
+        вырезка, если она покрывает отрезок, иначе исходное видео"""
+        end = self.start_time + self.duration
+        if self.working_path and self.working_start <= self.start_time and end <= self.working_end + 1e-3:
+            return self.working_path, round(self.start_time - self.working_start, 3)
+        return self.video_path, self.start_time
+
+    def to_dict(self) -> Dict[str, Any]:
+        fields_ = {f.name: getattr(self, f.name) for f in dataclass_fields(self) if f.name != "_saved"}
+        return {SESSION_PREFIX + "v": SESSION_VERSION, **{SESSION_PREFIX + k: v for k, v in fields_.items()}}
+
+    @classmethod
+    def from_data(cls, data: Dict[str, Any]) -> "EditorSession":
+        version = data.get(SESSION_PREFIX + "v", 0)
+        if version == 0:
+            raw = {name: data[key] for key, name in _LEGACY_KEYS.items() if key in data}
+        elif version == SESSION_VERSION:
+            raw = {k[len(SESSION_PREFIX):]: v for k, v in data.items() if k.startswith(SESSION_PREFIX)}
+            raw.pop("v", None)
+        else:
+            # Сессия от несовместимой версии бота: начинаем заново
+            raw = {}
+        known = {f.name for f in dataclass_fields(cls)} - {"_saved"}
+        session = cls(**{k: v for k, v in raw.items() if k in known})
+        if version == SESSION_VERSION:
+            session._saved = deepcopy(session.to_dict())
+        return session
+
+    @classmethod
+    async def load(cls, state) -> "EditorSession":
+        return cls.from_data(await state.get_data())
+
+    def changes(self) -> Dict[str, Any]:
+        """Ключи FSM, отличающиеся от последнего загруженного или сохраненного состояния"""
+        return {k: v for k, v in self.to_dict().items() if self._saved.get(k, _MISSING) != v}
+
+    async def save(self, state, **extra: Any) -> None:
+        """Записывает изменения сессии и extra (прочие ключи FSM) одним вызовом"""
+        changed = self.changes()
+        if not changed and not extra:
+            metrics.inc("session.unchanged")
+            return
+        await state.update_data(**deepcopy(changed), **extra)
+        self._saved.update(deepcopy(changed))
+        metrics.inc("session.saves")
+        metrics.inc("session.fields_written", len(changed))
+
+
+_MISSING = object()
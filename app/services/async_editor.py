@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.services.predictor import EncodeFeatures
+from app.services.tiktok import PROXY_FPS, VideoEditor, WorkingCopy, encode_proxy
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_editor_executor() -> ThreadPoolExecutor:
+    """Отдельный пул потоков для OpenCV, чтобы не занимать пул по умолчанию"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="editor")
+    return _executor
+
+
+def configure_editor_executor(workers: int) -> ThreadPoolExecutor:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="editor")
+    return _executor
+
+
+async def _in_pool(fn: Callable, *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(get_editor_executor(), partial(fn, *args))
+
+
+class AsyncVideoEditor:
+    """Асинхронная обертка над VideoEditor.
+
+    Декодирование и рендеринг выполняются в пуле потоков, а вызовы одной
+    сессии идут строго по очереди: cv2.VideoCapture нельзя трогать из двух
+    потоков сразу. Легкие атрибуты (width, duration, ...) читаются напрямую.
+    """
+
+    def __init__(self, editor: VideoEditor):
+        self.editor = editor
+        self._lock = asyncio.Lock()
+        self._proxy_dir: Optional[str] = None
+        self._proxy_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @classmethod
+    async def open(cls, video_path: str) -> "AsyncVideoEditor":
+        return cls(await _in_pool(VideoEditor, video_path))
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "editor":
+            raise AttributeError(name)
+        return getattr(self.editor, name)
+
+    async def _call(self, fn: Callable, *args: Any) -> Any:
+        async with self._lock:
+            return await _in_pool(fn, *args)
+
+    async def create_crop_preview(
+        self, crop_x: int, crop_y: int, crop_width: int, crop_height: int, time_seconds: float = 0
+    ) -> Optional[bytes]:
+        return await self._call(self.editor.create_crop_preview, crop_x, crop_y, crop_width, crop_height, time_seconds)
+
+    async def create_time_preview(
+        self, start_time: float, duration: float, crop_params: Tuple[int, int, int, int]
+    ) -> Optional[bytes]:
+        return await self._call(self.editor.create_time_preview, start_time, duration, crop_params)
+
+    async def get_frame_at_time(self, time_seconds: float) -> Optional[bytes]:
+        return await self._call(self.editor.get_frame_at_time, time_seconds)
+
+    async def probe_content(
+        self, start_time: float, duration: float, crop_params: Optional[Tuple[int, int, int, int]] = None
+    ) -> EncodeFeatures:
+        return await self._call(self.editor.probe_content, start_time, duration, crop_params)
+
+    async def attach_window(self, working_copy: WorkingCopy) -> None:
+        await self._call(self.editor.attach_window, working_copy)
+
+    def start_proxy(self, proxy_path: Optional[str] = None) -> None:
+        """Фоном строит уменьшенную копию видео и по ней ленту миниатюр;
+        до их готовности превью берут кадры из исходника.
+
+        Готовую прокси (например, построенную во время загрузки) редактор
+        забирает вместе с ее каталогом.
+        """
+        if self._proxy_task is not None:
+            if proxy_path:
+                shutil.rmtree(os.path.dirname(proxy_path), ignore_errors=True)
+            return
+        if proxy_path:
+            self._proxy_dir = os.path.dirname(proxy_path)
+        else:
+            self._proxy_dir = tempfile.mkdtemp(prefix="editor_proxy_")
+        self._proxy_task = asyncio.create_task(self._build_proxy(proxy_path))
+
+    async def _build_proxy(self, path: Optional[str] = None) -> None:
+        try:
+            if path is None:
+                path = await encode_proxy(
+                    self.editor.video_path, os.path.join(self._proxy_dir, "proxy.avi"), fps=PROXY_FPS
+                )
+            await self._call(self.editor.attach_proxy, path)
+            # Лента читает прокси своим VideoCapture, поэтому идет без блокировки
+            await _in_pool(self.editor.build_strip)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Битая прокси или каталог, удаленный close(): превью остаются на исходнике
+            if not self._closed:
+                logger.warning("Не удалось построить прокси для %s: %s", self.editor.video_path, e)
+
+    def close(self) -> None:
+        """Останавливает построение прокси и удаляет ее файлы"""
+        self._closed = True
+        if self._proxy_task is not None:
+            self._proxy_task.cancel()
+        if self._proxy_dir:
+            shutil.rmtree(self._proxy_dir, ignore_errors=True)
+
+
+# Сколько редакторов держать открытыми в одном процессе
+MAX_OPEN_EDITORS = 32
+
+_editors: "OrderedDict[str, AsyncVideoEditor]" = OrderedDict()
+_opening: Dict[str, asyncio.Lock] = {}
+
+
+async def open_session_editor(
+    video_path: str, proxy_path: Optional[str] = None, build_proxy: bool = True
+) -> AsyncVideoEditor:
+    """Редактор для сессии по пути к видео.
+
+    В FSM лежит только путь, а открытый VideoEditor живет в памяти процесса.
+    Если сессию продолжает другой процесс или бот перезапустился, редактор
+    открывается заново по тому же пути. proxy_path — готовая прокси,
+    которую редактор забирает себе (лишняя удаляется). Без build_proxy
+    прокси не строится: редактор нужен только тому, что уже в нем есть
+    (например, оценке сложности перед итоговым кодированием).
+    """
+    editor = _editors.get(video_path)
+    if editor is not None:
+        _editors.move_to_end(video_path)
+        if build_proxy:
+            editor.start_proxy(proxy_path)
+        return editor
+    lock = _opening.setdefault(video_path, asyncio.Lock())
+    async with lock:
+        editor = _editors.get(video_path)
+        if editor is None:
+            editor = await AsyncVideoEditor.open(video_path)
+            _editors[video_path] = editor
+            while len(_editors) > MAX_OPEN_EDITORS:
+                _editors.popitem(last=False)[1].close()
+        if build_proxy:
+            editor.start_proxy(proxy_path)
+    _opening.pop(video_path, None)
+    return editor
+
+
+def close_session_editor(video_path: Optional[str]) -> None:
+    editor = _editors.pop(video_path, None) if video_path else None
+    if editor is not None:
+        editor.close()
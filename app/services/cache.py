@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from app.services.metrics import metrics
+from app.services.spool import get_spool
+
+# Производитель записи: получает пустой каталог на той же ФС и возвращает путь к файлу в нем
+Producer = Callable[[str], Awaitable[str]]
+
+
+class _Entry:
+    __slots__ = ("path", "size", "mtime", "created")
+
+    def __init__(self, path: Path, size: int, mtime: float, created: float):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.created = created
+
+
+# Хеши содержимого файлов: (путь, размер, mtime) -> sha256, последние MAX_DIGESTS
+MAX_DIGESTS = 1024
+
+_digests: "OrderedDict[Tuple[str, int, float], str]" = OrderedDict()
+
+
+async def file_digest(path: str) -> str:
+    """sha256 содержимого файла; считается в потоке и запоминается"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    digest = _digests.get(key)
+    if digest is not None:
+        _digests.move_to_end(key)
+    else:
+        def compute() -> str:
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            return h.hexdigest()
+
+        digest = await asyncio.get_running_loop().run_in_executor(None, compute)
+        _digests[key] = digest
+        while len(_digests) > MAX_DIGESTS:
+            _digests.popitem(last=False)
+    return digest
+
+
+class DiskCache:
+    """LRU кеш файлов на диске с ограничением по размеру и времени жизни.
+
+    Каждая запись — каталог с одним файлом, имя каталога — хеш ключа.
+    Запись сначала собирается во временном каталоге внутри корня и затем
+    атомарно переименовывается, поэтому читатели никогда не видят
+    недописанный файл. Одновременные запросы одного ключа разделяют
+    одно вычисление.
+    """
+
+    def __init__(
+        self, root: str, max_bytes: int, name: str = "cache", ttl: Optional[float] = None, spool: bool = False
+    ):
+        self.root = Path(root)
+        # Без кеша producer получает каталог из spool (tmpfs), а не с диска
+        self.spool = spool
+        self.max_bytes = max_bytes
+        self.name = name
+        self.ttl = ttl
+        self._staging = self.root / ".tmp"
+        self._index: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._pins: Dict[str, int] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(e.size for e in self._index.values())
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+    def _load(self) -> None:
+        """Восстанавливает индекс после перезапуска"""
+        if not self.enabled:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        shutil.rmtree(self._staging, ignore_errors=True)
+        self._staging.mkdir(exist_ok=True)
+        entries = []
+        for entry_dir in self.root.iterdir():
+            if not entry_dir.is_dir() or entry_dir == self._staging:
+                continue
+            files = [f for f in entry_dir.iterdir() if f.is_file()]
+            if not files:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            stat = files[0].stat()
+            created = entry_dir.stat().st_mtime
+            entries.append((stat.st_mtime, entry_dir.name, _Entry(files[0], stat.st_size, stat.st_mtime, created)))
+        for _, digest, entry in sorted(entries):
+            self._index[digest] = entry
+        self._evict()
+
+    def _expired(self, entry: _Entry) -> bool:
+        return self.ttl is not None and time.time() - entry.created > self.ttl
+
+    def _lookup(self, key: str) -> Optional[_Entry]:
+        digest = self._digest(key)
+        entry = self._index.get(digest)
+        if entry is None:
+            return None
+        if not entry.path.exists():
+            self._index.pop(digest, None)
+            return None
+        if self._expired(entry) and not self._pins.get(digest):
+            self._index.pop(digest, None)
+            shutil.rmtree(entry.path.parent, ignore_errors=True)
+            metrics.inc(f"{self.name}.expired")
+            return None
+        self._index.move_to_end(digest)
+        entry.mtime = time.time()
+        try:
+            os.utime(entry.path, (entry.mtime, entry.mtime))
+        except OSError:
+            pass
+        return entry
+
+    def _hit(self, entry: _Entry) -> str:
+        metrics.inc(f"{self.name}.hits")
+        metrics.inc(f"{self.name}.bytes_saved", entry.size)
+        return str(entry.path)
+
+    def get(self, key: str) -> Optional[str]:
+        """Путь к файлу из кеша или None; обращение продлевает жизнь записи"""
+        if not self.enabled:
+            return None
+        entry = self._lookup(key)
+        if entry is None:
+            metrics.inc(f"{self.name}.misses")
+            return None
+        return self._hit(entry)
+
+    def put(self, key: str, src_path: str) -> str:
+        """Переносит файл в кеш и возвращает его новый путь"""
+        digest = self._digest(key)
+        final_dir = self.root / digest
+        staged = Path(tempfile.mkdtemp(dir=self._staging))
+        target = staged / Path(src_path).name
+        shutil.move(src_path, target)
+        old = self._index.pop(digest, None)
+        if old is not None:
+            shutil.rmtree(old.path.parent, ignore_errors=True)
+        os.replace(staged, final_dir)
+        path = final_dir / target.name
+        now = time.time()
+        self._index[digest] = _Entry(path, path.stat().st_size, now, now)
+        self._evict()
+        return str(path)
+
+    async def get_or_create(self, key: str, producer: Producer, expected_bytes: int = 0) -> str:
+        """Возвращает файл из кеша или создает его ровно одним вызовом producer.
+
+        Если кеш выключен, producer получает обычный временный каталог
+        (или каталог из spool с резервом expected_bytes), и удалять
+        результат должен вызывающий.
+        """
+        if not self.enabled:
+            if self.spool:
+                return await producer(get_spool().mkdtemp(f"{self.name}_", expected_bytes))
+            return await producer(tempfile.mkdtemp(prefix=f"{self.name}_"))
+        while True:
+            entry = self._lookup(key)
+            if entry is not None:
+                return self._hit(entry)
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            try:
+                await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Отменили того, кто создавал запись, а не нас — пробуем сами
+                if inflight.cancelled():
+                    continue
+                raise
+            metrics.inc(f"{self.name}.shared")
+
+        metrics.inc(f"{self.name}.misses")
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        staging = tempfile.mkdtemp(dir=self._staging)
+        try:
+            path = self.put(key, await producer(staging))
+            future.set_result(path)
+            return path
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже передано вызывающему; помечаем его полученным
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def owns(self, path: str) -> bool:
+        """Лежит ли файл в кеше (такой файл нельзя удалять вручную)"""
+        if not self.enabled:
+            return False
+        try:
+            Path(path).resolve().relative_to(self.root.resolve())
+        except ValueError:
+            return False
+        return True
+
+    def pin(self, key: str) -> None:
+        """Защищает запись от вытеснения, пока она используется"""
+        digest = self._digest(key)
+        self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, key: str) -> None:
+        digest = self._digest(key)
+        count = self._pins.get(digest, 0) - 1
+        if count > 0:
+            self._pins[digest] = count
+        else:
+            self._pins.pop(digest, None)
+        self._evict()
+
+    def _evict(self) -> None:
+        total = self.total_bytes
+        for digest in list(self._index):
+            if self._pins.get(digest):
+                continue
+            if total <= self.max_bytes and not self._expired(self._index[digest]):
+                continue
+            entry = self._index.pop(digest)
+            shutil.rmtree(entry.path.parent, ignore_errors=True)
+            total -= entry.size
+            metrics.inc(f"{self.name}.evictions")
+        metrics.set(f"{self.name}.bytes", total)
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from app.services.metrics import metrics
+
+Offset = Tuple[float, ...]
+Commit = Callable[[Offset], Awaitable[Any]]
+Render = Callable[[Any], Awaitable[None]]
+
+
+class _Session:
+    __slots__ = ("offset", "commit", "render", "task", "last_push", "lock")
+
+    def __init__(self):
+        self.offset: Optional[Offset] = None
+        self.commit: Optional[Commit] = None
+        self.render: Optional[Render] = None
+        self.task: Optional[asyncio.Task] = None
+        self.last_push = 0.0
+        self.lock = asyncio.Lock()
+
+
+class PressCoalescer:
+    """Склеивает быстрые нажатия кнопок одной сессии редактора.
+
+    Смещения нажатий, пришедших в пределах окна, суммируются в одно.
+    commit применяет суммарное смещение к состоянию и не прерывается,
+    render рисует и отправляет превью и отменяется, если пришло новое
+    нажатие: показывать имеет смысл только последнее состояние.
+    Первое нажатие после паузы обрабатывается сразу.
+    """
+
+    def __init__(self, window: float = 0.3):
+        self.window = window
+        self._sessions: Dict[Hashable, _Session] = {}
+
+    def push(self, key: Hashable, offset: Offset, commit: Commit, render: Render) -> None:
+        session = self._sessions.setdefault(key, _Session())
+        if session.offset is None:
+            session.offset = offset
+        else:
+            session.offset = tuple(a + b for a, b in zip(session.offset, offset))
+            metrics.inc("coalesce.merged")
+        session.commit = commit
+        session.render = render
+
+        now = time.monotonic()
+        delay = self.window if now - session.last_push < self.window else 0.0
+        session.last_push = now
+        if session.task and not session.task.done():
+            # Ожидающий таймер или устаревший рендер больше не нужны
+            session.task.cancel()
+            metrics.inc("coalesce.cancelled")
+        session.task = asyncio.create_task(self._run(key, session, delay))
+
+    async def _commit(self, session: _Session) -> Any:
+        async with session.lock:
+            offset, session.offset = session.offset, None
+            if offset is None or session.commit is None:
+                return None
+            return await session.commit(offset)
+
+    async def _run(self, key: Hashable, session: _Session, delay: float) -> None:
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            # Применение смещения доводим до конца даже при отмене
+            snapshot = await asyncio.shield(self._commit(session))
+            if snapshot is not None and session.render:
+                await session.render(snapshot)
+                metrics.inc("coalesce.renders")
+        finally:
+            if self._sessions.get(key) is session and session.offset is None and session.task is asyncio.current_task():
+                del self._sessions[key]
+
+    async def flush(self, key: Hashable) -> None:
+        """Сразу применяет накопленное смещение без рендера (перед сменой экрана)"""
+        session = self._sessions.get(key)
+        if session is None:
+            return
+        if session.task and not session.task.done():
+            session.task.cancel()
+        await self._commit(session)
+        self._sessions.pop(key, None)
@@ -1,25 +1,121 @@
 import asyncio
+import logging
 import os
 import shutil
-import tempfile
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple
 
 from app.models import Settings
+from app.services.encoders import (
+    PRESET_GOOD,
+    PRESET_REALTIME,
+    PRESETS,
+    EncoderBackend,
+    get_encoder_registry,
+    useful_threads,
+)
+from app.services.ingest import IngestError, follow_file
+from app.services.metrics import metrics
+from app.services.predictor import EncodeFeatures, EncodeRecord, get_predictor
+from app.services.progress import ProgressParser, ProgressStream, parse_duration
+from app.services.scheduler import PositionCallback, Priority, get_scheduler
+from app.services.spool import get_spool
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram на размер видеостикера
+STICKER_MAX_BYTES = 256 * 1024
+# Доля байтового бюджета, которую отдаем потокам; остальное — контейнер и погрешность
+SIZE_MARGIN = 0.92
+MIN_VIDEO_BITRATE = 30_000
+AUDIO_BITRATE = 64_000
+# Доля первого (анализирующего) прохода в общем прогрессе
+PASS1_SHARE = 0.3
+# Период отчетов -progress (с), когда по ним проверяется размер выхода
+GUARD_STATS_PERIOD = 0.1
+# WebM копит кластер до 5 с, и total_size растет скачками; с мелкими
+# кластерами размер виден почти сразу (ценой нескольких байт на кластер)
+GUARD_MUXER_ARGS = ["-cluster_time_limit", "250"]
+# Обрыв по прогнозу: размер экстраполируется по байтам на секунду медиа.
+# Первые кадры (ключевой) дороже среднего, поэтому прогнозу верим только
+# после GUARD_MIN_FRACTION длительности и только при явном перелете
+GUARD_MIN_FRACTION = 0.3
+GUARD_OVERSHOOT = 1.2
+# Попыток encode_to_size: все, кроме последней, обрываются по размеру
+SIZE_ATTEMPTS = 3
+# Подстройка под сложность отрезка: бит на пиксель кадра, которых хватает
+# отрезку средней сложности (простому — вдвое меньше, сложному — в 1.5 раза
+# больше). Если бюджета не хватает, снижается частота кадров, если его с
+# запасом вдвое — CRF (битрейт все равно ограничивает размер)
+BITS_PER_PIXEL = 0.05
+MIN_TUNED_FPS = 15
+SIMPLE_CRF_STEP = 4
+MIN_CRF = 10
 
 
 class FFmpegError(Exception):
     pass
 
 
+class OutputTooLarge(FFmpegError):
+    """ffmpeg остановлен: выход превысил байтовый бюджет, не дойдя до конца"""
+
+    def __init__(self, max_bytes: int, size: int, out_time: float):
+        super().__init__(f"Результат больше {max_bytes / (1024 * 1024):.1f} МБ")
+        self.max_bytes = max_bytes
+        self.size = size
+        self.out_time = out_time
+
+    def projected_size(self, duration: float) -> int:
+        """Размер, который получился бы к концу, если битрейт не изменится"""
+        return projected_size(self.size, self.out_time, duration)
+
+
+def projected_size(size: int, out_time: float, duration: Optional[float]) -> int:
+    """Итоговый размер при том же числе байт на секунду медиа"""
+    if out_time <= 0 or not duration:
+        return size
+    return int(size * max(1.0, duration / out_time))
+
+
+@dataclass
+class Output:
+    """Один выход многовыходного кодирования: своя цепочка фильтров после
+    общего кропа и свои параметры кодирования"""
+    path: str
+    filters: str
+    args: List[str]
+    audio: bool = False
+    # Запись для истории кодирований: размер дописывается после кодирования
+    record: Optional[EncodeRecord] = None
+
+
+def find_ffprobe() -> Optional[str]:
+    """Путь к ffprobe: FFPROBE_PATH, рядом с ffmpeg или в PATH"""
+    env_path = os.getenv("FFPROBE_PATH")
+    if env_path:
+        return env_path if os.path.exists(env_path) else None
+    ffmpeg = os.getenv("FFMPEG_PATH")
+    if ffmpeg and os.path.sep in ffmpeg:
+        sibling = os.path.join(os.path.dirname(ffmpeg), "ffprobe")
+        if os.path.exists(sibling):
+            return sibling
+    return shutil.which("ffprobe")
+
+
 class Converter:
     def __init__(self, ffmpeg_path: Optional[str] = None):
         self.ffmpeg = ffmpeg_path or os.getenv("FFMPEG_PATH") or "ffmpeg"
         self._proc: Optional[asyncio.subprocess.Process] = None
 
-    async def convert(self, input_path: str, settings: Settings) -> str:
-        out_dir = tempfile.mkdtemp(prefix="conv_")
-        out_path = str(Path(out_dir) / "output.webm")
+    @staticmethod
+    def backend(settings: Settings) -> EncoderBackend:
+        """Энкодер для настроек: самый быстрый доступный в нужном семействе"""
+        return get_encoder_registry().select(settings.codec)
+
+    def resolve(self) -> str:
+        """Возвращает путь к исполняемому ffmpeg"""
         exec_path: Optional[str]
         if os.path.isabs(self.ffmpeg) or os.path.sep in self.ffmpeg:
             exec_path = self.ffmpeg if os.path.exists(self.ffmpeg) else None
@@ -27,12 +123,167 @@ class Converter:
             exec_path = shutil.which(self.ffmpeg)
         if not exec_path:
             raise FFmpegError("ffmpeg не найден. Установите ffmpeg и добавьте его в PATH или задайте FFMPEG_PATH.")
+        return exec_path
+
+    async def run(
+        self,
+        args: List[str],
+        user_id: int = 0,
+        priority: Priority = Priority.ENCODE,
+        on_position: Optional[PositionCallback] = None,
+        progress: Optional[ProgressStream] = None,
+        progress_span: Tuple[float, float] = (0.0, 1.0),
+        duration: Optional[float] = None,
+        max_threads: Optional[int] = None,
+        output_paths: Optional[List[str]] = None,
+        stdin_path: Optional[str] = None,
+        max_output_bytes: Optional[int] = None,
+    ) -> bytes:
+        """Запускает ffmpeg через общий планировщик и возвращает stderr.
+
+        С progress ffmpeg пишет -progress в stdout, строки разбираются по
+        мере поступления, а доля выполнения отображается в отрезок
+        progress_span (для многопроходных заданий). С max_threads энкодер
+        получает -threads из бюджета планировщика на момент старта, но не
+        больше max_threads. Флаг ставится перед каждым из output_paths (бюджет
+        делится между ними), по умолчанию — перед последним аргументом. Со stdin_path в stdin ffmpeg
+        (вход pipe:0) идет файл, который еще загружается (см. ingest.follow_file).
+        С max_output_bytes ffmpeg останавливается, как только выход его
+        превысил или прогноз итогового размера по duration (без него — по
+        длительности входа) явно его перелетает, и поднимается OutputTooLarge.
+        """
+        cmd = [self.resolve()]
+        if progress is not None or max_output_bytes:
+            cmd += ["-progress", "pipe:1", "-nostats"]
+        if max_output_bytes:
+            # Размер проверяется по -progress: чем чаще отчет, тем раньше обрыв
+            cmd += ["-stats_period", str(GUARD_STATS_PERIOD)]
+        scheduler = get_scheduler()
+        try:
+            async with scheduler.slot(user_id, priority, on_position):
+                if max_threads:
+                    outputs = set(output_paths or args[-1:])
+                    # Бюджет задания делится между энкодерами всех его выходов
+                    threads = max(1, min(max_threads, scheduler.thread_budget() // len(outputs)))
+                    flag = ["-threads", str(threads)]
+                    for arg in args:
+                        cmd += flag + [arg] if arg in outputs else [arg]
+                else:
+                    cmd += args
+                self._proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.PIPE if stdin_path else None,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                proc = self._proc
+                stderr_lines: List[bytes] = []
+                media_duration = [duration]
+                ingest_error: List[IngestError] = []
+                too_large: List[OutputTooLarge] = []
+
+                async def write_stdin(chunk: bytes):
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain()
+
+                async def feed_stdin():
+                    if not stdin_path:
+                        return
+                    try:
+                        await follow_file(stdin_path, write_stdin)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # ffmpeg завершился сам; его ошибка будет в stderr
+                        return
+                    except IngestError as e:
+                        ingest_error.append(e)
+                        proc.kill()
+                        return
+                    proc.stdin.close()
+
+                async def read_stdout():
+                    parser = ProgressParser()
+                    span_start, span_width = progress_span
+                    async for raw in proc.stdout:
+                        snapshot = parser.feed(raw.decode("utf-8", errors="ignore"))
+                        if snapshot is None:
+                            continue
+                        total = media_duration[0]
+                        if max_output_bytes and not snapshot.done and not too_large:
+                            # Достигнутый до конца лимит будет превышен: дальше еще кадры и индекс.
+                            # Прогноз с явным перелетом значит то же, только раньше
+                            over = snapshot.total_size >= max_output_bytes
+                            if total and snapshot.out_time >= GUARD_MIN_FRACTION * total:
+                                projected = projected_size(snapshot.total_size, snapshot.out_time, total)
+                                over = over or projected > max_output_bytes * GUARD_OVERSHOOT
+                            if over:
+                                too_large.append(OutputTooLarge(max_output_bytes, snapshot.total_size, snapshot.out_time))
+                                proc.kill()
+                                metrics.inc("encode.size_aborts")
+                                if total:
+                                    metrics.inc("encode.size_abort_media_saved", max(0.0, total - snapshot.out_time))
+                        if progress is None:
+                            continue
+                        done = min(1.0, snapshot.out_time / total) if total else 0.0
+                        if snapshot.done:
+                            done = 1.0
+                        snapshot.fraction = span_start + span_width * done
+                        progress.publish(snapshot)
+
+                async def read_stderr():
+                    async for raw in proc.stderr:
+                        stderr_lines.append(raw)
+                        if media_duration[0] is None:
+                            media_duration[0] = parse_duration(raw.decode("utf-8", errors="ignore"))
+
+                try:
+                    await asyncio.gather(read_stdout(), read_stderr(), feed_stdin())
+                    returncode = await proc.wait()
+                except asyncio.CancelledError:
+                    try:
+                        if self._proc and self._proc.returncode is None:
+                            self._proc.terminate()
+                            try:
+                                await asyncio.wait_for(self._proc.wait(), timeout=3)
+                            except asyncio.TimeoutError:
+                                self._proc.kill()
+                    finally:
+                        self._proc = None
+                    raise FFmpegError("Конвертация отменена")
+                finally:
+                    self._proc = None
+        except asyncio.CancelledError:
+            # Отмена, пока задание еще ждет слота в очереди
+            raise FFmpegError("Конвертация отменена")
+        stderr = b"".join(stderr_lines)
+        if ingest_error:
+            raise FFmpegError(str(ingest_error[0]))
+        if too_large:
+            raise too_large[0]
+        if returncode != 0:
+            raise FFmpegError(stderr.decode("utf-8", errors="ignore"))
+        return stderr
+
+    async def convert(
+        self,
+        input_path: str,
+        settings: Settings,
+        user_id: int = 0,
+        on_position: Optional[PositionCallback] = None,
+        out_dir: Optional[str] = None,
+        progress: Optional[ProgressStream] = None,
+        follow: bool = False,
+        max_bytes: Optional[int] = None,
+    ) -> str:
+        """С follow вход читается по мере загрузки: кодирование начинается,
+        не дожидаясь конца скачивания (формат должен позволять чтение без перемотки).
+        С max_bytes кодирование обрывается, как только выход его превысил."""
+        out_dir = out_dir or get_spool().mkdtemp("conv_", max_bytes or 0)
+        out_path = str(Path(out_dir) / "output.webm")
 
         args = [
-            exec_path,
             "-y",
             "-i",
-            input_path,
+            "pipe:0" if follow else input_path,
             "-vf",
             f"scale={settings.width}:{settings.height}:flags=lanczos",
             "-r",
@@ -41,41 +292,291 @@ class Converter:
         ]
         if settings.audio:
             args += ["libopus", "-b:a", "96k"]
-        v_args = [
-            "-c:v",
-            settings.codec,
-            "-crf",
-            str(settings.crf),
-            "-b:v",
-            "0",
-            "-pix_fmt",
-            "yuv420p",
-            "-deadline",
-            settings.preset,
-        ]
-        cmd = args + v_args + [out_path]
-        self._proc = await asyncio.create_subprocess_exec(
-            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        preset = settings.preset if settings.preset in PRESETS else PRESET_GOOD
+        v_args = self.backend(settings).video_args(settings.crf, None, preset, settings.width)
+        if max_bytes:
+            v_args += GUARD_MUXER_ARGS
+        await self.run(
+            args + v_args + [out_path],
+            user_id=user_id,
+            on_position=on_position,
+            progress=progress,
+            max_threads=useful_threads(settings.width, settings.height),
+            stdin_path=input_path if follow else None,
+            max_output_bytes=max_bytes,
+        )
+        if not os.path.exists(out_path):
+            raise FFmpegError("Выходной файл не создан")
+        return out_path
+
+    @staticmethod
+    def input_args(
+        input_path: str,
+        settings: Settings,
+        start_time: Optional[float] = None,
+        duration: Optional[float] = None,
+        crop: Optional[Tuple[int, int, int, int]] = None,
+    ) -> List[str]:
+        """Вход, обрезка по времени, кроп и масштаб — общая часть всех команд"""
+        args = ["-y"]
+        if start_time is not None:
+            args += ["-ss", str(start_time)]
+        if duration is not None:
+            args += ["-t", str(duration)]
+        args += ["-i", input_path]
+        filters = []
+        if crop:
+            crop_x, crop_y, crop_width, crop_height = crop
+            filters.append(f"crop={crop_width}:{crop_height}:{crop_x}:{crop_y}")
+        filters.append(f"scale={settings.width}:{settings.height}:flags=lanczos")
+        return args + ["-vf", ",".join(filters), "-r", str(settings.fps)]
+
+    async def sticker_output(
+        self,
+        output_path: str,
+        settings: Settings,
+        duration: float,
+        max_bytes: int = STICKER_MAX_BYTES,
+        margin: float = SIZE_MARGIN,
+        features: Optional[EncodeFeatures] = None,
+    ) -> Output:
+        """Однопроходный выход под байтовый бюджет для encode_outputs.
+
+        Попадает в лимит менее точно, чем двухпроходный encode_to_size,
+        зато не требует отдельного декодирования.
+        """
+        settings = self.tune_settings(settings, duration, max_bytes, margin, features)
+        backend = self.backend(settings)
+        record, bitrate = await self.predict_bitrate(
+            backend, PRESET_REALTIME, 1, settings, duration, max_bytes, margin, features
+        )
+        args = backend.video_args(settings.crf, bitrate, PRESET_REALTIME, settings.width)
+        if settings.audio:
+            args += ["-c:a", "libopus", "-b:a", str(AUDIO_BITRATE)]
+        else:
+            args += ["-an"]
+        return Output(
+            path=output_path,
+            filters=f"scale={settings.width}:{settings.height}:flags=lanczos",
+            args=args + ["-r", str(settings.fps)],
+            audio=settings.audio,
+            record=record,
+        )
+
+    async def encode_outputs(
+        self,
+        input_path: str,
+        outputs: List[Output],
+        start_time: Optional[float] = None,
+        duration: Optional[float] = None,
+        crop: Optional[Tuple[int, int, int, int]] = None,
+        user_id: int = 0,
+        priority: Priority = Priority.ENCODE,
+        max_threads: Optional[int] = None,
+    ) -> None:
+        """Одно декодирование отрезка на несколько выходов.
+
+        Обрезка по времени, декодирование и кроп выполняются один раз, после
+        чего фильтр split раздает кадры цепочкам фильтров и энкодерам всех
+        выходов.
+        """
+        args = ["-y"]
+        if start_time is not None:
+            args += ["-ss", str(start_time)]
+        if duration is not None:
+            args += ["-t", str(duration)]
+        args += ["-i", input_path]
+        head = "[0:v]"
+        if crop:
+            crop_x, crop_y, crop_width, crop_height = crop
+            head += f"crop={crop_width}:{crop_height}:{crop_x}:{crop_y},"
+        head += f"split={len(outputs)}" + "".join(f"[s{i}]" for i in range(len(outputs)))
+        chains = [f"[s{i}]{output.filters or 'null'}[v{i}]" for i, output in enumerate(outputs)]
+        args += ["-filter_complex", ";".join([head] + chains)]
+        for i, output in enumerate(outputs):
+            args += ["-map", f"[v{i}]"]
+            if output.audio:
+                args += ["-map", "0:a?"]
+            args += output.args + [output.path]
+        await self.run(
+            args,
+            user_id=user_id,
+            priority=priority,
+            max_threads=max_threads,
+            output_paths=[output.path for output in outputs],
+        )
+        for output in outputs:
+            if output.record is not None and os.path.exists(output.path):
+                get_predictor().record(replace(output.record, size=os.path.getsize(output.path)))
+
+    @staticmethod
+    def target_bitrate(max_bytes: int, duration: float, audio: bool, margin: float = SIZE_MARGIN) -> int:
+        """Битрейт видео (бит/с), при котором клип укладывается в max_bytes"""
+        budget_bits = max_bytes * 8 * margin
+        bitrate = budget_bits / max(duration, 0.1)
+        if audio:
+            bitrate -= AUDIO_BITRATE
+        return max(MIN_VIDEO_BITRATE, int(bitrate))
+
+    @staticmethod
+    def tune_settings(
+        settings: Settings,
+        duration: float,
+        max_bytes: int,
+        margin: float = SIZE_MARGIN,
+        features: Optional[EncodeFeatures] = None,
+    ) -> Settings:
+        """Частота кадров и CRF под сложность отрезка и байтовый бюджет.
+
+        Без оценки сложности настройки не меняются. Частота кадров только
+        снижается: сложному отрезку в тесном бюджете меньше кадров с
+        приличным качеством лучше, чем все кадры в кашу.
+        """
+        if features is None:
+            return settings
+        bitrate = Converter.target_bitrate(max_bytes, duration, settings.audio, margin)
+        needed = BITS_PER_PIXEL * (0.5 + features.complexity)
+        pixels = settings.width * settings.height
+        fps, crf = settings.fps, settings.crf
+        if bitrate < needed * pixels * fps:
+            fps = max(min(MIN_TUNED_FPS, fps), int(bitrate / (needed * pixels)))
+        elif bitrate >= 2 * needed * pixels * fps:
+            crf = max(MIN_CRF, crf - SIMPLE_CRF_STEP)
+        if (fps, crf) != (settings.fps, settings.crf):
+            logger.info(
+                "Сложность %.2f: %d fps, CRF %d вместо %d fps, CRF %d",
+                features.complexity, fps, crf, settings.fps, settings.crf,
+            )
+        return replace(settings, fps=fps, crf=crf)
+
+    async def predict_bitrate(
+        self,
+        backend: EncoderBackend,
+        preset: str,
+        passes: int,
+        settings: Settings,
+        duration: float,
+        max_bytes: int,
+        margin: float = SIZE_MARGIN,
+        features: Optional[EncodeFeatures] = None,
+    ) -> Tuple[EncodeRecord, int]:
+        """Битрейт видео под max_bytes по истории похожих кодирований.
+
+        Пока истории мало, битрейт считается по фиксированной доле бюджета
+        (target_bitrate). Прогноз уже учитывает контейнер, поэтому от
+        бюджета отнимается только то, что вызывающий просил сверх SIZE_MARGIN.
+        Возвращает запись для истории вместе с битрейтом. Поиск похожих
+        кодирований идет в пуле потоков, чтобы не задерживать цикл событий.
+        """
+        bitrate = self.target_bitrate(max_bytes, duration, settings.audio, margin)
+        record = EncodeRecord.build(
+            backend.name, preset, passes, settings.width, settings.height, settings.fps, duration,
+            settings.crf, bitrate, AUDIO_BITRATE if settings.audio else 0, features,
+        )
+        predicted = await asyncio.to_thread(
+            get_predictor().bitrate_for, int(max_bytes * margin / SIZE_MARGIN), record, MIN_VIDEO_BITRATE
+        )
+        return record, predicted or bitrate
+
+    async def encode_to_size(
+        self,
+        input_path: str,
+        output_path: str,
+        settings: Settings,
+        duration: float,
+        max_bytes: int = STICKER_MAX_BYTES,
+        start_time: Optional[float] = None,
+        crop: Optional[Tuple[int, int, int, int]] = None,
+        margin: float = SIZE_MARGIN,
+        user_id: int = 0,
+        on_position: Optional[PositionCallback] = None,
+        progress: Optional[ProgressStream] = None,
+        features: Optional[EncodeFeatures] = None,
+    ) -> int:
+        """Кодирование под байтовый бюджет.
+
+        Для энкодеров с двумя проходами первый проход быстрый и только
+        собирает статистику, второй кодирует в режиме constrained quality:
+        CRF из настроек ограничен целевым битрейтом. Остальные энкодеры
+        кодируют за один проход с целевым битрейтом. Если результат все же
+        больше лимита, кодирование повторяется с битрейтом, уменьшенным
+        пропорционально промаху (до SIZE_ATTEMPTS попыток). Все попытки,
+        кроме последней, обрываются, как только выход перерос лимит или
+        прогноз по уже закодированной доле явно его превышает; промах тогда
+        берется из прогноза. Первый битрейт предсказывается по истории
+        кодирований (predict_bitrate), а каждая доведенная до конца попытка
+        пополняет историю. Частота кадров и CRF подстраиваются под
+        сложность отрезка (tune_settings). Выходы размера стикера кодируются
+        пресетом realtime. Возвращает размер итогового файла.
+        """
+        settings = self.tune_settings(settings, duration, max_bytes, margin, features)
+        base = self.input_args(input_path, settings, start_time, duration, crop)
+        backend = self.backend(settings)
+        max_threads = useful_threads(settings.width, settings.height)
+        if max_bytes <= STICKER_MAX_BYTES:
+            preset = PRESET_REALTIME
+        else:
+            preset = settings.preset if settings.preset in PRESETS else PRESET_GOOD
+        record, bitrate = await self.predict_bitrate(
+            backend, preset, 2 if backend.two_pass else 1, settings, duration, max_bytes, margin, features
         )
+        passlog = os.path.join(os.path.dirname(output_path) or ".", "ffmpeg2pass")
+        pass_args: List[str] = []
+        encode_span = (0.0, 1.0)
         try:
-            stdout, stderr = await self._proc.communicate()
-        except asyncio.CancelledError:
-            try:
-                if self._proc and self._proc.returncode is None:
-                    self._proc.terminate()
-                    try:
-                        await asyncio.wait_for(self._proc.wait(), timeout=3)
-                    except asyncio.TimeoutError:
-                        self._proc.kill()
-            finally:
-                self._proc = None
-            raise FFmpegError("Конвертация отменена")
+            if backend.two_pass:
+                pass_args = ["-passlogfile", passlog, "-pass", "2"]
+                encode_span = (PASS1_SHARE, 1.0 - PASS1_SHARE)
+                await self.run(
+                    base + ["-c:v", backend.name]
+                    + backend.rate_args(settings.crf, bitrate)
+                    + ["-pix_fmt", "yuv420p", "-passlogfile", passlog, "-pass", "1"]
+                    + backend.first_pass_args()
+                    + ["-an", "-f", "null", os.devnull],
+                    user_id=user_id,
+                    on_position=on_position,
+                    progress=progress,
+                    progress_span=(0.0, PASS1_SHARE),
+                    duration=duration,
+                    max_threads=max_threads,
+                )
+            if settings.audio:
+                audio = ["-c:a", "libopus", "-b:a", str(AUDIO_BITRATE)]
+            else:
+                audio = ["-an"]
+            size = 0
+            for attempt in range(SIZE_ATTEMPTS):
+                guarded = attempt < SIZE_ATTEMPTS - 1
+                try:
+                    await self.run(
+                        base + backend.video_args(settings.crf, bitrate, preset, settings.width)
+                        + pass_args + audio + (GUARD_MUXER_ARGS if guarded else []) + [output_path],
+                        user_id=user_id,
+                        on_position=on_position,
+                        progress=progress,
+                        progress_span=encode_span,
+                        duration=duration,
+                        max_threads=max_threads,
+                        # Последняя попытка доводится до конца: файл нужен даже с промахом
+                        max_output_bytes=max_bytes if guarded else None,
+                    )
+                except OutputTooLarge as e:
+                    size = e.projected_size(duration)
+                else:
+                    if not os.path.exists(output_path):
+                        raise FFmpegError("Выходной файл не создан")
+                    size = os.path.getsize(output_path)
+                    get_predictor().record(replace(record, bitrate=bitrate, size=size))
+                    if size <= max_bytes:
+                        break
+                bitrate = max(MIN_VIDEO_BITRATE, int(bitrate * max_bytes * margin / size))
+            return size
         finally:
-            self._proc = None
-        if (self._proc and self._proc.returncode != 0) or not os.path.exists(out_path):
-            err_text = (stderr or b"").decode("utf-8", errors="ignore")
-            raise FFmpegError(err_text)
-        return out_path
+            for log in Path(passlog).parent.glob(Path(passlog).name + "*"):
+                try:
+                    log.unlink()
+                except OSError:
+                    pass
 
     def cancel(self):
         proc = self._proc
@@ -0,0 +1,211 @@
+import logging
+import math
+import os
+import subprocess
+from typing import Dict, FrozenSet, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Пресеты скорости: good — качество (обычная конвертация), realtime — скорость
+# (стикеры, где важнее уложиться в 256 KB, чем последний процент качества)
+PRESET_GOOD = "good"
+PRESET_REALTIME = "realtime"
+PRESETS = (PRESET_GOOD, PRESET_REALTIME)
+
+# Семейства кодеков: видеостикеры Telegram принимает только в VP9
+CODEC_FAMILIES = {
+    "vp9": "vp9",
+    "libvpx-vp9": "vp9",
+    "libsvt_vp9": "vp9",
+    "av1": "av1",
+    "libaom-av1": "av1",
+    "libsvtav1": "av1",
+}
+
+
+def codec_family(codec: str) -> str:
+    """Семейство кодека по имени из настроек (семейство или конкретный энкодер)"""
+    family = CODEC_FAMILIES.get(codec)
+    if family is None:
+        raise ValueError(f"Неизвестный кодек: {codec}")
+    return family
+
+
+def tile_columns(width: int) -> int:
+    """log2 числа колонок тайлов: колонка не уже 256 пикселей"""
+    return max(0, min(6, int(math.log2(max(1, width // 256)))))
+
+
+def useful_threads(width: int, height: int) -> int:
+    """Сколько потоков энкодер реально займет на таком кадре.
+
+    С row-mt libvpx параллелит строки суперблоков 64x64, так что больше
+    потоков, чем таких строк, не дает ускорения; 16 — предел libvpx.
+    """
+    return max(1, min(16, (height + 63) // 64))
+
+
+class EncoderBackend:
+    """Энкодер ffmpeg и его флаги скорости и контроля битрейта"""
+
+    name = ""
+    family = ""
+    # Ориентировочная скорость относительно libvpx-vp9 в пресете good;
+    # из доступных энкодеров семейства выбирается самый быстрый
+    speed = 1.0
+    # Поддерживает ли двухпроходное кодирование через -pass
+    two_pass = False
+
+    def rate_args(self, crf: int, bitrate: Optional[int]) -> List[str]:
+        """Качество: CRF, ограниченный битрейтом, или чистый CRF без bitrate"""
+        args = ["-crf", str(crf)]
+        return args + ["-b:v", str(bitrate) if bitrate else "0"]
+
+    def speed_args(self, preset: str, width: int) -> List[str]:
+        raise NotImplementedError
+
+    def first_pass_args(self) -> List[str]:
+        """Флаги анализирующего прохода; используется только при two_pass"""
+        return []
+
+    def video_args(self, crf: int, bitrate: Optional[int], preset: str, width: int) -> List[str]:
+        """Полный набор флагов видеопотока, кроме -pass и -threads
+        (число потоков назначает Converter.run из бюджета планировщика)"""
+        return ["-c:v", self.name] + self.rate_args(crf, bitrate) + ["-pix_fmt", "yuv420p"] + self.speed_args(
+            preset, width
+        )
+
+
+class LibvpxVp9(EncoderBackend):
+    name = "libvpx-vp9"
+    family = "vp9"
+    speed = 1.0
+    two_pass = True
+
+    def speed_args(self, preset, width):
+        if preset == PRESET_REALTIME:
+            speed = ["-deadline", "realtime", "-cpu-used", "8"]
+        else:
+            speed = ["-deadline", "good", "-cpu-used", "2"]
+        return speed + ["-row-mt", "1", "-tile-columns", str(tile_columns(width))]
+
+    def first_pass_args(self):
+        # realtime для первого прохода libvpx не поддерживает
+        return ["-deadline", "good", "-cpu-used", "4", "-row-mt", "1"]
+
+
+class SvtVp9(EncoderBackend):
+    name = "libsvt_vp9"
+    family = "vp9"
+    speed = 3.0
+
+    def rate_args(self, crf, bitrate):
+        # CRF у SVT-VP9 нет: без битрейта постоянный QP, с битрейтом — VBR
+        if bitrate:
+            return ["-rc", "1", "-b:v", str(bitrate)]
+        return ["-rc", "0", "-qp", str(crf)]
+
+    def speed_args(self, preset, width):
+        return ["-preset", "9" if preset == PRESET_REALTIME else "6"]
+
+
+class LibaomAv1(EncoderBackend):
+    name = "libaom-av1"
+    family = "av1"
+    speed = 0.5
+    two_pass = True
+
+    def speed_args(self, preset, width):
+        if preset == PRESET_REALTIME:
+            speed = ["-usage", "realtime", "-cpu-used", "8"]
+        else:
+            speed = ["-cpu-used", "6"]
+        return speed + ["-row-mt", "1", "-tile-columns", str(tile_columns(width))]
+
+    def first_pass_args(self):
+        return ["-cpu-used", "6", "-row-mt", "1"]
+
+
+class SvtAv1(EncoderBackend):
+    name = "libsvtav1"
+    family = "av1"
+    speed = 2.0
+
+    def rate_args(self, crf, bitrate):
+        if bitrate:
+            return ["-b:v", str(bitrate)]
+        return ["-crf", str(crf)]
+
+    def speed_args(self, preset, width):
+        return ["-preset", "12" if preset == PRESET_REALTIME else "8"]
+
+
+BACKENDS: Dict[str, EncoderBackend] = {
+    backend.name: backend for backend in (LibvpxVp9(), SvtVp9(), LibaomAv1(), SvtAv1())
+}
+
+
+def probe_encoders(ffmpeg: str) -> FrozenSet[str]:
+    """Имена энкодеров из `ffmpeg -encoders`, которые есть в BACKENDS"""
+    try:
+        output = subprocess.run(
+            [ffmpeg, "-hide_banner", "-encoders"], capture_output=True, timeout=10, check=True
+        ).stdout.decode("utf-8", errors="ignore")
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning("Не удалось получить список энкодеров ffmpeg: %s", e)
+        return frozenset()
+    found = set()
+    for line in output.splitlines():
+        parts = line.split()
+        # Строки вида « V....D libvpx-vp9   libvpx VP9 (codec vp9)»
+        if len(parts) >= 2 and parts[0].startswith("V") and parts[1] in BACKENDS:
+            found.add(parts[1])
+    return frozenset(found)
+
+
+class EncoderRegistry:
+    """Доступные в локальной сборке ffmpeg энкодеры и выбор среди них"""
+
+    def __init__(self, available: FrozenSet[str], preferred: Optional[str] = None):
+        self.available = available
+        self.preferred = preferred
+
+    def select(self, codec: str) -> EncoderBackend:
+        """Самый быстрый доступный энкодер семейства кодека из настроек.
+
+        Если в настройках или в ENCODER указан конкретный доступный энкодер
+        нужного семейства, используется он. Без результатов проверки
+        (ffmpeg не ответил) остается libvpx-vp9 как раньше.
+        """
+        family = codec_family(codec)
+        for name in (self.preferred, codec):
+            backend = BACKENDS.get(name or "")
+            if backend and backend.family == family and backend.name in self.available:
+                return backend
+        candidates = [b for b in BACKENDS.values() if b.family == family and b.name in self.available]
+        if not candidates:
+            if family != "vp9":
+                raise ValueError(f"В ffmpeg нет энкодера для {family}")
+            return BACKENDS["libvpx-vp9"]
+        return max(candidates, key=lambda b: b.speed)
+
+
+_registry: Optional[EncoderRegistry] = None
+
+
+def get_encoder_registry() -> EncoderRegistry:
+    global _registry
+    if _registry is None:
+        _registry = configure_encoders(os.getenv("FFMPEG_PATH") or "ffmpeg")
+    return _registry
+
+
+def configure_encoders(ffmpeg: str, preferred: Optional[str] = None) -> EncoderRegistry:
+    """Один раз проверяет энкодеры ffmpeg (при старте процесса)"""
+    global _registry
+    available = probe_encoders(ffmpeg)
+    if preferred and preferred not in BACKENDS:
+        raise ValueError(f"Неизвестный энкодер: {preferred}")
+    _registry = EncoderRegistry(available, preferred)
+    logger.info("Энкодеры ffmpeg: %s", ", ".join(sorted(available)) or "не найдены")
+    return _registry
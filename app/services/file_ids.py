@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Optional
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from app.services.cache import file_digest
+from app.services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FILE_ID_STORE = "sqlite:/tmp/converter_file_ids.sqlite3"
+
+
+class FileIdStore:
+    """Соответствие «хеш содержимого файла -> Telegram file_id»"""
+
+    async def get(self, digest: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, digest: str, file_id: str) -> None:
+        raise NotImplementedError
+
+    async def delete(self, digest: str) -> None:
+        raise NotImplementedError
+
+
+class MemoryFileIdStore(FileIdStore):
+    """Хранилище в памяти процесса; теряется при перезапуске"""
+
+    def __init__(self):
+        self._ids: Dict[str, str] = {}
+
+    async def get(self, digest: str) -> Optional[str]:
+        return self._ids.get(digest)
+
+    async def set(self, digest: str, file_id: str) -> None:
+        self._ids[digest] = file_id
+
+    async def delete(self, digest: str) -> None:
+        self._ids.pop(digest, None)
+
+
+class SqliteFileIdStore(FileIdStore):
+    """Хранилище в файле SQLite; переживает перезапуски"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            "digest TEXT PRIMARY KEY, file_id TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        # Один поток на соединение: sqlite3 не любит параллельные вызовы
+        self._lock = asyncio.Lock()
+
+    async def _execute(self, sql: str, params: tuple):
+        def run():
+            cur = self._conn.execute(sql, params)
+            self._conn.commit()
+            return cur.fetchone()
+
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(None, run)
+
+    async def get(self, digest: str) -> Optional[str]:
+        row = await self._execute("SELECT file_id FROM file_ids WHERE digest = ?", (digest,))
+        return row[0] if row else None
+
+    async def set(self, digest: str, file_id: str) -> None:
+        await self._execute(
+            "INSERT OR REPLACE INTO file_ids (digest, file_id, updated_at) VALUES (?, ?, ?)",
+            (digest, file_id, time.time()),
+        )
+
+    async def delete(self, digest: str) -> None:
+        await self._execute("DELETE FROM file_ids WHERE digest = ?", (digest,))
+
+
+def create_file_id_store(url: str) -> FileIdStore:
+    """memory или sqlite:<путь к файлу>"""
+    if url == "memory":
+        return MemoryFileIdStore()
+    if url.startswith("sqlite:"):
+        return SqliteFileIdStore(url[len("sqlite:"):])
+    raise ValueError(f"Неизвестное хранилище file_id: {url}")
+
+
+_store: Optional[FileIdStore] = None
+
+
+def get_file_id_store() -> FileIdStore:
+    global _store
+    if _store is None:
+        _store = create_file_id_store(DEFAULT_FILE_ID_STORE)
+    return _store
+
+
+def configure_file_id_store(url: str) -> FileIdStore:
+    global _store
+    _store = create_file_id_store(url)
+    return _store
+
+
+async def send_document(message: Message, path: str, caption: Optional[str] = None) -> Message:
+    """Отправляет файл, используя file_id, если такой же файл уже отправлялся"""
+    store = get_file_id_store()
+    digest = await file_digest(path)
+    file_id = await store.get(digest)
+    if file_id:
+        try:
+            sent = await message.answer_document(file_id, caption=caption)
+            metrics.inc("file_ids.hits")
+            metrics.inc("file_ids.bytes_saved", os.path.getsize(path))
+            return sent
+        except TelegramBadRequest:
+            # file_id мог устареть — загружаем заново
+            logger.info("file_id для %s больше не действителен", digest)
+            await store.delete(digest)
+    metrics.inc("file_ids.misses")
+    sent = await message.answer_document(FSInputFile(path), caption=caption)
+    if sent.document:
+        await store.set(digest, sent.document.file_id)
+    return sent
@@ -0,0 +1,108 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Optional
+
+# Файл, который еще загружается, лежит рядом с итоговым под этим суффиксом
+# и переименовывается в итоговый, когда загрузка закончена
+PART_SUFFIX = ".part"
+# Сколько начала файла смотреть в поисках moov
+STREAM_HEAD_LIMIT = 4 * 1024 * 1024
+FOLLOW_CHUNK = 256 * 1024
+FOLLOW_POLL = 0.05
+# Сколько ждать новых байт, прежде чем считать загрузку зависшей
+FOLLOW_STALL = 60.0
+
+
+class IngestError(Exception):
+    pass
+
+
+def partial_path(path: str) -> str:
+    return path + PART_SUFFIX
+
+
+def is_streamable(head: bytes, ext: str) -> Optional[bool]:
+    """Можно ли разбирать файл по мере загрузки.
+
+    MP4 — только если метаданные (moov) идут до данных (mdat), иначе
+    ffmpeg без перемотки их не найдет. None — в head пока мало байт.
+    """
+    if ext not in ("mp4", "m4v", "mov"):
+        return ext in ("webm", "mkv")
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        kind = head[offset + 4:offset + 8]
+        if kind == b"moov":
+            return True
+        if kind == b"mdat":
+            return False
+        if size == 1:
+            if offset + 16 > len(head):
+                return None
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:
+            return False
+        offset += size
+    return None
+
+
+def _open_growing(path: str):
+    """Открывает итоговый файл или, пока его нет, растущий .part"""
+    for candidate in (path, partial_path(path), path):
+        try:
+            return open(candidate, "rb")
+        except FileNotFoundError:
+            continue
+    return None
+
+
+async def wait_streamable(path: str, ext: str, download: asyncio.Task) -> bool:
+    """Ждет, пока загрузится достаточно начала файла, чтобы решить, можно ли
+    отдавать его ffmpeg по мере загрузки. Если загрузка уже закончилась
+    (или упала), поток не нужен — False."""
+    while not download.done():
+        f = _open_growing(path)
+        if f is not None:
+            with f:
+                head = f.read(STREAM_HEAD_LIMIT)
+            streamable = is_streamable(head, ext)
+            if streamable is not None:
+                return streamable
+            if len(head) >= STREAM_HEAD_LIMIT:
+                return False
+        await asyncio.sleep(FOLLOW_POLL)
+    return False
+
+
+async def follow_file(path: str, on_chunk: Callable[[bytes], Awaitable[None]]) -> None:
+    """Читает файл по мере загрузки и отдает куски on_chunk.
+
+    Загрузчик пишет в path + PART_SUFFIX и в конце переименовывает его в
+    path; открытый дескриптор при этом продолжает читать тот же файл.
+    Пропавший .part без итогового файла значит, что загрузка прервана.
+    """
+    loop = asyncio.get_running_loop()
+    f = _open_growing(path)
+    if f is None:
+        raise IngestError("Входной файл не найден")
+    with f:
+        idle = 0.0
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, FOLLOW_CHUNK)
+            if chunk:
+                idle = 0.0
+                await on_chunk(chunk)
+                continue
+            if os.path.exists(path):
+                # Загрузка закончена: дочитываем хвост, если он появился после read
+                chunk = await loop.run_in_executor(None, f.read)
+                if chunk:
+                    await on_chunk(chunk)
+                return
+            if not os.path.exists(partial_path(path)):
+                raise IngestError("Загрузка входного файла прервана")
+            idle += FOLLOW_POLL
+            if idle > FOLLOW_STALL:
+                raise IngestError("Загрузка входного файла зависла")
+            await asyncio.sleep(FOLLOW_POLL)
@@ -0,0 +1,342 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from app.models import Settings
+from app.services.converter import SIZE_MARGIN, STICKER_MAX_BYTES, Converter, FFmpegError
+from app.services.predictor import EncodeFeatures
+from app.services.progress import Progress, ProgressStream
+from app.services.scheduler import PositionCallback, Priority
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_QUEUE = "local"
+# Через сколько секунд без heartbeat задание считается брошенным упавшим воркером
+STALE_AFTER = 60.0
+# Сколько хранить завершенные задания
+KEEP_FINISHED = 24 * 3600
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+
+@dataclass
+class Job:
+    """Задание на кодирование; params содержит только сериализуемые данные"""
+    kind: str
+    user_id: int
+    params: Dict[str, Any]
+    priority: int = Priority.ENCODE
+    id: str = field(default_factory=new_job_id)
+
+
+async def execute(
+    job: Job,
+    on_position: Optional[PositionCallback] = None,
+    progress: Optional[ProgressStream] = None,
+) -> Dict[str, Any]:
+    """Выполняет задание в текущем процессе и возвращает {"path", "size"}"""
+    params = job.params
+    settings = Settings.from_dict(params["settings"])
+    converter = Converter()
+    if job.kind == "convert":
+        path = await converter.convert(
+            params["input_path"],
+            settings,
+            user_id=job.user_id,
+            on_position=on_position,
+            out_dir=params.get("out_dir"),
+            progress=progress,
+            follow=params.get("follow", False),
+            max_bytes=params.get("max_bytes"),
+        )
+        return {"path": path, "size": os.path.getsize(path)}
+    if job.kind == "encode_to_size":
+        crop = params.get("crop")
+        size = await converter.encode_to_size(
+            params["input_path"],
+            params["output_path"],
+            settings,
+            params["duration"],
+            max_bytes=params.get("max_bytes", STICKER_MAX_BYTES),
+            start_time=params.get("start_time"),
+            crop=tuple(crop) if crop else None,
+            margin=params.get("margin", SIZE_MARGIN),
+            user_id=job.user_id,
+            on_position=on_position,
+            progress=progress,
+            features=EncodeFeatures.from_dict(params.get("features")),
+        )
+        return {"path": params["output_path"], "size": size}
+    raise ValueError(f"Неизвестный тип задания: {job.kind}")
+
+
+class JobQueue:
+    """Очередь заданий на кодирование"""
+
+    async def run(
+        self,
+        job: Job,
+        on_position: Optional[PositionCallback] = None,
+        progress: Optional[ProgressStream] = None,
+    ) -> Dict[str, Any]:
+        """Ставит задание и ждет результат"""
+        raise NotImplementedError
+
+    async def cancel(self, job_id: str) -> None:
+        raise NotImplementedError
+
+
+class LocalJobQueue(JobQueue):
+    """Кодирование в том же процессе, что и бот (режим по умолчанию)"""
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    async def run(self, job, on_position=None, progress=None):
+        self._tasks[job.id] = asyncio.current_task()
+        try:
+            return await execute(job, on_position, progress)
+        finally:
+            self._tasks.pop(job.id, None)
+
+    async def cancel(self, job_id: str) -> None:
+        task = self._tasks.get(job_id)
+        if task and not task.done():
+            task.cancel()
+
+
+class SqliteJobQueue(JobQueue):
+    """Персистентная очередь в SQLite для отдельных процессов-воркеров.
+
+    Фронт кладет задание и опрашивает его статус, воркеры (worker.py)
+    забирают задания, пишут прогресс и heartbeat. Задание упавшего
+    воркера возвращается в очередь. Пути во входных и выходных файлах
+    должны быть видны и фронту, и воркерам (общий диск или том).
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.5):
+        self.path = path
+        self.poll_interval = poll_interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, user_id INTEGER NOT NULL, "
+            "priority INTEGER NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL, "
+            "fraction REAL NOT NULL DEFAULT 0, result TEXT, error TEXT, worker TEXT, "
+            "cancel_requested INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL, heartbeat REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, created_at)")
+        self._lock = asyncio.Lock()
+
+    async def _run(self, fn, *args):
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def _execute(self, sql: str, params: tuple = ()):
+        return self._conn.execute(sql, params).fetchone()
+
+    # --- сторона фронта ---
+
+    async def submit(self, job: Job) -> None:
+        await self._run(
+            self._execute,
+            "INSERT INTO jobs (id, kind, user_id, priority, params, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+            (job.id, job.kind, job.user_id, int(job.priority), json.dumps(job.params), time.time()),
+        )
+
+    def _status(self, job_id: str):
+        row = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        if row is None or row["status"] != "queued":
+            return row, 0
+        ahead = self._execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' "
+            "AND (priority < ? OR (priority = ? AND created_at < ?))",
+            (row["priority"], row["priority"], row["created_at"]),
+        )[0]
+        return row, ahead + 1
+
+    async def run(self, job, on_position=None, progress=None):
+        await self.submit(job)
+        last_position = None
+        last_fraction = -1.0
+        try:
+            while True:
+                row, position = await self._run(self._status, job.id)
+                if row is None:
+                    raise FFmpegError("Задание потеряно")
+                if position != last_position and on_position:
+                    await on_position(position)
+                last_position = position
+                status = row["status"]
+                if status == "done":
+                    return json.loads(row["result"])
+                if status == "failed":
+                    raise FFmpegError(row["error"] or "Ошибка кодирования")
+                if status == "cancelled":
+                    raise FFmpegError("Конвертация отменена")
+                if progress is not None and row["fraction"] != last_fraction:
+                    last_fraction = row["fraction"]
+                    progress.publish(Progress(fraction=last_fraction))
+                await asyncio.sleep(self.poll_interval)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.cancel(job.id))
+            raise FFmpegError("Конвертация отменена")
+
+    async def cancel(self, job_id: str) -> None:
+        def run():
+            self._execute(
+                "UPDATE jobs SET status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END, "
+                "cancel_requested = 1 WHERE id = ?",
+                (job_id,),
+            )
+
+        await self._run(run)
+
+    # --- сторона воркера ---
+
+    async def claim(self, worker: str) -> Optional[Job]:
+        """Забирает следующее задание: сначала превью, затем пользователи
+        с меньшим числом выполняющихся заданий, затем по времени"""
+        def run():
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL "
+                    "WHERE status = 'running' AND heartbeat < ?",
+                    (now - STALE_AFTER,),
+                )
+                self._conn.execute(
+                    "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND created_at < ?",
+                    (now - KEEP_FINISHED,),
+                )
+                row = self._execute(
+                    "SELECT * FROM jobs AS j WHERE status = 'queued' ORDER BY priority, "
+                    "(SELECT COUNT(*) FROM jobs AS r WHERE r.status = 'running' AND r.user_id = j.user_id), "
+                    "created_at LIMIT 1"
+                )
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, heartbeat = ? WHERE id = ?",
+                        (worker, now, row["id"]),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return row
+
+        row = await self._run(run)
+        if row is None:
+            return None
+        return Job(
+            kind=row["kind"],
+            user_id=row["user_id"],
+            params=json.loads(row["params"]),
+            priority=row["priority"],
+            id=row["id"],
+        )
+
+    async def heartbeat(self, job_id: str, fraction: float) -> bool:
+        """Обновляет прогресс и возвращает True, если задание просят отменить"""
+        def run():
+            self._execute(
+                "UPDATE jobs SET heartbeat = ?, fraction = ? WHERE id = ?", (time.time(), fraction, job_id)
+            )
+            row = self._execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,))
+            return bool(row and row[0])
+
+        return await self._run(run)
+
+    async def finish(self, job_id: str, status: str, result: Optional[Dict[str, Any]] = None, error: str = "") -> None:
+        await self._run(
+            self._execute,
+            "UPDATE jobs SET status = ?, result = ?, error = ?, fraction = 1 WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error, job_id),
+        )
+
+
+async def _work(queue: SqliteJobQueue, job: Job, heartbeat_interval: float) -> None:
+    progress = ProgressStream()
+    task = asyncio.create_task(execute(job, progress=progress))
+    cancel_requested = False
+    while not task.done():
+        try:
+            await asyncio.wait({task}, timeout=heartbeat_interval)
+        except asyncio.CancelledError:
+            # Воркер останавливается: задание вернется в очередь по heartbeat
+            task.cancel()
+            raise
+        latest = progress.latest
+        if await queue.heartbeat(job.id, latest.fraction if latest else 0.0) and not task.done():
+            cancel_requested = True
+            task.cancel()
+    try:
+        result = task.result()
+    except (FFmpegError, asyncio.CancelledError) as e:
+        status = "cancelled" if cancel_requested else "failed"
+        await queue.finish(job.id, status, error=str(e))
+        return
+    except Exception as e:
+        logger.exception("Задание %s упало", job.id)
+        await queue.finish(job.id, "failed", error=str(e))
+        return
+    await queue.finish(job.id, "done", result)
+
+
+async def run_worker(queue: SqliteJobQueue, concurrency: int, heartbeat_interval: float = 1.0) -> None:
+    """Цикл процесса-воркера: concurrency заданий одновременно"""
+    name = f"{socket.gethostname()}:{os.getpid()}"
+
+    async def loop(slot: int):
+        while True:
+            job = await queue.claim(f"{name}/{slot}")
+            if job is None:
+                await asyncio.sleep(queue.poll_interval)
+                continue
+            logger.info("Воркер %s/%d взял задание %s (%s)", name, slot, job.id, job.kind)
+            await _work(queue, job, heartbeat_interval)
+
+    await asyncio.gather(*(loop(slot) for slot in range(max(1, concurrency))))
+
+
+def create_job_queue(url: str) -> JobQueue:
+    """local или sqlite:<путь к файлу>"""
+    if url == "local":
+        return LocalJobQueue()
+    if url.startswith("sqlite:"):
+        return SqliteJobQueue(url[len("sqlite:"):])
+    raise ValueError(f"Неизвестная очередь заданий: {url}")
+
+
+_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        _queue = create_job_queue(DEFAULT_JOB_QUEUE)
+    return _queue
+
+
+def configure_job_queue(url: str) -> JobQueue:
+    global _queue
+    _queue = create_job_queue(url)
+    return _queue
@@ -0,0 +1,47 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict
+
+
+class Metrics:
+    """Простые счетчики процесса: попадания в кеши, сэкономленные байты и т.п."""
+
+    def __init__(self):
+        self._values: Dict[str, float] = defaultdict(float)
+
+    def inc(self, name: str, value: float = 1) -> None:
+        self._values[name] += value
+
+    def set(self, name: str, value: float) -> None:
+        self._values[name] = value
+
+    def get(self, name: str) -> float:
+        return self._values.get(name, 0)
+
+    def ratio(self, hits: str, misses: str) -> float:
+        total = self.get(hits) + self.get(misses)
+        return self.get(hits) / total if total else 0.0
+
+    def snapshot(self) -> Dict[str, float]:
+        return dict(sorted(self._values.items()))
+
+
+metrics = Metrics()
+
+
+async def monitor_loop_lag(interval: float = 0.5) -> None:
+    """Измеряет, насколько позже запланированного просыпается event loop.
+
+    Большая задержка значит, что кто-то выполняет блокирующую работу прямо
+    в цикле и все остальные обновления ждут.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (time.perf_counter() - start - interval) * 1000)
+        metrics.set("loop_lag.last_ms", round(lag_ms, 1))
+        if lag_ms > metrics.get("loop_lag.max_ms"):
+            metrics.set("loop_lag.max_ms", round(lag_ms, 1))
+        if lag_ms > 100:
+            metrics.inc("loop_lag.stalls")
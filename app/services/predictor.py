@@ -0,0 +1,266 @@
+import heapq
+import json
+import logging
+import math
+import os
+import threading
+from collections import deque
+from dataclasses import asdict, dataclass, fields
+from typing import Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_PATH = "/tmp/converter_encode_history.jsonl"
+# Сколько последних кодирований держать в памяти
+MAX_RECORDS = 5000
+NEIGHBOURS = 16
+# Меньше похожих кодирований — прогноза нет, битрейт считается как раньше
+MIN_NEIGHBOURS = 4
+# Прогноз — медиана, а промахи вверх дороже промахов вниз: целимся чуть ниже
+SAFETY = 0.95
+# Масштабы признаков для расстояния: разница на масштаб весит как единица
+FEATURE_SCALES = (0.5, 10.0, 0.5, 0.5, 4.0, 4.0, 2.0, 8.0, 0.5)
+# Значения признаков, с которых отрезок считается предельно сложным
+SPATIAL_REF = 10.0
+TEMPORAL_REF = 12.0
+SCENE_CHANGES_REF = 2
+
+
+@dataclass
+class EncodeFeatures:
+    """Признаки содержимого отрезка, которые не знает энкодер"""
+    # Битрейт исходника, бит/с
+    source_bitrate: int = 0
+    # Средний модуль градиента яркости (детализация кадра), 0..255
+    spatial: float = 0.0
+    # Средняя разница соседних кадров (движение), 0..255
+    temporal: float = 0.0
+    # Смены сцены внутри отрезка
+    scene_changes: int = 0
+
+    @property
+    def complexity(self) -> float:
+        """Сложность для энкодера: 0 — статичная гладкая картинка, 1 — детальная,
+        быстрая и со сменами сцен"""
+        return (
+            0.4 * min(1.0, self.spatial / SPATIAL_REF)
+            + 0.4 * min(1.0, self.temporal / TEMPORAL_REF)
+            + 0.2 * min(1.0, self.scene_changes / SCENE_CHANGES_REF)
+        )
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict]) -> Optional["EncodeFeatures"]:
+        if not data:
+            return None
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in data.items() if k in known})
+
+
+@dataclass
+class EncodeRecord:
+    """Одно кодирование: параметры, признаки и получившийся размер"""
+    encoder: str
+    preset: str
+    passes: int
+    width: int
+    height: int
+    fps: int
+    duration: float
+    crf: int
+    # Запрошенный битрейт видео, бит/с
+    bitrate: int
+    audio_bitrate: int
+    source_bitrate: int
+    spatial: float
+    temporal: float
+    scene_changes: int = 0
+    # Размер файла, байт (0 — еще не закодировано)
+    size: int = 0
+
+    @classmethod
+    def build(
+        cls,
+        encoder: str,
+        preset: str,
+        passes: int,
+        width: int,
+        height: int,
+        fps: int,
+        duration: float,
+        crf: int,
+        bitrate: int,
+        audio_bitrate: int,
+        features: Optional[EncodeFeatures],
+    ) -> "EncodeRecord":
+        features = features or EncodeFeatures()
+        return cls(
+            encoder, preset, passes, width, height, fps, round(duration, 3), crf, bitrate, audio_bitrate,
+            features.source_bitrate, round(features.spatial, 2), round(features.temporal, 2),
+            features.scene_changes,
+        )
+
+    def requested_bits(self) -> float:
+        return max(1.0, (self.bitrate + self.audio_bitrate) * self.duration)
+
+    def ratio(self) -> float:
+        """Во сколько раз файл вышел больше запрошенного (контейнер включительно)"""
+        return self.size * 8 / self.requested_bits()
+
+    def bucket(self) -> Tuple[str, str, int]:
+        """Сравнимы только кодирования тем же энкодером, пресетом и числом проходов"""
+        return self.encoder, self.preset, self.passes
+
+    def vector(self) -> Tuple[float, ...]:
+        """Признаки, деленные на FEATURE_SCALES: расстояние — обычное евклидово"""
+        return tuple(value / scale for value, scale in zip(self._raw_vector(), FEATURE_SCALES))
+
+    def _raw_vector(self) -> Tuple[float, ...]:
+        return (
+            math.log(max(1, self.width * self.height)),
+            float(self.fps),
+            math.log(max(0.1, self.duration)),
+            math.log(max(1, self.source_bitrate)),
+            self.spatial,
+            self.temporal,
+            float(self.scene_changes),
+            float(self.crf),
+            math.log(max(1, self.bitrate)),
+        )
+
+
+class BitratePredictor:
+    """Предсказывает битрейт, с которым кодирование попадет в байтовый бюджет.
+
+    Энкодер промахивается мимо запрошенного битрейта по-разному в
+    зависимости от содержимого: простой отрезок упирается в CRF и выходит
+    меньше, сложный перелетает. Предиктор хранит историю кодирований
+    (в памяти и в JSONL-файле) и по NEIGHBOURS ближайшим кодированиям
+    тем же энкодером, пресетом и числом проходов оценивает отношение итогового размера к
+    запрошенному. Без достаточной истории прогноза нет.
+
+    Векторы признаков считаются один раз при добавлении записи и лежат по
+    корзинам энкодер/пресет/проходы. Прогноз можно считать в другом потоке
+    (Converter.predict_bitrate делает это через asyncio.to_thread).
+    """
+
+    def __init__(self, path: Optional[str] = None, max_records: int = MAX_RECORDS):
+        self.path = path
+        self.records: Deque[EncodeRecord] = deque(maxlen=max_records)
+        # Корзина -> (вектор признаков, логарифм отношения) в порядке добавления
+        self._buckets: Dict[Tuple[str, str, int], Deque[Tuple[Tuple[float, ...], float]]] = {}
+        self._lock = threading.Lock()
+        if path:
+            history = load_history(path)
+            for record in history:
+                if record.size > 0 and record.bitrate > 0:
+                    self._add(record)
+            if len(history) > 2 * max_records:
+                self._compact()
+
+    def _add(self, record: EncodeRecord) -> None:
+        with self._lock:
+            if len(self.records) == self.records.maxlen:
+                # Вытесняемая запись — самая старая и в своей корзине
+                evicted = self.records[0]
+                bucket = self._buckets[evicted.bucket()]
+                bucket.popleft()
+                if not bucket:
+                    del self._buckets[evicted.bucket()]
+            self.records.append(record)
+            self._buckets.setdefault(record.bucket(), deque()).append((record.vector(), math.log(record.ratio())))
+
+    def _compact(self) -> None:
+        """Оставляет в файле только записи, которые держатся в памяти"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self.records:
+                f.write(json.dumps(asdict(record), separators=(",", ":")) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def record(self, record: EncodeRecord) -> None:
+        """Запоминает кодирование и дописывает его в файл истории"""
+        if record.size <= 0 or record.bitrate <= 0:
+            return
+        self._add(record)
+        if not self.path:
+            return
+        try:
+            # Одна короткая строка на запись: дописывания из нескольких процессов не перемешиваются
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(asdict(record), separators=(",", ":")) + "\n")
+        except OSError as e:
+            logger.warning("Не удалось записать историю кодирований: %s", e)
+
+    def predict_ratio(self, query: EncodeRecord) -> Optional[float]:
+        """Ожидаемое отношение итогового размера к запрошенному или None"""
+        with self._lock:
+            candidates = list(self._buckets.get(query.bucket(), ()))
+        if len(candidates) < MIN_NEIGHBOURS:
+            return None
+        target = query.vector()
+
+        def distance(vector: Tuple[float, ...]) -> float:
+            return sum((a - b) ** 2 for a, b in zip(vector, target))
+
+        nearest = heapq.nsmallest(NEIGHBOURS, ((distance(vector), log_ratio) for vector, log_ratio in candidates))
+        # Взвешенная медиана логарифма отношения: выбросы не тянут прогноз
+        weighted = sorted((log_ratio, 1.0 / (1.0 + math.sqrt(d))) for d, log_ratio in nearest)
+        half = sum(w for _, w in weighted) / 2
+        acc = 0.0
+        for log_ratio, weight in weighted:
+            acc += weight
+            if acc >= half:
+                return math.exp(log_ratio)
+        return math.exp(weighted[-1][0])
+
+    def bitrate_for(self, max_bytes: int, query: EncodeRecord, min_bitrate: int) -> Optional[int]:
+        """Битрейт видео, с которым файл должен попасть в max_bytes, или None.
+
+        Отношение зависит и от самого битрейта (ниже порога CRF его не
+        достичь), поэтому битрейт уточняется несколькими итерациями.
+        query.bitrate становится выбранным битрейтом, чтобы запись после
+        кодирования сохранила именно его.
+        """
+        budget = max_bytes * 8 * SAFETY
+        bitrate = query.bitrate
+        for _ in range(3):
+            query.bitrate = bitrate
+            ratio = self.predict_ratio(query)
+            if ratio is None:
+                return None
+            total = budget / (ratio * max(query.duration, 0.1))
+            bitrate = max(min_bitrate, int(total - query.audio_bitrate))
+        query.bitrate = bitrate
+        return bitrate
+
+
+def load_history(path: str) -> List[EncodeRecord]:
+    """Записи из JSONL-файла истории; битые строки пропускаются"""
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(EncodeRecord(**json.loads(line)))
+            except (ValueError, TypeError):
+                continue
+    return records
+
+
+_predictor: Optional[BitratePredictor] = None
+
+
+def get_predictor() -> BitratePredictor:
+    global _predictor
+    if _predictor is None:
+        _predictor = BitratePredictor(None)
+    return _predictor
+
+
+def configure_predictor(path: Optional[str]) -> BitratePredictor:
+    """История кодирований в path; пустой path — только в памяти процесса"""
+    global _predictor
+    _predictor = BitratePredictor(path or None)
+    logger.info("История кодирований: %d записей", len(_predictor.records))
+    return _predictor
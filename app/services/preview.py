@@ -0,0 +1,107 @@
+from typing import Sequence, Tuple
+
+import cv2
+import numpy as np
+
+try:
+    from turbojpeg import TurboJPEG
+    _turbo = TurboJPEG()
+except Exception:  # нет пакета или libturbojpeg — используем cv2
+    _turbo = None
+
+# Длинная сторона превью: Telegram все равно показывает фото уменьшенным
+PREVIEW_MAX_SIDE = 640
+PREVIEW_QUALITY = 85
+BORDER_COLOR = (0, 0, 255)  # красный в BGR
+BORDER_WIDTH = 3
+# Подписи времени на контактном листе
+LABEL_COLOR = (255, 255, 255)
+LABEL_SHADOW = (0, 0, 0)
+SHEET_GAP = 4
+
+
+def encode_jpeg(image: np.ndarray, quality: int = PREVIEW_QUALITY) -> bytes:
+    """Кодирует BGR массив в JPEG одним вызовом"""
+    if _turbo is not None:
+        return _turbo.encode(image, quality=quality)
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Не удалось закодировать JPEG")
+    return buffer.tobytes()
+
+
+def downscale(frame: np.ndarray, max_side: int = PREVIEW_MAX_SIDE) -> Tuple[np.ndarray, float]:
+    """Уменьшает кадр до max_side по длинной стороне; возвращает новую копию и масштаб"""
+    height, width = frame.shape[:2]
+    scale = min(1.0, max_side / max(height, width))
+    if scale >= 1.0:
+        return frame.copy(), 1.0
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA), scale
+
+
+def draw_crop(image: np.ndarray, crop: Tuple[int, int, int, int], border: int = BORDER_WIDTH) -> None:
+    """Затемняет все вне кропа и рисует рамку прямо в image"""
+    height, width = image.shape[:2]
+    crop_x, crop_y, crop_width, crop_height = crop
+    x0, y0 = max(0, crop_x), max(0, crop_y)
+    x1, y1 = min(width, crop_x + crop_width), min(height, crop_y + crop_height)
+
+    # Полупрозрачная черная маска = деление яркости пополам
+    image[:y0] >>= 1
+    image[y1:] >>= 1
+    image[y0:y1, :x0] >>= 1
+    image[y0:y1, x1:] >>= 1
+
+    image[y0:min(y0 + border, y1), x0:x1] = BORDER_COLOR
+    image[max(y1 - border, y0):y1, x0:x1] = BORDER_COLOR
+    image[y0:y1, x0:min(x0 + border, x1)] = BORDER_COLOR
+    image[y0:y1, max(x1 - border, x0):x1] = BORDER_COLOR
+
+
+def scale_crop(crop: Tuple[int, int, int, int], scale_x: float, scale_y: float) -> Tuple[int, int, int, int]:
+    """Переводит кроп из координат исходника в координаты уменьшенного кадра"""
+    crop_x, crop_y, crop_width, crop_height = crop
+    return (
+        round(crop_x * scale_x),
+        round(crop_y * scale_y),
+        round(crop_width * scale_x),
+        round(crop_height * scale_y),
+    )
+
+
+def render_crop_preview(
+    frame: np.ndarray,
+    crop: Tuple[int, int, int, int],
+    max_side: int = PREVIEW_MAX_SIDE,
+    quality: int = PREVIEW_QUALITY,
+) -> bytes:
+    """Превью кропа из BGR кадра: уменьшение, затемнение, рамка и один JPEG"""
+    image, scale = downscale(frame, max_side)
+    draw_crop(image, scale_crop(crop, scale, scale))
+    return encode_jpeg(image, quality)
+
+
+def render_contact_sheet(
+    frames: Sequence[np.ndarray],
+    crop: Tuple[int, int, int, int],
+    labels: Sequence[str],
+    quality: int = PREVIEW_QUALITY,
+) -> bytes:
+    """Кадры одного размера в ряд с кропом и подписью на каждом, один JPEG.
+
+    Кроп задается в координатах кадров; кадры не меняются.
+    """
+    height, width = frames[0].shape[:2]
+    sheet = np.zeros((height, len(frames) * (width + SHEET_GAP) - SHEET_GAP, 3), dtype=np.uint8)
+    border = max(1, BORDER_WIDTH * width // PREVIEW_MAX_SIDE)
+    scale = max(0.4, height / 640)
+    for i, (frame, label) in enumerate(zip(frames, labels)):
+        x = i * (width + SHEET_GAP)
+        cell = sheet[:, x:x + width]
+        cell[:] = frame
+        draw_crop(cell, crop, border)
+        origin = (6, height - 8)
+        cv2.putText(cell, label, origin, cv2.FONT_HERSHEY_SIMPLEX, scale, LABEL_SHADOW, 3, cv2.LINE_AA)
+        cv2.putText(cell, label, origin, cv2.FONT_HERSHEY_SIMPLEX, scale, LABEL_COLOR, 1, cv2.LINE_AA)
+    return encode_jpeg(sheet, quality)
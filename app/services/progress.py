@@ -0,0 +1,175 @@
+import asyncio
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, Message
+
+DURATION_PATTERN = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+@dataclass
+class Progress:
+    """Снимок прогресса ffmpeg из -progress"""
+    out_time: float = 0.0
+    fps: float = 0.0
+    speed: float = 0.0
+    total_size: int = 0
+    # Доля выполнения всего задания (с учетом нескольких проходов), 0..1
+    fraction: float = 0.0
+    done: bool = False
+
+
+def parse_duration(line: str) -> Optional[float]:
+    """Длительность входа из строки лога ffmpeg вида «Duration: 00:00:12.34»"""
+    match = DURATION_PATTERN.search(line)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+class ProgressParser:
+    """Собирает блоки key=value из -progress pipe:1 в снимки Progress"""
+
+    def __init__(self):
+        self._fields: Dict[str, str] = {}
+
+    def feed(self, line: str) -> Optional[Progress]:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return None
+        self._fields[key] = value
+        if key != "progress":
+            return None
+        fields, self._fields = self._fields, {}
+        return Progress(
+            out_time=_parse_out_time(fields),
+            fps=_to_float(fields.get("fps")),
+            speed=_to_float(fields.get("speed", "").rstrip("x")),
+            total_size=int(_to_float(fields.get("total_size"))),
+            done=value == "end",
+        )
+
+
+def _to_float(value: Optional[str]) -> float:
+    try:
+        return float(value) if value not in (None, "", "N/A") else 0.0
+    except ValueError:
+        return 0.0
+
+
+def _parse_out_time(fields: Dict[str, str]) -> float:
+    # out_time_us есть во всех версиях; out_time_ms исторически тоже в микросекундах
+    for key in ("out_time_us", "out_time_ms"):
+        micros = _to_float(fields.get(key))
+        if micros:
+            return micros / 1_000_000
+    return 0.0
+
+
+class ProgressStream:
+    """Асинхронный итератор по прогрессу задания.
+
+    Хранит только последний снимок: медленный потребитель пропускает
+    промежуточные значения, а не копит очередь.
+    """
+
+    def __init__(self):
+        self.latest: Optional[Progress] = None
+        self._changed = asyncio.Event()
+        self._closed = False
+
+    def publish(self, progress: Progress) -> None:
+        self.latest = progress
+        self._changed.set()
+
+    def close(self) -> None:
+        self._closed = True
+        self._changed.set()
+
+    def __aiter__(self) -> "ProgressStream":
+        return self
+
+    async def __anext__(self) -> Progress:
+        while True:
+            if self._changed.is_set():
+                self._changed.clear()
+                if self.latest is not None:
+                    return self.latest
+            if self._closed:
+                raise StopAsyncIteration
+            await self._changed.wait()
+
+
+class StatusReporter:
+    """Обновляет статусное сообщение реальным процентом и ETA.
+
+    Частота правок адаптивная: не чаще min_interval, а для долгих заданий
+    реже, примерно десять правок на все время работы. Одинаковый текст не
+    отправляется, а RetryAfter от Telegram увеличивает паузу.
+    """
+
+    def __init__(
+        self,
+        message: Message,
+        title: str,
+        reply_markup: Optional[InlineKeyboardMarkup] = None,
+        min_interval: float = 2.0,
+        max_interval: float = 10.0,
+    ):
+        self.message = message
+        self.title = title
+        self.reply_markup = reply_markup
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.stream = ProgressStream()
+        self._queue_position = 0
+        self._last_text = title
+        self._last_edit = 0.0
+        self._started = time.monotonic()
+
+    async def on_position(self, position: int) -> None:
+        """Колбэк планировщика: показывает место в очереди"""
+        self._queue_position = position
+        if position == 0:
+            self._started = time.monotonic()
+        await self._edit(self._render(self.stream.latest), force=True)
+
+    def _render(self, progress: Optional[Progress]) -> str:
+        if self._queue_position:
+            return f"{self.title}\n⏳ Место в очереди: {self._queue_position}"
+        if progress is None or progress.fraction <= 0:
+            return self.title
+        percent = min(99, int(progress.fraction * 100))
+        elapsed = time.monotonic() - self._started
+        eta = elapsed * (1 - progress.fraction) / progress.fraction
+        return f"{self.title} {percent}%\n⏱ Осталось ~{int(eta) + 1} с"
+
+    def _interval(self) -> float:
+        latest = self.stream.latest
+        if latest is None or latest.fraction <= 0:
+            return self.min_interval
+        total = (time.monotonic() - self._started) / latest.fraction
+        return max(self.min_interval, min(self.max_interval, total / 10))
+
+    async def _edit(self, text: str, force: bool = False) -> None:
+        if text == self._last_text:
+            return
+        if not force and time.monotonic() - self._last_edit < self._interval():
+            return
+        try:
+            await self.message.edit_text(text, reply_markup=self.reply_markup)
+            self._last_text = text
+        except TelegramRetryAfter as e:
+            self.min_interval = max(self.min_interval, float(e.retry_after))
+        except TelegramBadRequest:
+            pass
+        self._last_edit = time.monotonic()
+
+    async def run(self) -> None:
+        """Потребляет поток прогресса до его закрытия"""
+        async for progress in self.stream:
+            await self._edit(self._render(progress))
@@ -0,0 +1,46 @@
+import hashlib
+import json
+from dataclasses import asdict
+from typing import Any, Optional
+
+from app.models import Settings
+from app.services.cache import DiskCache
+
+DEFAULT_RESULT_CACHE_DIR = "/tmp/converter_results"
+
+_result_cache: Optional[DiskCache] = None
+
+
+def get_result_cache() -> DiskCache:
+    """Общий кеш готовых результатов кодирования"""
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = DiskCache(
+            DEFAULT_RESULT_CACHE_DIR, 512 * 1024 * 1024, name="result_cache", ttl=24 * 3600, spool=True
+        )
+    return _result_cache
+
+
+def configure_result_cache(root: str, max_bytes: int, ttl: Optional[float], enabled: bool = True) -> DiskCache:
+    """Пересоздает кеш результатов; enabled=False полностью его отключает"""
+    global _result_cache
+    _result_cache = DiskCache(root, max_bytes if enabled else 0, name="result_cache", ttl=ttl, spool=True)
+    return _result_cache
+
+
+def _canonical(value: Any) -> Any:
+    if isinstance(value, float):
+        # 0.1 + 0.2 и 0.3 должны давать один ключ
+        return round(value, 3)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items()}
+    return value
+
+
+def job_key(source_digest: str, settings: Settings, **params: Any) -> str:
+    """Ключ задания: хеш содержимого входа плюс каноническая запись параметров"""
+    payload = {"settings": asdict(settings), **params}
+    blob = json.dumps(_canonical(payload), sort_keys=True, separators=(",", ":"))
+    return f"{source_digest}:{hashlib.sha256(blob.encode('utf-8')).hexdigest()}"
@@ -0,0 +1,182 @@
+import asyncio
+import itertools
+import logging
+import os
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class Priority(IntEnum):
+    """Классы приоритета: меньшее значение обслуживается раньше"""
+    PREVIEW = 0
+    ENCODE = 1
+
+
+class _Waiter:
+    __slots__ = ("seq", "user_id", "priority", "future", "on_position", "position")
+
+    def __init__(self, seq: int, user_id: int, priority: Priority, on_position: Optional[PositionCallback]):
+        self.seq = seq
+        self.user_id = user_id
+        self.priority = priority
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = -1
+
+
+class EncodeScheduler:
+    """Ограниченный пул слотов для ffmpeg с честной очередью.
+
+    Внутри одного класса приоритета пользователи (chat id) обслуживаются
+    по кругу, так что десять загрузок одного человека не блокируют остальных.
+    """
+
+    def __init__(self, workers: Optional[int] = None, cpus: Optional[int] = None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.cpus = max(1, cpus or os.cpu_count() or 1)
+        self._seq = itertools.count()
+        # priority -> user_id -> очередь ожидающих; порядок ключей задает круг
+        self._queues: Dict[Priority, "OrderedDict[int, Deque[_Waiter]]"] = {
+            p: OrderedDict() for p in Priority
+        }
+        self._running: Dict[int, _Waiter] = {}
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for users in self._queues.values() for q in users.values())
+
+    def has_free_slot(self) -> bool:
+        """Получит ли новое задание слот сразу, без очереди"""
+        return self.running < self.workers and not self.queued
+
+    def thread_budget(self) -> int:
+        """Потоков на одно задание: ядра поровну между заданиями, которые
+        выполняются сейчас или получат слот следующими.
+
+        Бюджет считается при старте задания и потом не меняется, поэтому
+        первое задание всплеска может успеть занять все ядра.
+        """
+        jobs = min(self.workers, max(1, self.running + self.queued))
+        return max(1, self.cpus // jobs)
+
+    def _order(self) -> List[_Waiter]:
+        """Порядок, в котором ожидающие получат слоты"""
+        order: List[_Waiter] = []
+        for priority in Priority:
+            queues = [list(q) for q in self._queues[priority].values()]
+            depth = max((len(q) for q in queues), default=0)
+            for i in range(depth):
+                order.extend(q[i] for q in queues if i < len(q))
+        return order
+
+    def _next(self) -> Optional[_Waiter]:
+        for priority in Priority:
+            users = self._queues[priority]
+            if not users:
+                continue
+            user_id, queue = next(iter(users.items()))
+            waiter = queue.popleft()
+            # Пользователь уходит в конец круга
+            del users[user_id]
+            if queue:
+                users[user_id] = queue
+            return waiter
+        return None
+
+    def _remove(self, waiter: _Waiter) -> None:
+        users = self._queues[waiter.priority]
+        queue = users.get(waiter.user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        if not queue:
+            del users[waiter.user_id]
+
+    def _dispatch(self) -> None:
+        while len(self._running) < self.workers:
+            waiter = self._next()
+            if waiter is None:
+                break
+            self._running[waiter.seq] = waiter
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+            # Позиция 0 означает, что задача вышла из очереди и запущена
+            if waiter.on_position and waiter.position > 0:
+                asyncio.ensure_future(self._safe_notify(waiter.on_position, 0))
+            waiter.position = 0
+        self._notify_positions()
+
+    def _notify_positions(self) -> None:
+        """Сообщает ожидающим их новое место, если оно изменилось"""
+        for position, waiter in enumerate(self._order(), 1):
+            if waiter.position == position:
+                continue
+            waiter.position = position
+            if waiter.on_position:
+                asyncio.ensure_future(self._safe_notify(waiter.on_position, position))
+
+    @staticmethod
+    async def _safe_notify(callback: PositionCallback, position: int) -> None:
+        try:
+            await callback(position)
+        except Exception:
+            logger.debug("Не удалось сообщить позицию в очереди", exc_info=True)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_id: int = 0,
+        priority: Priority = Priority.ENCODE,
+        on_position: Optional[PositionCallback] = None,
+    ):
+        """Ждет своей очереди и удерживает слот на время работы ffmpeg.
+
+        Отмена задачи снимает ее из очереди или освобождает занятый слот.
+        """
+        waiter = _Waiter(next(self._seq), user_id, priority, on_position)
+        users = self._queues[priority]
+        users.setdefault(user_id, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except BaseException:
+            self._remove(waiter)
+            self._running.pop(waiter.seq, None)
+            self._dispatch()
+            raise
+        try:
+            yield
+        finally:
+            self._running.pop(waiter.seq, None)
+            self._dispatch()
+
+
+_scheduler: Optional[EncodeScheduler] = None
+
+
+def get_scheduler() -> EncodeScheduler:
+    """Общий планировщик процесса"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = EncodeScheduler()
+    return _scheduler
+
+
+def configure_scheduler(workers: Optional[int]) -> EncodeScheduler:
+    """Пересоздает общий планировщик с заданным числом слотов"""
+    global _scheduler
+    _scheduler = EncodeScheduler(workers)
+    return _scheduler
@@ -0,0 +1,77 @@
+import logging
+import os
+import shutil
+import tempfile
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_DIR = "/dev/shm"
+DEFAULT_SPOOL_MAX_BYTES = 256 * 1024 * 1024
+
+
+class Spool:
+    """Временные каталоги для выходов ffmpeg, которые только отправляются
+    и удаляются: в tmpfs, пока он укладывается в лимит памяти, иначе на диске.
+
+    Каталог резервирует ожидаемый размер выхода до своего удаления: каждый
+    выход считается по большему из резерва и уже записанного. Новый каталог
+    создается в tmpfs, если резерв укладывается и в лимит, и в реально
+    свободное место (за вычетом еще не записанной части чужих резервов).
+    """
+
+    def __init__(self, root: Optional[str], max_bytes: int):
+        self.root = root if root and os.path.isdir(root) and max_bytes > 0 else None
+        self.max_bytes = max_bytes
+        # Каталог -> зарезервированные байты
+        self._dirs: Dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None
+
+    def _usage(self) -> Tuple[int, int]:
+        """(занято с учетом резервов, еще не записанная часть резервов)"""
+        used = pending = 0
+        for directory, reserved in list(self._dirs.items()):
+            try:
+                written = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+            except FileNotFoundError:
+                # Каталог удален — резерв освобождается
+                del self._dirs[directory]
+                continue
+            used += max(written, reserved)
+            pending += max(0, reserved - written)
+        return used, pending
+
+    def used_bytes(self) -> int:
+        return self._usage()[0]
+
+    def mkdtemp(self, prefix: str, expected_bytes: int = 0) -> str:
+        """Каталог в tmpfs, если туда влезает еще expected_bytes, иначе в /tmp"""
+        if self.root is not None:
+            used, pending = self._usage()
+            free = shutil.disk_usage(self.root).free - pending
+            if used + expected_bytes <= self.max_bytes and expected_bytes < free:
+                directory = tempfile.mkdtemp(prefix=prefix, dir=self.root)
+                self._dirs[directory] = expected_bytes
+                return directory
+        return tempfile.mkdtemp(prefix=prefix)
+
+
+_spool: Optional[Spool] = None
+
+
+def get_spool() -> Spool:
+    global _spool
+    if _spool is None:
+        _spool = Spool(DEFAULT_SPOOL_DIR, DEFAULT_SPOOL_MAX_BYTES)
+    return _spool
+
+
+def configure_spool(root: Optional[str], max_bytes: int) -> Spool:
+    """Пустой root отключает tmpfs: все каталоги создаются в /tmp"""
+    global _spool
+    _spool = Spool(root, max_bytes)
+    logger.info("Выходы ffmpeg: %s", _spool.root or "на диске")
+    return _spool
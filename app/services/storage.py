@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+import sqlite3
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+
+class SqliteStorage(BaseStorage):
+    """FSM в файле SQLite.
+
+    Состояние и данные хранятся в JSON, поэтому сессию видят все процессы
+    на одной машине и она переживает перезапуск. Для нескольких машин
+    используйте Redis.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._key_builder = DefaultKeyBuilder(with_destiny=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}')"
+        )
+        self._lock = asyncio.Lock()
+
+    async def _run(self, fn, *args):
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def _load(self, key: str) -> Optional[tuple]:
+        return self._conn.execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+
+        def run(k: str):
+            self._conn.execute(
+                "INSERT INTO fsm (key, state) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+                (k, value),
+            )
+
+        await self._run(run, self._key_builder.build(key))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._run(self._load, self._key_builder.build(key))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        payload = json.dumps(data, ensure_ascii=False)
+
+        def run(k: str):
+            self._conn.execute(
+                "INSERT INTO fsm (key, data) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                (k, payload),
+            )
+
+        await self._run(run, self._key_builder.build(key))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._run(self._load, self._key_builder.build(key))
+        return json.loads(row[1]) if row else {}
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        # Чтение и запись в одной транзакции: другой процесс не вклинится между ними
+        def run(k: str) -> Dict[str, Any]:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._load(k)
+                current = json.loads(row[1]) if row else {}
+                current.update(data)
+                self._conn.execute(
+                    "INSERT INTO fsm (key, data) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                    (k, json.dumps(current, ensure_ascii=False)),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return current
+
+        return (await self._run(run, self._key_builder.build(key))).copy()
+
+    async def close(self) -> None:
+        self._conn.close()
+
+
+def create_fsm_storage(url: str) -> BaseStorage:
+    """memory, sqlite:<путь> или redis://..."""
+    if url == "memory":
+        return MemoryStorage()
+    if url.startswith("sqlite:"):
+        return SqliteStorage(url[len("sqlite:"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        # Необязательная зависимость: нужна только для Redis
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        return RedisStorage.from_url(url, key_builder=DefaultKeyBuilder(with_destiny=True))
+    raise ValueError(f"Неизвестное хранилище FSM: {url}")
@@ -1,25 +1,173 @@
 import os
+import re
+import bisect
+import shutil
+import subprocess
 import tempfile
 import cv2
+import numpy as np
 import asyncio
+import aiohttp
 import yt_dlp
 import logging
-from PIL import Image, ImageDraw
-from typing import Tuple, Optional
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Sequence, Tuple, Optional
 from pathlib import Path
 
+from app.services.cache import DiskCache
+from app.services.converter import Converter, Output, find_ffprobe
+from app.services.encoders import useful_threads
+from app.services.ingest import STREAM_HEAD_LIMIT, is_streamable
+from app.services.metrics import metrics
+from app.services.predictor import EncodeFeatures
+from app.services.progress import parse_duration
+from app.services.preview import encode_jpeg, render_contact_sheet, render_crop_preview, scale_crop
+from app.services.scheduler import Priority, get_scheduler
+
+logger = logging.getLogger(__name__)
+
 # Настраиваем логирование для yt-dlp
 logging.getLogger('yt_dlp').setLevel(logging.WARNING)
 
+# Канонический id видео в полной ссылке TikTok
+TIKTOK_ID_PATTERN = re.compile(r'/(?:video|photo)/(\d+)')
+TIKTOK_SHORT_HOSTS = ("vm.tiktok.com", "vt.tiktok.com")
+DEFAULT_DOWNLOAD_CACHE_DIR = "/tmp/tiktok_downloads"
+# Сколько кадров можно дочитать вперед вместо перемотки, если индекса нет
+FORWARD_READ_FRAMES = 12
+# Запас после выбранного отрезка в рабочей вырезке, секунды
+WORKING_MARGIN = 0.5
+# Длинная сторона прокси: как у превью, уменьшать не нужно
+PROXY_MAX_SIDE = 640
+# Частота кадров прокси всего видео: шаг редактора времени 0.1 s
+PROXY_FPS = 10
+# Лента миниатюр для редактора времени: длинная сторона кадра и память
+# на одно видео; у длинных видео шаг ленты растет, чтобы уложиться в лимит
+STRIP_MAX_SIDE = 320
+DEFAULT_STRIP_CACHE_MB = 24
+# Оценка сложности отрезка перед кодированием: сколько точек отрезка,
+# шаг между кадрами пары для оценки движения и размер кадра для статистики
+PROBE_SAMPLES = 8
+PROBE_STEP = 0.1
+PROBE_SIDE = 160
+# Смена сцены: средний скачок яркости между соседними точками больше
+# SCENE_CUT и во столько раз больше движения внутри пар
+SCENE_CUT = 25.0
+SCENE_MOTION_RATIO = 6.0
+# Сколько оценок (отрезок, кроп) помнить на одно видео
+PROBE_CACHE_SIZE = 32
+# Поточная загрузка: протоколы, которые читаются напрямую по HTTP, размер
+# куска
+STREAM_PROTOCOLS = ("http", "https")
+STREAM_CHUNK = 256 * 1024
+# Сколько байт может ждать ffmpeg в памяти, прежде чем загрузка притормозит
+STREAM_BUFFER = 32 * 1024 * 1024
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+_download_cache: Optional[DiskCache] = None
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая сессия aiohttp: соединения с TikTok и CDN переиспользуются между загрузками"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+            headers={"User-Agent": USER_AGENT},
+        )
+    return _http_session
+
+
+async def close_http_session() -> None:
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+def get_download_cache() -> DiskCache:
+    """Общий кеш загруженных видео"""
+    global _download_cache
+    if _download_cache is None:
+        _download_cache = DiskCache(DEFAULT_DOWNLOAD_CACHE_DIR, 1024 * 1024 * 1024, name="download_cache")
+    return _download_cache
+
+
+def configure_download_cache(root: str, max_bytes: int) -> DiskCache:
+    """Пересоздает кеш загрузок с заданными каталогом и лимитом"""
+    global _download_cache
+    _download_cache = DiskCache(root, max_bytes, name="download_cache")
+    return _download_cache
+
+
+async def resolve_video_id(url: str) -> Optional[str]:
+    """Определяет канонический id видео, раскрывая короткие vm./vt. ссылки"""
+    match = TIKTOK_ID_PATTERN.search(url)
+    if match:
+        return match.group(1)
+    if not url.startswith("http"):
+        url = "https://" + url
+    if not any(host in url for host in TIKTOK_SHORT_HOSTS):
+        return None
+    try:
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with get_http_session().head(url, allow_redirects=True, timeout=timeout) as resp:
+            match = TIKTOK_ID_PATTERN.search(str(resp.url))
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+    return match.group(1) if match else None
+
+
+@dataclass
+class StreamHead:
+    """Параметры видео, прочитанные из начала потока, до конца загрузки"""
+    width: int
+    height: int
+    duration: float
+
+
+HeadCallback = Callable[[StreamHead], Awaitable[None]]
+
 
 class TikTokDownloader:
     def __init__(self):
         self.temp_dir = None
+        self.video_id: Optional[str] = None
+        # Прокси, построенная во время поточной загрузки (забирает редактор)
+        self.proxy_path: Optional[str] = None
         
-    async def download_video(self, url: str) -> str:
-        """Загружает видео с TikTok и возвращает путь к файлу"""
-        self.temp_dir = tempfile.mkdtemp(prefix="tiktok_")
+    async def download_video(self, url: str, on_head: Optional[HeadCallback] = None, user_id: int = 0) -> str:
+        """Загружает видео с TikTok и возвращает путь к файлу.
         
+        on_head вызывается, как только из начала потока прочитаны размеры
+        и длительность (только при поточной загрузке, когда прокси строится
+        по ходу загрузки). user_id — для очереди планировщика.
+        """
+        cache = get_download_cache()
+        video_id = await resolve_video_id(url) if cache.enabled else None
+        if not video_id:
+            self.temp_dir = tempfile.mkdtemp(prefix="tiktok_")
+            return await self._download(url, self.temp_dir, on_head, user_id)
+        
+        # Одно и то же видео скачивается один раз, даже если его прислали одновременно
+        path = await cache.get_or_create(video_id, lambda target_dir: self._download(url, target_dir, on_head, user_id))
+        cache.pin(video_id)
+        self.video_id = video_id
+        return path
+    
+    def take_proxy(self) -> Optional[str]:
+        """Отдает прокси редактору: дальше ее каталог удаляет он"""
+        path, self.proxy_path = self.proxy_path, None
+        return path
+    
+    async def _download(
+        self, url: str, target_dir: str, on_head: Optional[HeadCallback] = None, user_id: int = 0
+    ) -> str:
+        """Скачивает видео в target_dir: поточно по прямой ссылке, если
+        yt-dlp ее дал, иначе загрузчиком yt-dlp"""
         # Список форматов для попытки загрузки (от лучшего к худшему)
         format_options = [
             'best[height<=720][ext=mp4]',  # Лучшее качество MP4 до 720p
@@ -29,24 +177,43 @@ class TikTokDownloader:
             'worst'                        # В крайнем случае - худшее качество
         ]
         
+        def options(fmt: str) -> dict:
+            return {
+                'outtmpl': os.path.join(target_dir, '%(id)s.%(ext)s'),
+                'format': fmt,
+                'no_warnings': True,
+                'ignoreerrors': False,
+                'cookiefile': None,
+                'user_agent': USER_AGENT,
+                'referer': 'https://www.tiktok.com/',
+                'extractor_retries': 3,
+                'fragment_retries': 3,
+                'skip_unavailable_fragments': True,
+            }
+        
+        def extract():
+            """Прямая ссылка на файл и заголовки (с cookies) для запроса"""
+            last_error = None
+            for fmt in format_options:
+                try:
+                    with yt_dlp.YoutubeDL(options(fmt)) as ydl:
+                        info = ydl.extract_info(url, download=False)
+                        headers = dict(info.get('http_headers') or {})
+                        if info.get('url'):
+                            cookies = ydl.cookiejar.get_cookie_header(info['url'])
+                            if cookies:
+                                headers['Cookie'] = cookies
+                    return info, headers
+                except Exception as e:
+                    last_error = e
+                    continue
+            raise last_error
+        
         def download():
             last_error = None
             for fmt in format_options:
                 try:
-                    ydl_opts = {
-                        'outtmpl': os.path.join(self.temp_dir, '%(title)s.%(ext)s'),
-                        'format': fmt,
-                        'no_warnings': True,
-                        'ignoreerrors': False,
-                        'cookiefile': None,
-                        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                        'referer': 'https://www.tiktok.com/',
-                        'extractor_retries': 3,
-                        'fragment_retries': 3,
-                        'skip_unavailable_fragments': True,
-                    }
-                    
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    with yt_dlp.YoutubeDL(options(fmt)) as ydl:
                         ydl.download([url])
                     return  # Успешная загрузка
                 except Exception as e:
@@ -57,26 +224,137 @@ class TikTokDownloader:
             if last_error:
                 raise last_error
         
-        # Запускаем загрузку в отдельном потоке
         loop = asyncio.get_event_loop()
+        info, headers = await loop.run_in_executor(None, extract)
+        if info.get('protocol') in STREAM_PROTOCOLS and info.get('url'):
+            try:
+                return await self._stream(info, headers, target_dir, on_head, user_id)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                logger.warning("Поточная загрузка %s не удалась, качаем через yt-dlp: %s", url, e)
+                for partial in Path(target_dir).glob("*.part"):
+                    partial.unlink(missing_ok=True)
+        
+        # Запускаем загрузку в отдельном потоке
         await loop.run_in_executor(None, download)
         
         # Найдем загруженный файл
-        files = list(Path(self.temp_dir).glob("*"))
+        files = [f for f in Path(target_dir).glob("*") if f.is_file() and not f.name.endswith(".part")]
         if not files:
             raise ValueError("Не удалось загрузить видео")
         
         return str(files[0])
     
+    async def _stream(
+        self, info: dict, headers: dict, target_dir: str, on_head: Optional[HeadCallback], user_id: int = 0
+    ) -> str:
+        """Качает файл по общему HTTP-соединению и, если формат позволяет и
+        у планировщика есть свободный слот, сразу отдает байты ffmpeg:
+        размеры и прокси готовы к концу загрузки"""
+        ext = info.get('ext') or "mp4"
+        path = os.path.join(target_dir, f"{info.get('id') or 'video'}.{ext}")
+        partial = path + ".part"
+        proxy: Optional[StreamingProxy] = None
+        head = b""
+        streamable: Optional[bool] = None
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+        try:
+            async with get_http_session().get(info['url'], headers=headers, timeout=timeout) as resp:
+                resp.raise_for_status()
+                with open(partial, "wb") as f:
+                    async for chunk in resp.content.iter_chunked(STREAM_CHUNK):
+                        f.write(chunk)
+                        if proxy is not None:
+                            await proxy.feed(chunk)
+                        elif streamable is None:
+                            head += chunk
+                            streamable = is_streamable(head, ext)
+                            if streamable is None and len(head) >= STREAM_HEAD_LIMIT:
+                                streamable = False
+                            if streamable:
+                                proxy = StreamingProxy(on_head)
+                                if await proxy.start(user_id):
+                                    await proxy.feed(head)
+                                else:
+                                    # Все слоты заняты: прокси построится после загрузки
+                                    await proxy.abort()
+                                    proxy = None
+                            if streamable is not None:
+                                head = b""
+                                kind = "file" if not streamable else "piped" if proxy else "busy"
+                                metrics.inc(f"download.stream.{kind}")
+            if proxy is not None:
+                self.proxy_path = await proxy.finish()
+                proxy = None
+        finally:
+            if proxy is not None:
+                await proxy.abort()
+        os.replace(partial, path)
+        return path
+    
     def cleanup(self):
         """Очистка временных файлов"""
+        if self.video_id:
+            # Файл остается в кеше, просто перестаем его удерживать
+            get_download_cache().unpin(self.video_id)
+            self.video_id = None
+        if self.proxy_path:
+            shutil.rmtree(os.path.dirname(self.proxy_path), ignore_errors=True)
+            self.proxy_path = None
         if self.temp_dir and os.path.exists(self.temp_dir):
-            import shutil
             shutil.rmtree(self.temp_dir, ignore_errors=True)
 
+    def to_state(self) -> dict:
+        """Сериализуемое состояние для FSM"""
+        return {"video_id": self.video_id, "temp_dir": self.temp_dir}
+
+    @classmethod
+    def from_state(cls, state: Optional[dict]) -> "TikTokDownloader":
+        """Восстанавливает загрузчик из FSM, чтобы любой процесс мог выполнить cleanup"""
+        downloader = cls()
+        if state:
+            downloader.video_id = state.get("video_id")
+            downloader.temp_dir = state.get("temp_dir")
+        return downloader
+
+
+def build_keyframe_index(video_path: str) -> Tuple[List[float], List[int]]:
+    """Читает метки времени всех кадров и номера ключевых кадров без декодирования.
+
+    ffprobe разбирает только пакеты контейнера, поэтому это быстро даже
+    для длинных видео. Если ffprobe нет, возвращает пустые списки.
+    """
+    ffprobe = find_ffprobe()
+    if not ffprobe:
+        return [], []
+    try:
+        result = subprocess.run(
+            [
+                ffprobe, "-v", "error",
+                "-select_streams", "v:0",
+                "-show_entries", "packet=pts_time,flags",
+                "-of", "csv=p=0",
+                video_path,
+            ],
+            capture_output=True, text=True, timeout=30,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return [], []
+    packets = []
+    for line in result.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        try:
+            packets.append((float(pts), "K" in flags))
+        except ValueError:
+            continue
+    # Пакеты идут в порядке декодирования, кадры нумеруются в порядке показа
+    packets.sort()
+    timestamps = [pts for pts, _ in packets]
+    keyframes = [i for i, (_, is_key) in enumerate(packets) if is_key]
+    return timestamps, keyframes
+
 
 class VideoEditor:
-    def __init__(self, video_path: str):
+    def __init__(self, video_path: str, frame_cache_bytes: Optional[int] = None):
         self.video_path = video_path
         self.cap = cv2.VideoCapture(video_path)
         self.fps = self.cap.get(cv2.CAP_PROP_FPS)
@@ -84,82 +362,281 @@ class VideoEditor:
         self.duration = self.frame_count / self.fps if self.fps > 0 else 0
         self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    
-    def get_frame_at_time(self, time_seconds: float) -> Optional[bytes]:
-        """Получает кадр в заданное время в виде JPEG байтов"""
-        frame_number = int(time_seconds * self.fps)
-        if frame_number >= self.frame_count:
-            frame_number = self.frame_count - 1
         
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-        ret, frame = self.cap.read()
+        # Индекс кадров строится один раз при открытии
+        self.timestamps, self.keyframes = build_keyframe_index(video_path)
         
-        if not ret:
+        # LRU кеш декодированных кадров с ограничением по памяти
+        if frame_cache_bytes is None:
+            frame_cache_bytes = int(os.getenv("FRAME_CACHE_MB", "64")) * 1024 * 1024
+        self.frame_cache_bytes = frame_cache_bytes
+        self._frames: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._frames_bytes = 0
+        self.frame_hits = 0
+        self.frame_misses = 0
+        # Номер кадра, который вернет следующий cap.read()
+        self._next_frame = 0
+        # Прокси выбранного отрезка: (начало, конец, редактор прокси)
+        self._window: Optional[Tuple[float, float, "VideoEditor"]] = None
+        # Уменьшенная копия всего видео для интерактивных превью
+        self._proxy: Optional["VideoEditor"] = None
+        # Лента миниатюр (кадр, высота, ширина, 3) с шагом _strip_interval секунд
+        self._strip: Optional[np.ndarray] = None
+        self._strip_interval = 0.0
+        # Оценки сложности по (начало, длительность, кроп)
+        self._probes: "OrderedDict[tuple, EncodeFeatures]" = OrderedDict()
+    
+    def keyframe_time_before(self, time_seconds: float) -> Optional[float]:
+        """Время ближайшего ключевого кадра не позже time_seconds (None без индекса)"""
+        if not self.keyframes:
             return None
+        number = self.frame_number_at(time_seconds)
+        keyframe = self.keyframes[max(0, bisect.bisect_right(self.keyframes, number) - 1)]
+        return self.timestamps[keyframe] - self.timestamps[0]
+    
+    def attach_window(self, working_copy: "WorkingCopy") -> None:
+        """Кадры внутри отрезка рабочей копии дальше берутся из ее прокси"""
+        proxy = VideoEditor(working_copy.proxy_path, frame_cache_bytes=self.frame_cache_bytes // 4)
+        if proxy.frame_count <= 0:
+            return
+        self._window = (working_copy.start, working_copy.end, proxy)
+    
+    def attach_proxy(self, proxy_path: str) -> None:
+        """Дальше превью берут кадры из уменьшенной копии всего видео"""
+        proxy = VideoEditor(proxy_path, frame_cache_bytes=self.frame_cache_bytes // 4)
+        if proxy.frame_count > 0:
+            self._proxy = proxy
+    
+    @property
+    def has_proxy(self) -> bool:
+        return self._proxy is not None
+    
+    @property
+    def has_strip(self) -> bool:
+        return self._strip is not None
+    
+    @property
+    def has_small_frames(self) -> bool:
+        """Есть ли уменьшенные кадры (лента или прокси), чтобы probe_content
+        не перематывал исходник в полном разрешении"""
+        return self._strip is not None or self._proxy is not None or self._window is not None
+    
+    def build_strip(self, max_side: int = STRIP_MAX_SIDE, max_bytes: Optional[int] = None) -> None:
+        """Читает прокси подряд и складывает кадры в один массив миниатюр.
         
-        # Конвертируем в RGB для PIL
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        
-        # Конвертируем в PIL Image
-        pil_image = Image.fromarray(frame_rgb)
+        Прокси снята с шагом 1/PROXY_FPS, так что лента покрывает видео с
+        тем же шагом (реже, если не влезает в max_bytes). Файл прокси
+        открывается отдельно, поэтому превью не ждут построения ленты.
+        """
+        if self._proxy is None:
+            return
+        if max_bytes is None:
+            max_bytes = int(os.getenv("STRIP_CACHE_MB", str(DEFAULT_STRIP_CACHE_MB))) * 1024 * 1024
+        proxy = self._proxy
+        scale = min(1.0, max_side / max(proxy.width, proxy.height))
+        size = (max(1, round(proxy.width * scale)), max(1, round(proxy.height * scale)))
+        frame_bytes = size[0] * size[1] * 3
+        step = max(1, -(-proxy.frame_count * frame_bytes // max(1, max_bytes)))
+        strip = np.empty((-(-proxy.frame_count // step), size[1], size[0], 3), dtype=np.uint8)
+        cap = cv2.VideoCapture(proxy.video_path)
+        count = 0
+        try:
+            for number in range(proxy.frame_count):
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                if number % step == 0 and count < len(strip):
+                    cv2.resize(frame, size, dst=strip[count], interpolation=cv2.INTER_AREA)
+                    count += 1
+        finally:
+            cap.release()
+        if count:
+            self._strip_interval = step / proxy.fps
+            self._strip = strip[:count]
+            logger.info(
+                "Лента миниатюр %s: %d кадров с шагом %.2f s, %.1f MB",
+                self.video_path, count, self._strip_interval, self._strip.nbytes / 1024 / 1024,
+            )
+    
+    def _strip_frame(self, time_seconds: float) -> np.ndarray:
+        index = round(time_seconds / self._strip_interval)
+        return self._strip[max(0, min(len(self._strip) - 1, index))]
+    
+    def create_contact_sheet(self, start_time: float, duration: float, crop_params: Tuple[int, int, int, int]) -> Optional[bytes]:
+        """Первый, средний и последний кадры отрезка на одном фото, из ленты без декодирования"""
+        strip = self._strip
+        if strip is None:
+            return None
+        end_time = min(start_time + duration, self.duration) - self._strip_interval
+        times = [start_time, start_time + duration / 2, max(start_time, end_time)]
+        frames = [self._strip_frame(t) for t in times]
+        crop = scale_crop(crop_params, strip.shape[2] / self.width, strip.shape[1] / self.height)
+        return render_contact_sheet(frames, crop, [f"{t:.1f}s" for t in times])
+    
+    def _preview_frame(self, time_seconds: float) -> Tuple[Optional[np.ndarray], float, float]:
+        """Кадр для превью и масштаб координат исходника в координаты кадра.
         
-        # Сохраняем в байты
-        import io
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format='JPEG', quality=85)
-        return buffer.getvalue()
+        Порядок: прокси выбранного отрезка (все кадры), прокси всего видео,
+        и только если их еще нет — исходник в полном разрешении.
+        """
+        sources = []
+        if self._window:
+            start, end, proxy = self._window
+            if start <= time_seconds <= end:
+                sources.append((proxy, time_seconds - start))
+        if self._proxy:
+            sources.append((self._proxy, time_seconds))
+        for proxy, proxy_time in sources:
+            frame = proxy.get_frame_array(proxy_time)
+            if frame is not None:
+                return frame, proxy.width / self.width, proxy.height / self.height
+        return self.get_frame_array(time_seconds), 1.0, 1.0
     
-    def create_crop_preview(self, crop_x: int, crop_y: int, crop_width: int, crop_height: int, time_seconds: float = 0) -> Optional[bytes]:
-        """Создает превью с красным квадратом обрезки"""
-        frame_bytes = self.get_frame_at_time(time_seconds)
-        if not frame_bytes:
+    def frame_number_at(self, time_seconds: float) -> int:
+        """Номер кадра, показываемого в заданное время"""
+        if self.timestamps:
+            number = bisect.bisect_right(self.timestamps, self.timestamps[0] + time_seconds) - 1
+        else:
+            number = int(time_seconds * self.fps)
+        return max(0, min(number, self.frame_count - 1))
+    
+    def _can_read_forward(self, frame_number: int) -> bool:
+        if not self._next_frame <= frame_number:
+            return False
+        if not self.keyframes:
+            # Без индекса дочитываем только совсем короткие расстояния
+            return frame_number - self._next_frame <= FORWARD_READ_FRAMES
+        # Если цель в том же GOP впереди текущей позиции, перемотка все равно
+        # начала бы декодирование с того же ключевого кадра
+        keyframe = self.keyframes[max(0, bisect.bisect_right(self.keyframes, frame_number) - 1)]
+        return keyframe <= self._next_frame
+    
+    def _decode(self, frame_number: int) -> Optional[np.ndarray]:
+        """Декодирует кадр, по возможности без перемотки"""
+        if not self._can_read_forward(frame_number):
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            self._next_frame = frame_number
+        while self._next_frame < frame_number:
+            if not self.cap.grab():
+                return None
+            self._next_frame += 1
+        ret, frame = self.cap.read()
+        if not ret:
             return None
+        self._next_frame = frame_number + 1
+        return frame
+    
+    def get_frame_array(self, time_seconds: float) -> Optional[np.ndarray]:
+        """Кадр в заданное время как BGR массив; повторные запросы берутся из кеша"""
+        frame_number = self.frame_number_at(time_seconds)
+        frame = self._frames.get(frame_number)
+        if frame is not None:
+            self._frames.move_to_end(frame_number)
+            self.frame_hits += 1
+            metrics.inc("frame_cache.hits")
+            return frame
         
-        # Загружаем изображение
-        from io import BytesIO
-        image = Image.open(BytesIO(frame_bytes))
+        self.frame_misses += 1
+        metrics.inc("frame_cache.misses")
+        frame = self._decode(frame_number)
+        if frame is None:
+            return None
         
-        # Создаем копию для рисования
-        draw_image = image.copy()
-        draw = ImageDraw.Draw(draw_image)
+        # Кеш только для чтения: вызывающие рисуют на копиях
+        frame.setflags(write=False)
+        self._frames[frame_number] = frame
+        self._frames_bytes += frame.nbytes
+        while self._frames_bytes > self.frame_cache_bytes and len(self._frames) > 1:
+            _, evicted = self._frames.popitem(last=False)
+            self._frames_bytes -= evicted.nbytes
+        return frame
+    
+    def probe_content(
+        self, start_time: float, duration: float, crop_params: Optional[Tuple[int, int, int, int]] = None
+    ) -> EncodeFeatures:
+        """Быстрая оценка сложности отрезка перед кодированием.
         
-        # Рисуем красный прямоугольник
-        draw.rectangle(
-            [crop_x, crop_y, crop_x + crop_width, crop_y + crop_height],
-            outline='red',
-            width=3
-        )
+        В PROBE_SAMPLES точках отрезка берутся пары кадров с шагом
+        PROBE_STEP из ленты миниатюр (а без нее — из превью), кроп
+        уменьшается до PROBE_SIDE. По ним считаются детализация (градиент
+        яркости), движение (разница кадров пары) и смены сцен (скачок между
+        соседними точками, которого не объясняет движение). Результат
+        кешируется по отрезку и кропу.
+        """
+        key = (round(start_time, 2), round(duration, 2), tuple(crop_params) if crop_params else None)
+        cached = self._probes.get(key)
+        if cached is not None:
+            self._probes.move_to_end(key)
+            return cached
         
-        # Затемняем области вне кропа
-        # Создаем маску
-        mask = Image.new('RGBA', image.size, (0, 0, 0, 128))
-        mask_draw = ImageDraw.Draw(mask)
+        step = PROBE_STEP
+        if self._strip is not None:
+            # Кадры пары не должны попасть в одну миниатюру
+            step = max(step, self._strip_interval)
+        end = max(start_time, min(start_time + duration, self.duration) - step)
+        times = [start_time + (end - start_time) * i / (PROBE_SAMPLES - 1) for i in range(PROBE_SAMPLES)]
+        pairs = []
+        for t in times:
+            if self._strip is not None:
+                frames = [self._strip_frame(t), self._strip_frame(t + step)]
+                scale = (self._strip.shape[2] / self.width, self._strip.shape[1] / self.height)
+            else:
+                (first, sx, sy), (second, _, _) = self._preview_frame(t), self._preview_frame(t + step)
+                if first is None or second is None:
+                    continue
+                frames, scale = [first, second], (sx, sy)
+            if crop_params:
+                x, y, w, h = scale_crop(crop_params, *scale)
+                frames = [f[max(0, y):y + h, max(0, x):x + w] for f in frames]
+            pairs.append([self._probe_gray(f) for f in frames])
         
-        # Рисуем прозрачную область в месте кропа
-        mask_draw.rectangle(
-            [crop_x, crop_y, crop_x + crop_width, crop_y + crop_height],
-            fill=(0, 0, 0, 0)
-        )
+        spatial = temporal = 0.0
+        scene_changes = 0
+        if pairs:
+            # (точка, кадр пары, высота, ширина)
+            grays = np.stack([np.stack(pair) for pair in pairs]).astype(np.int16)
+            first = grays[:, 0]
+            spatial = float((np.abs(np.diff(first, axis=1)).mean() + np.abs(np.diff(first, axis=2)).mean()) / 2)
+            # Движение за PROBE_STEP, даже если пара взята с большим шагом
+            motion = np.abs(grays[:, 1] - first).mean(axis=(1, 2)) * PROBE_STEP / step
+            temporal = float(motion.mean())
+            jumps = np.abs(np.diff(first, axis=0)).mean(axis=(1, 2))
+            expected = np.maximum(np.maximum(motion[:-1], motion[1:]), 1.0) * SCENE_MOTION_RATIO
+            scene_changes = int(np.count_nonzero((jumps > SCENE_CUT) & (jumps > expected)))
+        source_bitrate = 0
+        if self.duration > 0 and os.path.exists(self.video_path):
+            source_bitrate = int(os.path.getsize(self.video_path) * 8 / self.duration)
+        features = EncodeFeatures(source_bitrate, spatial, temporal, scene_changes)
         
-        # Применяем маску
-        if draw_image.mode != 'RGBA':
-            draw_image = draw_image.convert('RGBA')
+        self._probes[key] = features
+        if len(self._probes) > PROBE_CACHE_SIZE:
+            self._probes.popitem(last=False)
+        return features
+    
+    @staticmethod
+    def _probe_gray(frame: np.ndarray) -> np.ndarray:
+        height, width = frame.shape[:2]
+        scale = min(1.0, PROBE_SIDE / max(1, height, width))
+        size = (max(2, round(width * scale)), max(2, round(height * scale)))
+        return cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    
+    def get_frame_at_time(self, time_seconds: float) -> Optional[bytes]:
+        """Получает кадр в заданное время в виде JPEG байтов"""
+        frame = self.get_frame_array(time_seconds)
         
-        draw_image = Image.alpha_composite(draw_image, mask)
-        draw_image = draw_image.convert('RGB')
+        if frame is None:
+            return None
         
-        # Снова рисуем красную рамку поверх всего
-        draw = ImageDraw.Draw(draw_image)
-        draw.rectangle(
-            [crop_x, crop_y, crop_x + crop_width, crop_y + crop_height],
-            outline='red',
-            width=3
-        )
+        return encode_jpeg(frame)
+    
+    def create_crop_preview(self, crop_x: int, crop_y: int, crop_width: int, crop_height: int, time_seconds: float = 0) -> Optional[bytes]:
+        """Создает превью с красным квадратом обрезки"""
+        frame, scale_x, scale_y = self._preview_frame(time_seconds)
+        if frame is None:
+            return None
         
-        # Сохраняем в байты
-        buffer = BytesIO()
-        draw_image.save(buffer, format='JPEG', quality=85)
-        return buffer.getvalue()
+        # Рисуем на уменьшенной копии кешированного кадра и кодируем один раз
+        return render_crop_preview(frame, scale_crop((crop_x, crop_y, crop_width, crop_height), scale_x, scale_y))
     
     def calculate_crop_bounds(self, crop_width: int, crop_height: int) -> Tuple[int, int, int, int]:
         """Вычисляет границы кропа по центру видео"""
@@ -180,7 +657,10 @@ class VideoEditor:
     def create_time_preview(self, start_time: float, duration: float, crop_params: Tuple[int, int, int, int]) -> Optional[bytes]:
         """Создает превью временного отрезка"""
         try:
-            # Берем кадр из середины выбранного отрезка
+            if self._strip is not None:
+                return self.create_contact_sheet(start_time, duration, crop_params)
+            
+            # Пока ленты нет, берем кадр из середины выбранного отрезка
             middle_time = start_time + duration / 2
             
             # Убеждаемся, что время в пределах видео
@@ -215,37 +695,213 @@ class VideoEditor:
             'frame_count': self.frame_count
         }
     
-    async def create_video_preview(self, start_time: float, duration: float, crop_params: Tuple[int, int, int, int], output_path: str) -> bool:
-        """Создает короткое превью видео"""
+    async def create_video_preview(
+        self,
+        start_time: float,
+        duration: float,
+        crop_params: Tuple[int, int, int, int],
+        output_path: str,
+        user_id: int = 0,
+        extra_outputs: Sequence[Output] = (),
+        input_path: Optional[str] = None,
+    ) -> bool:
+        """Создает короткое превью видео.
+
+        extra_outputs кодируются тем же вызовом ffmpeg из того же
+        декодированного отрезка (например, итоговый webm заранее).
+        input_path — рабочая вырезка вместо исходника; start_time тогда
+        отсчитывается от ее начала.
+        """
         try:
-            crop_x, crop_y, crop_width, crop_height = crop_params
-            
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-ss", str(start_time),
-                "-t", str(min(duration, 2.0)),  # Максимум 2 секунды для превью
-                "-i", self.video_path,
-                "-vf", f"crop={crop_width}:{crop_height}:{crop_x}:{crop_y}",
-                "-r", "15",  # Низкий FPS для превью
-                "-crf", "35",  # Низкое качество для превью
-                "-an",  # Без аудио
-                output_path
-            ]
-            
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+            preview = Output(
+                path=output_path,
+                # Максимум 2 секунды для превью
+                filters=f"trim=duration={min(duration, 2.0)},setpts=PTS-STARTPTS",
+                args=[
+                    "-r", "15",  # Низкий FPS для превью
+                    "-crf", "35",  # Низкое качество для превью
+                    "-an",  # Без аудио
+                ],
             )
             
-            stdout, stderr = await process.communicate()
+            # Превью идет через общий планировщик вне очереди полных кодирований
+            await Converter().encode_outputs(
+                input_path or self.video_path,
+                [preview, *extra_outputs],
+                start_time=start_time,
+                duration=duration if extra_outputs else min(duration, 2.0),
+                crop=crop_params,
+                user_id=user_id,
+                priority=Priority.PREVIEW,
+                max_threads=useful_threads(crop_params[2], crop_params[3]),
+            )
             
-            return process.returncode == 0 and os.path.exists(output_path)
+            return os.path.exists(output_path)
         except Exception as e:
             print(f"DEBUG: Error creating video preview: {e}")
             return False
     
     def __del__(self):
         if hasattr(self, 'cap') and self.cap:
-            self.cap.release()
\ No newline at end of file
+            self.cap.release()
+
+
+@dataclass
+class WorkingCopy:
+    """Вырезка выбранного отрезка без перекодирования и ее легкая прокси.
+
+    start и end — положение вырезки в исходном видео, секунды.
+    """
+    path: str
+    proxy_path: str
+    start: float
+    end: float
+
+
+async def cut_working_copy(
+    editor: VideoEditor, start_time: float, duration: float, out_dir: str, user_id: int = 0
+) -> Optional[WorkingCopy]:
+    """Вырезает отрезок копированием потоков от ближайшего ключевого кадра
+    и делает из вырезки прокси из одних ключевых кадров (MJPEG) для
+    быстрых превью. Без индекса ключевых кадров возвращает None.
+    """
+    start = editor.keyframe_time_before(start_time)
+    if start is None:
+        return None
+    end = min(editor.duration, start_time + duration + WORKING_MARGIN)
+    path = os.path.join(out_dir, "excerpt" + (Path(editor.video_path).suffix or ".mp4"))
+    proxy_path = os.path.join(out_dir, "proxy.avi")
+    converter = Converter()
+    await converter.run(
+        [
+            "-y",
+            "-ss", str(start),
+            "-i", editor.video_path,
+            "-t", str(end - start),
+            "-map", "0:v:0", "-map", "0:a?",
+            "-c", "copy",
+            "-avoid_negative_ts", "make_zero",
+            path,
+        ],
+        user_id=user_id,
+        priority=Priority.PREVIEW,
+        # Копирование потоков почти не занимает процессор
+        max_threads=1,
+    )
+    await encode_proxy(path, proxy_path, user_id=user_id)
+    return WorkingCopy(path, proxy_path, start, end)
+
+
+def proxy_args(fps: Optional[int] = None) -> List[str]:
+    """Выходные флаги прокси: MJPEG не больше PROXY_MAX_SIDE, без звука"""
+    filters = (
+        f"scale={PROXY_MAX_SIDE}:{PROXY_MAX_SIDE}:force_original_aspect_ratio=decrease,"
+        "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    )
+    if fps:
+        filters = f"fps={fps}," + filters
+    return ["-vf", filters, "-c:v", "mjpeg", "-q:v", "8", "-pix_fmt", "yuvj420p", "-an"]
+
+
+async def encode_proxy(input_path: str, proxy_path: str, fps: Optional[int] = None, user_id: int = 0) -> str:
+    """Уменьшенная копия видео из одних ключевых кадров (MJPEG): любой
+    кадр декодируется без перемотки и в несколько раз дешевле исходного"""
+    await Converter().run(
+        ["-y", "-i", input_path] + proxy_args(fps) + [proxy_path],
+        user_id=user_id,
+        priority=Priority.PREVIEW,
+        max_threads=useful_threads(PROXY_MAX_SIDE, PROXY_MAX_SIDE),
+    )
+    return proxy_path
+
+
+class StreamingProxy:
+    """ffmpeg, который строит прокси всего видео из байтов загрузки по мере
+    их прихода и по пути сообщает размеры и длительность из заголовка.
+    
+    Работает в слоте планировщика с бюджетом потоков, как остальные ffmpeg.
+    Ждать слот в очереди нельзя — байты загрузки идут сейчас, — поэтому
+    без свободного слота start возвращает False.
+    """
+    
+    VIDEO = re.compile(r"Video: .*?(\d{2,5})x(\d{2,5})")
+    
+    def __init__(self, on_head: Optional[HeadCallback] = None):
+        self.on_head = on_head
+        self.proxy_dir = tempfile.mkdtemp(prefix="editor_proxy_")
+        self.proxy_path = os.path.join(self.proxy_dir, "proxy.avi")
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self._stderr_task: Optional[asyncio.Task] = None
+        self._slot = AsyncExitStack()
+        self._broken = False
+    
+    async def start(self, user_id: int = 0) -> bool:
+        scheduler = get_scheduler()
+        if not scheduler.has_free_slot():
+            return False
+        await self._slot.enter_async_context(scheduler.slot(user_id, Priority.PREVIEW))
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                Converter().ffmpeg, "-hide_banner", "-nostats", "-y",
+                "-i", "pipe:0",
+                *proxy_args(PROXY_FPS),
+                "-threads", str(scheduler.thread_budget()),
+                self.proxy_path,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except BaseException:
+            await self._slot.aclose()
+            raise
+        # Загрузка идет со скоростью сети, ffmpeg догоняет из буфера
+        self.process.stdin.transport.set_write_buffer_limits(high=STREAM_BUFFER)
+        self._stderr_task = asyncio.create_task(self._read_stderr())
+        return True
+    
+    async def _read_stderr(self) -> None:
+        duration = None
+        reported = False
+        async for raw in self.process.stderr:
+            line = raw.decode("utf-8", errors="ignore")
+            duration = parse_duration(line) or duration
+            match = self.VIDEO.search(line)
+            if match and duration is not None and not reported:
+                reported = True
+                if self.on_head:
+                    try:
+                        await self.on_head(StreamHead(int(match.group(1)), int(match.group(2)), duration))
+                    except Exception as e:
+                        logger.warning("Ошибка в обработчике начала потока: %s", e)
+    
+    async def feed(self, chunk: bytes) -> None:
+        """Отдает ffmpeg очередной кусок; если ffmpeg упал, загрузка идет дальше без него"""
+        if self._broken:
+            return
+        try:
+            self.process.stdin.write(chunk)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            self._broken = True
+    
+    async def finish(self) -> Optional[str]:
+        """Дожидается ffmpeg; путь к прокси или None, если построить не вышло"""
+        try:
+            if not self._broken:
+                self.process.stdin.close()
+            await self.process.wait()
+            await self._stderr_task
+        finally:
+            await self._slot.aclose()
+        if self.process.returncode == 0 and not self._broken:
+            return self.proxy_path
+        shutil.rmtree(self.proxy_dir, ignore_errors=True)
+        return None
+    
+    async def abort(self) -> None:
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+        if self._stderr_task is not None:
+            self._stderr_task.cancel()
+        await self._slot.aclose()
+        shutil.rmtree(self.proxy_dir, ignore_errors=True)
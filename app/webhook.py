@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import secrets
+import signal
+from typing import Any, Dict, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiohttp import web
+
+from app.config import Config
+from app.services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """Прием обновлений от Telegram по HTTP.
+
+    Каждое обновление обрабатывается отдельной задачей, ответ Telegram
+    отдается сразу. Одновременно обрабатывается не больше max_in_flight
+    обновлений: когда лимит исчерпан, запрос ждет свободного места, и
+    Telegram сам притормаживает доставку. При остановке новые запросы
+    получают 503, а начатые доводятся до конца в пределах drain_timeout.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, max_in_flight: int = 100, **data: Any):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret_token = secret_token
+        self.data = data
+        self._slots = asyncio.Semaphore(max(1, max_in_flight))
+        self._tasks: Set[asyncio.Task] = set()
+        self._draining = False
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    def verify_secret(self, token: str) -> bool:
+        return secrets.compare_digest(token, self.secret_token)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.verify_secret(request.headers.get(SECRET_HEADER, "")):
+            metrics.inc("webhook.unauthorized")
+            return web.Response(text="Unauthorized", status=401)
+        if self._draining:
+            return web.Response(text="Shutting down", status=503)
+        try:
+            update: Dict[str, Any] = await request.json(loads=self.bot.session.json_loads)
+        except ValueError:
+            return web.Response(text="Bad Request", status=400)
+
+        await self._slots.acquire()
+        if self._draining:
+            self._slots.release()
+            return web.Response(text="Shutting down", status=503)
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        metrics.inc("webhook.updates")
+        metrics.set("webhook.in_flight", self.in_flight)
+        return web.json_response({}, dumps=self.bot.session.json_dumps)
+
+    async def _process(self, update: Dict[str, Any]) -> None:
+        try:
+            result = await self.dispatcher.feed_raw_update(bot=self.bot, update=update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot=self.bot, result=result)
+        except Exception:
+            logger.exception("Ошибка обработки обновления из веб-хука")
+        finally:
+            self._slots.release()
+            metrics.set("webhook.in_flight", len(self._tasks) - 1)
+
+    async def drain(self, timeout: float) -> None:
+        """Перестает принимать обновления и ждет завершения начатых"""
+        self._draining = True
+        if not self._tasks:
+            return
+        logger.info("Жду завершения %d обновлений", len(self._tasks))
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            logger.warning("Не дождались %d обновлений, отменяю", len(pending))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def health(self, request: web.Request) -> web.Response:
+        """Проверка для балансировщика: 503 во время остановки"""
+        if self._draining:
+            return web.Response(text="draining", status=503)
+        return web.json_response({"in_flight": self.in_flight})
+
+
+def _stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, cfg: Config) -> None:
+    """Запускает aiohttp-сервер веб-хука и работает до SIGINT/SIGTERM"""
+    server = WebhookServer(dp, bot, cfg.webhook_secret, cfg.webhook_max_in_flight)
+    app = web.Application()
+    app.router.add_post(cfg.webhook_path, server.handle)
+    app.router.add_get("/healthz", server.health)
+
+    workflow_data = {"app": app, "dispatcher": dp, "bot": bot, **dp.workflow_data}
+    await dp.emit_startup(**workflow_data)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, cfg.webhook_host, cfg.webhook_port)
+    await site.start()
+    logger.info("Веб-хук слушает %s:%s%s", cfg.webhook_host, cfg.webhook_port, cfg.webhook_path)
+
+    if cfg.webhook_url:
+        # За балансировщиком веб-хук регистрирует один экземпляр, остальные
+        # запускаются без WEBHOOK_URL
+        await bot.set_webhook(
+            url=cfg.webhook_url.rstrip("/") + cfg.webhook_path,
+            secret_token=cfg.webhook_secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(100, cfg.webhook_max_in_flight),
+        )
+
+    try:
+        await _stop_event().wait()
+    finally:
+        logger.info("Останавливаю веб-хук")
+        await server.drain(cfg.webhook_drain_timeout)
+        await runner.cleanup()
+        await dp.emit_shutdown(**workflow_data)
+        await bot.session.close()
@@ -0,0 +1,59 @@
+"""Точность прогноза размера по истории кодирований против фиксированного
+запаса SIZE_MARGIN.
+
+История проигрывается по порядку: каждое кодирование предсказывается по
+предыдущим, как это было бы в работе бота. Для каждой записи сравнивается
+ожидаемый размер при ее битрейте с фактическим: прежнее правило считает,
+что файл не больше бюджета / SIZE_MARGIN, предиктор — что он в ожидаемое
+отношение больше запрошенного. «Уложился» — фактический размер не больше
+ожидаемого (с тем бюджетом файл попал бы в лимит), «использовано» — какая
+доля ожидаемого размера занята файлом.
+
+    python -m benchmarks.bitrate_predictor history.jsonl
+"""
+import math
+import statistics
+import sys
+from typing import List
+
+from app.services.converter import SIZE_MARGIN
+from app.services.predictor import SAFETY, BitratePredictor, EncodeRecord, load_history
+
+
+def report(name: str, records: List[EncodeRecord], expected: List[float]) -> None:
+    sizes = [r.size for r in records]
+    fits = [size <= e for size, e in zip(sizes, expected)]
+    used = [size / e for size, e in zip(sizes, expected) if size <= e]
+    errors = [abs(math.log(size / e)) for size, e in zip(sizes, expected)]
+    print(
+        f"{name:>12} {len(records):>7} {sum(fits) / len(fits):>10.1%} "
+        f"{statistics.mean(used) if used else 0:>13.1%} {statistics.median(errors):>17.3f}"
+    )
+
+
+def main(path: str) -> None:
+    history = load_history(path)
+    predictor = BitratePredictor(None)
+    evaluated: List[EncodeRecord] = []
+    baseline: List[float] = []
+    predicted: List[float] = []
+    for record in history:
+        ratio = predictor.predict_ratio(record)
+        if ratio is not None:
+            evaluated.append(record)
+            requested = record.requested_bits() / 8
+            baseline.append(requested / SIZE_MARGIN)
+            predicted.append(requested * ratio / SAFETY)
+        predictor.record(record)
+    print(f"{len(history)} кодирований, с прогнозом {len(evaluated)}")
+    if not evaluated:
+        return
+    print(f"{'':>12} {'записей':>7} {'уложился':>10} {'использовано':>13} {'|log ошибки|, мед.':>17}")
+    report("SIZE_MARGIN", evaluated, baseline)
+    report("предиктор", evaluated, predicted)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    main(sys.argv[1])
@@ -0,0 +1,52 @@
+"""Задержка event loop под нагрузкой превью редактора.
+
+Запускает несколько «пользователей», которые параллельно жмут стрелки
+кропа, и сравнивает задержку цикла при синхронных вызовах VideoEditor
+и через AsyncVideoEditor.
+
+    python -m benchmarks.editor_loop_lag path/to/video.mp4
+"""
+import asyncio
+import sys
+
+from app.services.async_editor import AsyncVideoEditor
+from app.services.metrics import metrics, monitor_loop_lag
+from app.services.tiktok import VideoEditor
+
+USERS = 8
+PRESSES = 10
+
+
+async def sync_user(path: str, user: int) -> None:
+    editor = VideoEditor(path)
+    for press in range(PRESSES):
+        editor.create_crop_preview(20 * press, 0, 256, 256, time_seconds=(user + press) * 0.37 % editor.duration)
+        await asyncio.sleep(0)
+
+
+async def async_user(path: str, user: int) -> None:
+    editor = await AsyncVideoEditor.open(path)
+    for press in range(PRESSES):
+        await editor.create_crop_preview(20 * press, 0, 256, 256, time_seconds=(user + press) * 0.37 % editor.duration)
+
+
+async def run(path: str, user_fn) -> float:
+    metrics.set("loop_lag.max_ms", 0)
+    monitor = asyncio.create_task(monitor_loop_lag(interval=0.05))
+    await asyncio.gather(*(user_fn(path, user) for user in range(USERS)))
+    monitor.cancel()
+    return metrics.get("loop_lag.max_ms")
+
+
+async def main(path: str) -> None:
+    sync_lag = await run(path, sync_user)
+    async_lag = await run(path, async_user)
+    print(f"{USERS} пользователей x {PRESSES} нажатий")
+    print(f"  синхронный VideoEditor: макс. задержка цикла {sync_lag:8.1f} ms")
+    print(f"  AsyncVideoEditor:       макс. задержка цикла {async_lag:8.1f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    asyncio.run(main(sys.argv[1]))
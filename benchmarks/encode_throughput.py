@@ -0,0 +1,73 @@
+"""Пропускная способность кодирования (заданий в минуту) при 1, 2, 4 и N
+одновременных заданиях.
+
+Сравнивает прежние аргументы libvpx-vp9 (без -threads, -row-mt и
+-tile-columns: каждый ffmpeg берет все ядра) с бюджетом потоков из
+планировщика. Пресет скорости одинаковый, так что разница только в
+распределении потоков. Каждое задание кодирует первые CLIP секунд файла.
+
+    python -m benchmarks.encode_throughput video1.mp4 [video2.mp4 ...]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from typing import List
+
+from app.config import Defaults
+from app.models import Settings
+from app.services.converter import Converter
+from app.services.encoders import BACKENDS, PRESET_GOOD, useful_threads
+from app.services.scheduler import configure_scheduler
+
+CLIP = 2.0
+JOBS_PER_WORKER = 2
+
+
+def encode_args(path: str, out_path: str, settings: Settings, old: bool) -> List[str]:
+    args = Converter.input_args(path, settings, duration=CLIP) + ["-an"]
+    if old:
+        return args + [
+            "-c:v", "libvpx-vp9", "-crf", str(settings.crf), "-b:v", "0",
+            "-pix_fmt", "yuv420p", "-deadline", "good", "-cpu-used", "2", out_path,
+        ]
+    video = BACKENDS["libvpx-vp9"].video_args(settings.crf, None, PRESET_GOOD, settings.width)
+    return args + video + [out_path]
+
+
+async def run(samples: List[str], concurrency: int, old: bool) -> float:
+    """Возвращает заданий в минуту"""
+    configure_scheduler(concurrency)
+    settings = Settings.from_defaults(Defaults())
+    max_threads = None if old else useful_threads(settings.width, settings.height)
+    jobs = max(len(samples), concurrency * JOBS_PER_WORKER)
+    with tempfile.TemporaryDirectory() as out_dir:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            Converter().run(
+                encode_args(samples[i % len(samples)], os.path.join(out_dir, f"{i}.webm"), settings, old),
+                user_id=i,
+                max_threads=max_threads,
+            )
+            for i in range(jobs)
+        ))
+        elapsed = time.perf_counter() - started
+    return jobs * 60 / elapsed
+
+
+async def main(samples: List[str]) -> None:
+    cpus = os.cpu_count() or 1
+    levels = sorted({1, 2, 4, cpus})
+    print(f"{cpus} ядер, клипы по {CLIP:.0f} s, {len(samples)} файлов")
+    print(f"{'заданий':>8} {'прежние аргументы':>18} {'бюджет потоков':>15}")
+    for concurrency in levels:
+        old = await run(samples, concurrency, old=True)
+        new = await run(samples, concurrency, old=False)
+        print(f"{concurrency:>8} {old:>14.1f}/мин {new:>11.1f}/мин")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,73 @@
+"""Микробенчмарк рендеринга превью кропа на кадре 1080x1920.
+
+Сравнивает прежний путь через PIL (JPEG -> PIL -> RGBA маска -> JPEG)
+с рендерингом по кешированному BGR кадру из app.services.preview.
+
+    python -m benchmarks.preview_render
+"""
+import statistics
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw
+
+from app.services.preview import render_crop_preview
+
+WIDTH, HEIGHT = 1080, 1920
+CROP = (284, 704, 512, 512)
+TARGET_MS = 10.0
+ROUNDS = 50
+
+
+def make_frame() -> np.ndarray:
+    """Синтетический кадр с градиентом и шумом, похожий на реальное видео по сжимаемости"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:HEIGHT, 0:WIDTH]
+    frame = np.stack([(x * 255 // WIDTH), (y * 255 // HEIGHT), ((x + y) % 256)], axis=-1).astype(np.uint8)
+    noise = rng.integers(0, 24, size=frame.shape, dtype=np.uint8)
+    return cv2.add(frame, noise)
+
+
+def legacy_preview(frame: np.ndarray) -> bytes:
+    """Прежняя реализация create_crop_preview вместе с get_frame_at_time"""
+    buffer = BytesIO()
+    Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)).save(buffer, format="JPEG", quality=85)
+    image = Image.open(BytesIO(buffer.getvalue()))
+    crop_x, crop_y, crop_width, crop_height = CROP
+    box = [crop_x, crop_y, crop_x + crop_width, crop_y + crop_height]
+    draw_image = image.copy()
+    ImageDraw.Draw(draw_image).rectangle(box, outline="red", width=3)
+    mask = Image.new("RGBA", image.size, (0, 0, 0, 128))
+    ImageDraw.Draw(mask).rectangle(box, fill=(0, 0, 0, 0))
+    draw_image = Image.alpha_composite(draw_image.convert("RGBA"), mask).convert("RGB")
+    ImageDraw.Draw(draw_image).rectangle(box, outline="red", width=3)
+    out = BytesIO()
+    draw_image.save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+def measure(fn, frame: np.ndarray) -> float:
+    fn(frame)  # прогрев
+    samples = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        fn(frame)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main() -> None:
+    frame = make_frame()
+    frame.setflags(write=False)  # как в кеше кадров VideoEditor
+    legacy_ms = measure(legacy_preview, frame)
+    new_ms = measure(lambda f: render_crop_preview(f, CROP), frame)
+    print(f"Кадр {WIDTH}x{HEIGHT}, медиана по {ROUNDS} вызовам")
+    print(f"  PIL (прежний путь): {legacy_ms:8.2f} ms")
+    print(f"  numpy + один JPEG:  {new_ms:8.2f} ms  ({legacy_ms / new_ms:.1f}x)")
+    print(f"  Цель < {TARGET_MS:.0f} ms: {'OK' if new_ms < TARGET_MS else 'НЕ ДОСТИГНУТА'}")
+
+
+if __name__ == "__main__":
+    main()
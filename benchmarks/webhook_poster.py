@@ -0,0 +1,75 @@
+"""Локальный «Telegram», который шлет обновления в веб-хук бота.
+
+Запустите бота с BOT_MODE=webhook без WEBHOOK_URL (веб-хук тогда не
+регистрируется в Telegram) и натравите на него поток синтетических
+обновлений. Скрипт проверяет отказ по неверному секрету и печатает
+коды ответов и задержку приема.
+
+    BOT_MODE=webhook WEBHOOK_SECRET=test python main.py
+    python -m benchmarks.webhook_poster --secret test --count 500 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import Counter
+
+import aiohttp
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def make_update(update_id: int) -> dict:
+    """Текстовое сообщение, на которое не отвечает ни один обработчик"""
+    user = {"id": 100000 + update_id % 50, "is_bot": False, "first_name": "Load"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"},
+            "from": user,
+            "text": f"ping {update_id}",
+        },
+    }
+
+
+async def post(session: aiohttp.ClientSession, url: str, secret: str, update_id: int):
+    start = time.perf_counter()
+    async with session.post(url, json=make_update(update_id), headers={SECRET_HEADER: secret}) as resp:
+        await resp.read()
+        return resp.status, (time.perf_counter() - start) * 1000
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000/webhook")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    async with aiohttp.ClientSession() as session:
+        status, _ = await post(session, args.url, args.secret + "-wrong", 0)
+        print(f"неверный секрет: HTTP {status} ({'ok' if status == 401 else 'ОЖИДАЛСЯ 401'})")
+
+        sem = asyncio.Semaphore(args.concurrency)
+
+        async def one(update_id: int):
+            async with sem:
+                return await post(session, args.url, args.secret, update_id)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(1, args.count + 1)))
+        elapsed = time.perf_counter() - start
+
+    codes = Counter(status for status, _ in results)
+    latencies = sorted(ms for _, ms in results)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"ответы: {dict(codes)}")
+    print(f"прием: {args.count / elapsed:.0f} обновлений/с, "
+          f"p50 {statistics.median(latencies):.1f} мс, p95 {p95:.1f} мс")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
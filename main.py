@@ -3,24 +3,60 @@ import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from app.config import Config
 from app.handlers.start import router as start_router
 from app.handlers.settings import router as settings_router
 from app.handlers.video import router as video_router
 from app.handlers.tiktok import router as tiktok_router
+from app.services.async_editor import configure_editor_executor
+from app.services.converter import Converter
+from app.services.encoders import configure_encoders
+from app.services.file_ids import configure_file_id_store
+from app.services.jobs import configure_job_queue
+from app.services.metrics import monitor_loop_lag
+from app.services.predictor import configure_predictor
+from app.services.results import configure_result_cache
+from app.services.scheduler import configure_scheduler
+from app.services.spool import configure_spool
+from app.services.storage import create_fsm_storage
+from app.services.tiktok import close_http_session, configure_download_cache
+from app.webhook import run_webhook
 
 
 async def main() -> None:
 	logging.basicConfig(level=logging.INFO)
 	cfg = Config.load()
+	configure_scheduler(cfg.encode_workers)
+	# Какие энкодеры есть в локальной сборке ffmpeg, проверяется один раз
+	configure_encoders(Converter().ffmpeg, cfg.encoder)
+	# Битрейт под размер подбирается по истории прошлых кодирований
+	configure_predictor(cfg.encode_history)
+	configure_editor_executor(cfg.editor_threads)
+	configure_download_cache(cfg.download_cache_dir, cfg.download_cache_max_bytes)
+	configure_result_cache(
+		cfg.result_cache_dir, cfg.result_cache_max_bytes, cfg.result_cache_ttl, enabled=cfg.result_cache_enabled
+	)
+	# Выходы кодирования, которые только отправляются, пишутся в tmpfs. С воркерами
+	# в других процессах каталог должен быть общим, поэтому tmpfs только с local
+	configure_spool(cfg.spool_dir if cfg.job_queue == "local" else None, cfg.spool_max_bytes)
+	configure_file_id_store(cfg.file_id_store)
+	# При JOB_QUEUE=sqlite:... кодируют отдельные процессы worker.py
+	configure_job_queue(cfg.job_queue)
 	bot = Bot(token=cfg.bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-	dp = Dispatcher(storage=MemoryStorage())
+	dp = Dispatcher(storage=create_fsm_storage(cfg.fsm_storage))
 	dp.include_router(start_router)
 	dp.include_router(tiktok_router)
 	dp.include_router(settings_router)
 	dp.include_router(video_router)
-	await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+	lag_monitor = asyncio.create_task(monitor_loop_lag())
+	try:
+		if cfg.mode == "webhook":
+			await run_webhook(dp, bot, cfg)
+		else:
+			await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+	finally:
+		lag_monitor.cancel()
+		await close_http_session()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from app.config import Defaults
+from app.handlers import tiktok as handlers
+from app.models import EditorSession, Settings
+from app.services.converter import FFmpegError
+from app.services.results import configure_result_cache
+from app.services.spool import configure_spool, get_spool
+
+
+class FakeMessage:
+    def __init__(self, bot):
+        self.bot = bot
+        self.chat = SimpleNamespace(id=1)
+        self.message_id = 1
+
+    async def answer(self, text, **kwargs):
+        return FakeMessage(self.bot)
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+    async def delete(self):
+        pass
+
+
+class FakeBot:
+    async def delete_message(self, *args, **kwargs):
+        pass
+
+
+def test_failed_encode_releases_spool(tmp_path, monkeypatch):
+    spool_root = tmp_path / "shm"
+    spool_root.mkdir()
+    configure_spool(str(spool_root), 16 * 1024 * 1024)
+    configure_result_cache(str(tmp_path / "results"), 0, 3600, enabled=False)
+    video_path = tmp_path / "video.mp4"
+    video_path.write_bytes(b"video")
+
+    async def failing_encode(message, title, user_id, **params):
+        # Недописанный выход, как после упавшего ffmpeg
+        with open(params["output_path"], "wb") as f:
+            f.write(b"\0" * 4096)
+        raise FFmpegError("boom")
+
+    async def no_features(session):
+        return {}
+
+    monkeypatch.setattr(handlers, "encode_with_status", failing_encode)
+    monkeypatch.setattr(handlers, "session_features", no_features)
+
+    async def run():
+        state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=1, user_id=1))
+        session = EditorSession(video_path=str(video_path), crop_width=512, crop_height=512, duration=3.0)
+        await state.update_data(settings=Settings.from_defaults(Defaults()).to_dict(), **session.to_dict())
+        bot = FakeBot()
+
+        async def answer(*args, **kwargs):
+            pass
+
+        cb = SimpleNamespace(message=FakeMessage(bot), bot=bot, answer=answer)
+        await handlers.start_video_processing(cb, state)
+
+    asyncio.run(run())
+
+    assert get_spool().used_bytes() == 0
+    assert os.listdir(spool_root) == []
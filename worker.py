@@ -0,0 +1,31 @@
+import asyncio
+import logging
+from app.config import Config
+from app.services.converter import Converter
+from app.services.encoders import configure_encoders
+from app.services.jobs import SqliteJobQueue, configure_job_queue, run_worker
+from app.services.metrics import monitor_loop_lag
+from app.services.predictor import configure_predictor
+from app.services.scheduler import configure_scheduler
+
+
+async def main() -> None:
+	logging.basicConfig(level=logging.INFO)
+	cfg = Config.load()
+	queue = configure_job_queue(cfg.job_queue)
+	if not isinstance(queue, SqliteJobQueue):
+		raise RuntimeError("Воркеру нужна общая очередь: задайте JOB_QUEUE=sqlite:<путь>")
+	configure_scheduler(cfg.encode_workers)
+	# Какие энкодеры есть в локальной сборке ffmpeg, проверяется один раз
+	configure_encoders(Converter().ffmpeg, cfg.encoder)
+	# Битрейт под размер подбирается по истории прошлых кодирований
+	configure_predictor(cfg.encode_history)
+	lag_monitor = asyncio.create_task(monitor_loop_lag())
+	try:
+		await run_worker(queue, cfg.encode_workers)
+	finally:
+		lag_monitor.cancel()
+
+
+if __name__ == "__main__":
+	asyncio.run(main())